@@ -0,0 +1 @@
+from .pressure import SCENARIOS, SOLVERS, open_box, closed_box, random_spheres, maze, run_benchmark, save_results, load_results, compare_results
@@ -0,0 +1,302 @@
+"""
+Benchmarks comparing pressure solvers on standard FluidDomain scenarios.
+
+Run from the command line:
+
+    python -m phi.benchmark.pressure run results.json
+    python -m phi.benchmark.pressure compare baseline.json results.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import scipy.ndimage
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from phi.physics.domain import Domain
+from phi.physics.field import CenteredGrid
+from phi.physics.material import OPEN, CLOSED
+from phi.physics.pressuresolver.amg import AMGSolver
+from phi.physics.pressuresolver.fourier import FourierSolver
+from phi.physics.pressuresolver.geom import GeometricCG
+from phi.physics.pressuresolver.matrix_free import MatrixFreeSciPy
+from phi.physics.pressuresolver.multigrid import MultigridSolver
+from phi.physics.pressuresolver.multiscale import MultiscaleSolver
+from phi.physics.pressuresolver.schwarz import SchwarzCG
+from phi.physics.pressuresolver.solver_api import FluidDomain
+from phi.physics.pressuresolver.sor import SORSolver
+from phi.physics.pressuresolver.sparse import SparseCG, SparseSciPy, sparse_pressure_matrix
+
+
+def open_box(resolution, seed=0):
+    """ Obstacle-free domain with open boundaries. """
+    return _fluid_domain(resolution, OPEN, np.ones(resolution, np.float32))
+
+
+def closed_box(resolution, seed=0):
+    """ Obstacle-free domain with closed boundaries. """
+    return _fluid_domain(resolution, CLOSED, np.ones(resolution, np.float32))
+
+
+def random_spheres(resolution, seed=0, count=8, max_radius=0.15):
+    """ Closed domain containing randomly placed spherical obstacles. """
+    random = np.random.RandomState(seed)
+    points = np.stack(np.meshgrid(*[np.arange(n) + 0.5 for n in resolution], indexing='ij'), -1)
+    active = np.ones(resolution, np.float32)
+    for _ in range(count):
+        center = random.rand(len(resolution)) * resolution
+        radius = random.uniform(0.3, 1) * max_radius * min(resolution)
+        active[np.sum((points - center) ** 2, -1) <= radius ** 2] = 0
+    return _fluid_domain(resolution, CLOSED, active)
+
+
+def maze(resolution, seed=0, spacing=8, gap=3):
+    """ Closed domain divided by walls along the first axis. Each wall has one randomly placed opening. """
+    random = np.random.RandomState(seed)
+    active = np.ones(resolution, np.float32)
+    for position in range(spacing, resolution[0] - 1, spacing):
+        active[position] = 0
+        opening = [random.randint(0, max(1, n - gap)) for n in resolution[1:]]
+        active[(position,) + tuple([slice(start, start + gap) for start in opening])] = 1
+    return _fluid_domain(resolution, CLOSED, active)
+
+
+def _fluid_domain(resolution, boundaries, active):
+    active = CenteredGrid(active.reshape([1] + list(active.shape) + [1]), extrapolation='constant')
+    return FluidDomain(Domain(list(resolution), boundaries=boundaries), active=active, accessible=active)
+
+
+SCENARIOS = {
+    'open_box': open_box,
+    'closed_box': closed_box,
+    'random_spheres': random_spheres,
+    'maze': maze,
+}
+
+SOLVERS = {
+    'SparseCG': lambda: SparseCG(),
+    'SparseSciPy': lambda: SparseSciPy(),
+    'GeometricCG': lambda: GeometricCG(),
+    'MultiscaleSolver': lambda: MultiscaleSolver([SparseCG(), SparseCG()]),
+    'MultigridSolver': lambda: MultigridSolver(),
+    'FourierSolver': lambda: FourierSolver(),
+    'MatrixFreeSciPy': lambda: MatrixFreeSciPy(),
+    'AMGSolver': lambda: AMGSolver(),
+    'SORSolver': lambda: SORSolver(),
+    'SchwarzCG': lambda: SchwarzCG(),
+}
+
+RESOLUTIONS = ([32, 32], [64, 64], [128, 128], [16, 16, 16], [32, 32, 32])
+
+
+def benchmark_divergence(domain, batch_size, seed=0):
+    """
+    Creates a random divergence that is zero in inactive cells.
+    For domains without open boundaries, the divergence is made compatible by removing its mean from each connected fluid region.
+
+    :return: NumPy array of shape (batch_size, resolution..., 1)
+    """
+    resolution = [int(n) for n in domain.domain.resolution]
+    active = domain.active.data
+    divergence = np.random.RandomState(seed).randn(*[batch_size] + resolution + [1]) * active
+    if domain.domain.boundaries == CLOSED:
+        regions, region_count = scipy.ndimage.label(active[0, ..., 0] > 0)
+        for region in range(1, region_count + 1):
+            cells = (slice(None),) + tuple(np.nonzero(regions == region)) + (0,)
+            divergence[cells] -= np.mean(divergence[cells], axis=1, keepdims=True)
+    return divergence.astype(np.float32)
+
+
+def run_case(solver, domain, divergence, repeat=1):
+    """
+    Solves the pressure equation repeat times after one warm-up solve and measures the fastest solve.
+
+    :return: dict with entries wall_time (seconds), iterations, peak_memory (bytes or None) and residual (maximum absolute residual)
+    """
+    solver.solve(divergence, domain, None)  # warm-up, fills operator caches
+    wall_time = np.inf
+    peak_memory = None
+    for _ in range(repeat):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        start = time.time()
+        pressure, iterations = solver.solve(divergence, domain, None)
+        wall_time = min(wall_time, time.time() - start)
+        if tracemalloc is not None:
+            peak_memory = max(peak_memory or 0, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    resolution = [int(n) for n in domain.domain.resolution]
+    A = sparse_pressure_matrix(resolution, domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+    flat_pressure = np.reshape(pressure, [divergence.shape[0], -1]).astype(np.float64)
+    residual = (np.reshape(divergence, flat_pressure.shape) - A.dot(flat_pressure.T).T) * np.reshape(domain.active.data, [1, -1])
+    return {
+        'wall_time': wall_time,
+        'iterations': np.asarray(iterations).tolist() if iterations is not None else None,
+        'peak_memory': peak_memory,
+        'residual': float(np.max(np.abs(residual))),
+    }
+
+
+def run_benchmark(solvers=None, scenarios=None, resolutions=RESOLUTIONS, batch_sizes=(1, 4), repeat=1, seed=0, log=None):
+    """
+    Runs all combinations of solvers, scenarios, resolutions and batch sizes.
+    Failing solves are recorded with an error message instead of measurements.
+
+    :param solvers: names of SOLVERS or dict mapping names to functions creating PressureSolvers. None runs all SOLVERS.
+    :param scenarios: names of SCENARIOS or dict mapping names to functions creating a FluidDomain from a resolution. None runs all SCENARIOS.
+    :param resolutions: list of resolutions, each a list of integers. 2D and 3D resolutions can be mixed.
+    :param batch_sizes: list of batch sizes
+    :param repeat: number of timed solves per case, the fastest one is recorded
+    :param log: (optional) function called with a message after each case, e.g. print
+    :return: list of records (dicts)
+    """
+    solvers = _select(solvers, SOLVERS)
+    scenarios = _select(scenarios, SCENARIOS)
+    records = []
+    for scenario_name, scenario in sorted(scenarios.items()):
+        for resolution in resolutions:
+            domain = scenario(list(resolution), seed=seed)
+            for batch_size in batch_sizes:
+                divergence = benchmark_divergence(domain, batch_size, seed)
+                for solver_name, create_solver in sorted(solvers.items()):
+                    record = {'solver': solver_name, 'scenario': scenario_name, 'resolution': list(resolution), 'batch_size': batch_size}
+                    try:
+                        record.update(run_case(create_solver(), domain, divergence, repeat))
+                    except Exception as exc:
+                        record['error'] = '%s: %s' % (type(exc).__name__, exc)
+                    records.append(record)
+                    if log is not None:
+                        log(format_record(record))
+    return records
+
+
+def _select(selection, available):
+    if selection is None:
+        return dict(available)
+    if isinstance(selection, dict):
+        return selection
+    return {name: available[name] for name in selection}
+
+
+def format_record(record):
+    case = '%s %s %s batch %d' % (record['solver'], record['scenario'], 'x'.join(str(n) for n in record['resolution']), record['batch_size'])
+    if 'error' in record:
+        return '%s: %s' % (case, record['error'])
+    memory = '%.1f MB' % (record['peak_memory'] / 1024. ** 2) if record['peak_memory'] is not None else 'n/a'
+    return '%s: %.4f s, %s iterations, %s, residual %.2e' % (case, record['wall_time'], record['iterations'], memory, record['residual'])
+
+
+def save_results(records, path):
+    """ Writes benchmark records together with information about the environment to a JSON file. """
+    data = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+        'records': records,
+    }
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2)
+
+
+def load_results(path):
+    """ Reads the records written by save_results(). """
+    with open(path) as file:
+        return json.load(file)['records']
+
+
+def compare_results(baseline, current, time_tolerance=0.25, residual_tolerance=10., iteration_tolerance=0.1):
+    """
+    Compares two lists of benchmark records and reports regressions of cases present in both.
+
+    :param baseline: records of the reference run
+    :param current: records of the new run
+    :param time_tolerance: allowed relative increase of the wall time
+    :param residual_tolerance: allowed factor by which the residual may grow
+    :param iteration_tolerance: allowed relative increase of the iteration count
+    :return: list of messages describing regressions, empty if there are none
+    """
+    reference = {_case_key(record): record for record in baseline}
+    regressions = []
+    for record in current:
+        key = _case_key(record)
+        if key not in reference:
+            continue
+        old = reference[key]
+        case = format_record(record).split(':')[0]
+        if 'error' in record:
+            if 'error' not in old:
+                regressions.append('%s failed: %s' % (case, record['error']))
+            continue
+        if 'error' in old:
+            continue
+        if record['wall_time'] > old['wall_time'] * (1 + time_tolerance):
+            regressions.append('%s wall time %.4f s -> %.4f s' % (case, old['wall_time'], record['wall_time']))
+        if record['residual'] > max(old['residual'] * residual_tolerance, 1e-12):
+            regressions.append('%s residual %.2e -> %.2e' % (case, old['residual'], record['residual']))
+        old_iterations, new_iterations = _total_iterations(old), _total_iterations(record)
+        if old_iterations is not None and new_iterations is not None and new_iterations > old_iterations * (1 + iteration_tolerance):
+            regressions.append('%s iterations %s -> %s' % (case, old['iterations'], record['iterations']))
+    return regressions
+
+
+def _case_key(record):
+    return record['solver'], record['scenario'], tuple(record['resolution']), record['batch_size']
+
+
+def _total_iterations(record):
+    if record.get('iterations') is None:
+        return None
+    return int(np.sum(record['iterations']))
+
+
+def format_regressions(regressions):
+    """ Formats the result of compare_results() as a report with one line per regression. """
+    lines = [str(regression) for regression in regressions]
+    lines.append('%d regressions' % len(regressions))
+    return '\n'.join(lines)
+
+
+def main(argv=None, log=None):
+    """
+    Command line entry point.
+
+    :param argv: (optional) command line arguments, defaults to sys.argv
+    :param log: (optional) function called with progress messages and the regression report, e.g. print
+    :return: exit status
+    """
+    parser = argparse.ArgumentParser(description='Pressure solver benchmarks')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='run benchmarks and write the results to a JSON file')
+    run.add_argument('output')
+    run.add_argument('--solvers', nargs='+', choices=sorted(SOLVERS.keys()))
+    run.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS.keys()))
+    run.add_argument('--resolutions', nargs='+', help='resolutions such as 64x64 or 32x32x32')
+    run.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4])
+    run.add_argument('--repeat', type=int, default=1)
+    compare = commands.add_parser('compare', help='compare two result files and list regressions')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--time-tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        resolutions = [[int(n) for n in r.split('x')] for r in args.resolutions] if args.resolutions else RESOLUTIONS
+        records = run_benchmark(args.solvers, args.scenarios, resolutions, args.batch_sizes, args.repeat, log=log)
+        save_results(records, args.output)
+        return 0
+    elif args.command == 'compare':
+        regressions = compare_results(load_results(args.baseline), load_results(args.current), time_tolerance=args.time_tolerance)
+        if log is not None:
+            log(format_regressions(regressions))
+        return 1 if regressions else 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(log=print))
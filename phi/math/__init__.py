@@ -1,5 +1,7 @@
 from .base_backend import DYNAMIC_BACKEND
 from .scipy_backend import SciPyBackend
+from .buffer_pool import BufferPool
+from .parallel import set_num_threads
 from .struct_backend import StructBroadcastBackend
 from .math_util import types, is_static_shape, zeros, ones, randn, randfreq
 from .nd import (spatial_rank, spatial_dimensions, axes, all_dimensions,
@@ -10,17 +12,19 @@ from .nd import (spatial_rank, spatial_dimensions, axes, all_dimensions,
                  blur,
                  l1_loss, l2_loss, l_n_loss,
                  divergence, gradient, axis_gradient, laplace, fourier_laplace,
-                 fftfreq,
+                 fftfreq, spectral_kernel, use_real_fft,
                  downsample2x, upsample2x, interpolate_linear,
                  spatial_sum,)
 
 
 # Setup Backend
-DYNAMIC_BACKEND.add_backend(SciPyBackend())
+SCIPY_BACKEND = SciPyBackend()  # set SCIPY_BACKEND.buffer_pool = BufferPool() to reuse result arrays across simulation steps
+DYNAMIC_BACKEND.add_backend(SCIPY_BACKEND)
 DYNAMIC_BACKEND.add_backend(StructBroadcastBackend(DYNAMIC_BACKEND))
 
 # Enable importing methods directly from math
 choose_backend = DYNAMIC_BACKEND.choose_backend
+use_backend = DYNAMIC_BACKEND.use_backend
 
 abs = DYNAMIC_BACKEND.abs
 add = DYNAMIC_BACKEND.add
@@ -67,6 +71,8 @@ py_func = DYNAMIC_BACKEND.py_func
 random_uniform = DYNAMIC_BACKEND.random_uniform
 range = DYNAMIC_BACKEND.range
 real = DYNAMIC_BACKEND.real
+rfft = DYNAMIC_BACKEND.rfft
+irfft = DYNAMIC_BACKEND.irfft
 resample = DYNAMIC_BACKEND.resample
 reshape = DYNAMIC_BACKEND.reshape
 round = DYNAMIC_BACKEND.round
@@ -1,3 +1,12 @@
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import six
+
+from phi.struct.struct import Struct
+
+
 class Backend:
 
     def __init__(self, name):
@@ -38,7 +47,7 @@ class Backend:
     def concat(self, values, axis):
         raise NotImplementedError(self)
 
-    def pad(self, value, pad_width, mode='constant', constant_values=0):
+    def pad(self, value, pad_width, mode='constant', constant_values=0, out=None):
         """
     Pad a tensor.
         :param value: tensor
@@ -50,6 +59,7 @@ class Backend:
             'circular'
             ('wrap' is deprecated, use 'circular' instead, 'symmetric' may not be supported by all backends and defaults to 'replicate').
         :param constant_values: used for out-of-bounds points if mode='constant'
+        :param out: (optional) array the result is written to. Only supported by the SciPy backend.
         """
         raise NotImplementedError(self)
 
@@ -75,7 +85,7 @@ class Backend:
     def py_func(self, func, inputs, Tout, shape_out, stateful=True, name=None, grad=None):
         raise NotImplementedError(self)
 
-    def resample(self, inputs, sample_coords, interpolation='linear', boundary='constant'):
+    def resample(self, inputs, sample_coords, interpolation='linear', boundary='constant', out=None):
         """
     Interpolates a regular grid at the sample coordinates.
         :param inputs: grid data
@@ -86,6 +96,7 @@ class Backend:
             'replicate',
             'circular'
             ('symmetric' may not be supported by all backends and defaults to 'replicate')
+        :param out: (optional) array the result is written to. Only supported by the SciPy backend.
         """
         raise NotImplementedError(self)
 
@@ -144,7 +155,7 @@ class Backend:
     def exp(self, x):
         raise NotImplementedError(self)
 
-    def conv(self, tensor, kernel, padding='same'):
+    def conv(self, tensor, kernel, padding='same', out=None):
         raise NotImplementedError(self)
 
     def expand_dims(self, a, axis=0, number=1):
@@ -225,6 +236,26 @@ class Backend:
         """
         raise NotImplementedError(self)
 
+    def rfft(self, x):
+        """
+        Computes the n-dimensional FFT of a real tensor along all but the first and last dimensions.
+        Only the non-negative frequencies of the last spatial dimension are computed which roughly halves the work compared to fft().
+
+        :param x: real tensor of dimension 3 or higher
+        :return: complex tensor where the last spatial dimension has length n//2+1
+        """
+        raise NotImplementedError(self)
+
+    def irfft(self, k, resolution):
+        """
+        Inverse of rfft().
+
+        :param k: complex tensor as returned by rfft()
+        :param resolution: spatial shape of the real result
+        :return: real tensor
+        """
+        raise NotImplementedError(self)
+
     def imag(self, complex):
         raise NotImplementedError(self)
 
@@ -262,16 +293,20 @@ class Backend:
             batches = [batches]
         return tensor[batches, ...]
 
-    def add(self, a, b):
-        return self.as_tensor(a) * self.as_tensor(b)
+    def add(self, a, b, out=None):
+        assert out is None, '%s does not support out' % self.name
+        return self.as_tensor(a) + self.as_tensor(b)
 
-    def sub(self, a, b):
+    def sub(self, a, b, out=None):
+        assert out is None, '%s does not support out' % self.name
         return self.as_tensor(a) - self.as_tensor(b)
 
-    def mul(self, a, b):
+    def mul(self, a, b, out=None):
+        assert out is None, '%s does not support out' % self.name
         return self.as_tensor(a) * self.as_tensor(b)
 
-    def div(self, numerator, denominator):
+    def div(self, numerator, denominator, out=None):
+        assert out is None, '%s does not support out' % self.name
         return self.as_tensor(numerator) / self.as_tensor(denominator)
 
     def pow(self, base, exp):
@@ -283,20 +318,66 @@ class DynamicBackend(Backend):
     def __init__(self):
         Backend.__init__(self, 'Dynamic')
         self.backends = []
+        self._dispatch_cache = {}  # tuple of argument types -> backend
+        self._pinned = _PinnedBackend()
 
     def choose_backend(self, values):
+        """
+        Returns the first registered backend applicable to the given values.
+
+        The result is cached by the types of the values unless a value is a list, tuple or dict whose content determines the backend.
+        Inside a use_backend() block, the pinned backend is returned for all values except lists, tuples, dicts and structs.
+
+        :param values: single value or list/tuple of values
+        :return: Backend
+        """
+        pinned = self._pinned.backend
+        if type(values) is np.ndarray and pinned is None:  # fast path for the most common call
+            backend = self._dispatch_cache.get(_NDARRAY_KEY, None)
+            if backend is not None:
+                return backend
         if not isinstance(values, tuple) and not isinstance(values, list):
             values = [values]
+        if pinned is not None and not any(isinstance(value, _CONTAINER_TYPES + (Struct,)) for value in values):
+            return pinned
+        key = tuple(type(value) for value in values)
+        backend = self._dispatch_cache.get(key, None)
+        if backend is not None:
+            return backend
         for backend in self.backends:
             if backend.is_applicable(values):
+                if len(key) <= MAX_CACHED_DISPATCH_ARGUMENTS and not any(isinstance(value, _CONTAINER_TYPES) for value in values):
+                    self._dispatch_cache[key] = backend
                 return backend
         raise NoBackendFound('No backend found for values %s; registered backends are %s' % (values, self.backends))
 
+    @contextmanager
+    def use_backend(self, backend):
+        """
+        Context manager pinning a backend for all math calls of the current thread within the block.
+        Backend dispatch is skipped for all arguments except lists, tuples, dicts and structs which are still dispatched by content.
+
+        Only use this if all tensors passed to math functions inside the block belong to the backend.
+
+        :param backend: Backend, name of a registered backend or None to keep dynamic dispatch
+        """
+        if isinstance(backend, six.string_types):
+            matching = [registered for registered in self.backends if registered.name.lower() == backend.lower()]  # StructBroadcastBackend proxies matches_name()
+            assert matching, 'No registered backend named %s; registered backends are %s' % (backend, self.backends)
+            backend = matching[0]
+        previous = self._pinned.backend
+        self._pinned.backend = backend if backend is not None else previous
+        try:
+            yield backend
+        finally:
+            self._pinned.backend = previous
+
     def add_backend(self, backend):
         for existing in self.backends:
             if existing.name == backend.name:
                 return False
         self.backends.append(backend)
+        self._dispatch_cache.clear()
         return True
 
     def is_applicable(self, values):
@@ -331,8 +412,8 @@ class DynamicBackend(Backend):
     def tile(self, value, multiples):
         return self.choose_backend(value).tile(value, multiples)
 
-    def pad(self, value, pad_width, mode='constant', constant_values=0):
-        return self.choose_backend(value).pad(value, pad_width, mode, constant_values)
+    def pad(self, value, pad_width, mode='constant', constant_values=0, out=None):
+        return self.choose_backend(value).pad(value, pad_width, mode, constant_values, out=out)
 
     def reshape(self, value, shape):
         return self.choose_backend(value).reshape(value, shape)
@@ -356,8 +437,8 @@ class DynamicBackend(Backend):
     def py_func(self, func, inputs, Tout, shape_out, stateful=True, name=None, grad=None):
         return self.choose_backend(inputs).py_func(func, inputs, Tout, shape_out, stateful, name, grad)
 
-    def resample(self, inputs, sample_coords, interpolation='linear', boundary='constant'):
-        return self.choose_backend((inputs, sample_coords)).resample(inputs, sample_coords, interpolation, boundary)
+    def resample(self, inputs, sample_coords, interpolation='linear', boundary='constant', out=None):
+        return self.choose_backend((inputs, sample_coords)).resample(inputs, sample_coords, interpolation, boundary, out=out)
 
     def range(self, start, limit=None, delta=1, dtype=None):
         return self.choose_backend((start, limit, delta)).range(start, limit, delta, dtype)
@@ -413,8 +494,8 @@ class DynamicBackend(Backend):
     def exp(self, x):
         return self.choose_backend(x).exp(x)
 
-    def conv(self, tensor, kernel, padding='SAME'):
-        return self.choose_backend([tensor, kernel]).conv(tensor, kernel, padding)
+    def conv(self, tensor, kernel, padding='SAME', out=None):
+        return self.choose_backend([tensor, kernel]).conv(tensor, kernel, padding, out=out)
 
     def expand_dims(self, a, axis=0, number=1):
         return self.choose_backend(a).expand_dims(a, axis, number)
@@ -467,6 +548,12 @@ class DynamicBackend(Backend):
     def ifft(self, k):
         return self.choose_backend(k).ifft(k)
 
+    def rfft(self, x):
+        return self.choose_backend(x).rfft(x)
+
+    def irfft(self, k, resolution):
+        return self.choose_backend(k).irfft(k, resolution)
+
     def imag(self, complex):
         return self.choose_backend(complex).imag(complex)
 
@@ -488,22 +575,31 @@ class DynamicBackend(Backend):
     def dtype(self, array):
         return self.choose_backend(array).dtype(array)
 
-    def add(self, a, b):
-        return self.choose_backend([a, b]).add(a, b)
+    def add(self, a, b, out=None):
+        return self.choose_backend([a, b]).add(a, b, out=out)
 
-    def sub(self, a, b):
-        return self.choose_backend([a, b]).sub(a, b)
+    def sub(self, a, b, out=None):
+        return self.choose_backend([a, b]).sub(a, b, out=out)
 
-    def mul(self, a, b):
-        return self.choose_backend([a, b]).mul(a, b)
+    def mul(self, a, b, out=None):
+        return self.choose_backend([a, b]).mul(a, b, out=out)
 
-    def div(self, numerator, denominator):
-        return self.choose_backend([numerator, denominator]).div(numerator, denominator)
+    def div(self, numerator, denominator, out=None):
+        return self.choose_backend([numerator, denominator]).div(numerator, denominator, out=out)
 
     def pow(self, base, exp):
         return self.choose_backend([base, exp]).pow(base, exp)
 
 
+class _PinnedBackend(threading.local):
+    backend = None  # class attribute as default, looking up missing attributes of thread-locals is slow
+
+
+MAX_CACHED_DISPATCH_ARGUMENTS = 8
+_NDARRAY_KEY = (np.ndarray,)
+_CONTAINER_TYPES = (list, tuple, dict)
+
+
 class NoBackendFound(Exception):
 
     def __init__(self, msg):
@@ -1,42 +1,71 @@
 # coding=utf-8
+import numpy as np
+
 from .base_backend import DYNAMIC_BACKEND as math
 
 
-def conjugate_gradient(k, apply_A, initial_x=None, accuracy=1e-5, max_iterations=1024, back_prop=False):
+RESIDUAL_NORMS = ('max', 'l2', 'rms')
+
+
+def conjugate_gradient(k, apply_A, initial_x=None, accuracy=1e-5, max_iterations=1024, back_prop=False, preconditioner=None, per_example=False, compact=False,
+                       norm='max', relative=False, callback=None):
     """
     Solve the linear system of equations Ax=k using the conjugate gradient (CG) algorithm.
     The implementation is based on https://nvlpubs.nist.gov/nistpubs/jres/049/jresv49n6p409_A1b.pdf
 
+    The first dimension of k is treated as batch dimension, all other dimensions are reduced in the inner products.
+
     :param k: Right-hand-side vector
     :param apply_A: function that takes x and calculates Ax
     :param initial_x: initial guess for the value of x
-    :param accuracy: the algorithm terminates once |Ax-k| ≤ accuracy for every element. If None, the algorithm runs until max_iterations is reached.
+    :param accuracy: the algorithm terminates once ‖Ax-k‖ ≤ accuracy for every example. If None, the algorithm runs until max_iterations is reached.
     :param max_iterations: maximum number of CG iterations to perform
-    :return: Pair containing the result for x and the number of iterations performed
+    :param preconditioner: (optional) function that takes a residual r and approximates the solution of Ax=r.
+        It must represent a fixed symmetric linear operator with the same definiteness as A.
+    :param per_example: if True, tracks convergence for each example of the batch separately.
+        Converged examples are frozen while the remaining ones continue iterating.
+    :param compact: only with per_example=True and NumPy arrays. Removes converged examples from the batch so that apply_A is only evaluated for the remaining ones.
+        apply_A and preconditioner must accept any batch size.
+    :param norm: norm of the residual compared against accuracy, one of
+        'max' (largest absolute element), 'l2' (Euclidean norm) or 'rms' (root mean square, independent of the resolution)
+    :param relative: if True, the accuracy is relative to the norm of k, i.e. the algorithm terminates once ‖Ax-k‖ ≤ accuracy ‖k‖.
+        With norm='max', this scales the accuracy by the largest divergence of each example. Examples with k=0 use the absolute accuracy.
+    :param callback: (optional) function(iteration, residual) called after every iteration, e.g. to record the residual history.
+        Only called for NumPy arrays. With compact=True, the residual only contains the unconverged examples.
+    :return: Pair containing the result for x and the number of iterations performed. With per_example=True, the iterations are a vector holding the count for each example.
     """
-    # Get momentum = k - Ax
+    assert norm in RESIDUAL_NORMS, 'invalid norm: %s' % norm
+    if preconditioner is None:
+        preconditioner = _identity
+    if accuracy is not None:
+        accuracy = _stopping_threshold(k, accuracy, norm, relative)
+    if per_example and compact and isinstance(k, np.ndarray) and accuracy is not None:
+        return _compacted_conjugate_gradient(k, apply_A, initial_x, accuracy, max_iterations, preconditioner, norm, callback)
+    # Get residual = k - Ax
     if initial_x is None:
         x = math.zeros_like(k)
-        momentum = k
+        residual = k
     else:
         x = initial_x
-        momentum = k - apply_A(x)
+        residual = k - apply_A(x)
     # Further Variables
-    residual = momentum  # residual is previous momentum
+    momentum = preconditioner(residual)  # search direction
     laplace_momentum = apply_A(momentum)  # = A*momentum
     loop_index = 0  # initial
     # Pack Variables for loop
     variables = [x, momentum, laplace_momentum, residual, loop_index]
+    if per_example:
+        variables.append(math.to_int(math.zeros_like(math.max(k, axis=tuple(range(1, math.ndims(k)))))))  # iterations of each example
     # Ensure to run until desired accuracy is achieved
     if accuracy is not None:
-        def loop_condition(_1, _2, _3, residual, _i):
-            '''continue if the maximum deviation from zero is bigger than desired accuracy'''
-            return math.max(math.abs(residual)) >= accuracy
+        def loop_condition(_1, _2, _3, residual, *_args):
+            '''continue if the residual norm of any example is bigger than desired accuracy'''
+            return math.any(_unconverged(residual, accuracy, norm))
     else:
         def loop_condition(*_args):
             return True
 
-    def loop_body(pressure, momentum, A_times_momentum, residual, loop_index):
+    def loop_body(pressure, momentum, A_times_momentum, residual, loop_index, *example_iterations):
         """
         iteratively solve for:
         x : pressure
@@ -44,18 +73,161 @@ def conjugate_gradient(k, apply_A, initial_x=None, accuracy=1e-5, max_iterations
         laplace_momentum : A_times_momentum
         residual : residual
         """
-        tmp = math.sum(momentum * A_times_momentum, axis=1, keepdims=True)  # t = sum(mAm)
-        a = math.divide_no_nan(math.sum(momentum * residual, axis=1, keepdims=True), tmp)  # a = sum(mr)/sum(mAm)
-        pressure += a * momentum  # p += am
-        residual -= a * A_times_momentum  # r -= aAm
-        momentum = residual - math.divide_no_nan(math.sum(residual * A_times_momentum, axis=1, keepdims=True) * momentum, tmp)  # m = r-sum(rAm)*m/t = r-sum(rAm)*m/sum(mAm)
+        tmp = _batch_dot(momentum, A_times_momentum)  # t = sum(mAm)
+        a = math.divide_no_nan(_batch_dot(momentum, residual), tmp)  # a = sum(mr)/sum(mAm)
+        if per_example and accuracy is None:
+            example_iterations = [example_iterations[0] + 1]
+        elif per_example:
+            unconverged = _unconverged(residual, accuracy, norm)
+            a = a * math.reshape(math.to_float(unconverged), math.shape(a))  # converged examples keep their pressure and residual
+            example_iterations = [example_iterations[0] + math.to_int(unconverged)]
+        pressure = pressure + a * momentum  # p += am, not in-place as NumPy arrays may alias k or initial_x
+        residual = residual - a * A_times_momentum  # r -= aAm
+        preconditioned = preconditioner(residual)  # z = Mr
+        momentum = preconditioned - math.divide_no_nan(_batch_dot(preconditioned, A_times_momentum) * momentum, tmp)  # m = z-sum(zAm)*m/t = z-sum(zAm)*m/sum(mAm)
         A_times_momentum = apply_A(momentum)  # Am = A*m
-        return [pressure, momentum, A_times_momentum, residual, loop_index + 1]
-
-    x, momentum, laplace_momentum, residual, loop_index = math.while_loop(loop_condition, loop_body, variables,
-                                                                          parallel_iterations=2, back_prop=back_prop,
-                                                                          swap_memory=False,
-                                                                          name="pressure_solve_loop",
-                                                                          maximum_iterations=max_iterations)
+        if callback is not None and isinstance(residual, np.ndarray):
+            callback(loop_index + 1, residual)
+        return [pressure, momentum, A_times_momentum, residual, loop_index + 1] + list(example_iterations)
 
+    result = math.while_loop(loop_condition, loop_body, variables,
+                             parallel_iterations=2, back_prop=back_prop,
+                             swap_memory=False,
+                             name="pressure_solve_loop",
+                             maximum_iterations=max_iterations)
+    x, loop_index = result[0], result[4]
+    if per_example:
+        return x, result[5]
     return x, loop_index
+
+
+def refined_conjugate_gradient(k, apply_A, apply_A_high, initial_x=None, accuracy=1e-5, max_iterations=1024, preconditioner=None,
+                               residual_reduction=1e-3, refinement_interval=None, per_example=False, norm='max', relative=False, callback=None):
+    """
+    Mixed-precision conjugate gradient using iterative refinement. Only supports NumPy arrays.
+
+    The solution and the true residual k - Ax are kept in float64.
+    Each refinement step runs conjugate_gradient() in the precision of k (typically float32) to solve for a correction,
+    until the residual is reduced by residual_reduction or refinement_interval iterations have been performed.
+    The correction is added in float64, the true residual is recomputed with apply_A_high and CG restarts.
+    This reaches accuracies at which single precision CG stagnates because its recursively updated residual drifts from the true residual.
+
+    :param k: Right-hand-side vector, NumPy array
+    :param apply_A: function that takes x in the precision of k and calculates Ax
+    :param apply_A_high: function that takes x in float64 and calculates Ax in float64
+    :param initial_x: initial guess for the value of x
+    :param accuracy: the algorithm terminates once ‖Ax-k‖ ≤ accuracy for every example, measured in float64 before rounding the result to the dtype of k
+    :param max_iterations: maximum total number of CG iterations or None for no limit
+    :param preconditioner: (optional) function that takes a residual r and approximates the solution of Ax=r, see conjugate_gradient()
+    :param residual_reduction: relative reduction of the residual after which a refinement step ends
+    :param refinement_interval: (optional) maximum number of CG iterations per refinement step
+    :param per_example: if True, converged examples are frozen and the iterations are counted for each example, see conjugate_gradient()
+    :param norm: residual norm, see conjugate_gradient()
+    :param relative: if True, the accuracy is relative to the norm of k, see conjugate_gradient()
+    :param callback: (optional) function(iteration, residual) called with the total iteration count and the float64 true residual after every refinement step
+    :return: Pair containing the result for x in the dtype of k and the total number of CG iterations (a vector with per_example=True)
+    """
+    assert isinstance(k, np.ndarray), 'refined_conjugate_gradient only supports NumPy arrays'
+    assert norm in RESIDUAL_NORMS, 'invalid norm: %s' % norm
+    k_high = k.astype(np.float64)
+    accuracy = _stopping_threshold(k_high, accuracy, norm, relative)
+    x = np.zeros_like(k_high) if initial_x is None else np.array(initial_x, np.float64)
+    residual = k_high if initial_x is None else k_high - apply_A_high(x)
+    example_iterations = np.zeros(k.shape[0], np.int32)
+    iteration = 0
+    while max_iterations is None or iteration < max_iterations:
+        unconverged = _unconverged(residual, accuracy, norm)
+        if not np.any(unconverged):
+            break
+        inner_accuracy = residual_reduction * np.max(np.abs(residual))
+        inner_iterations = None if max_iterations is None else max_iterations - iteration
+        if refinement_interval is not None:
+            inner_iterations = refinement_interval if inner_iterations is None else min(inner_iterations, refinement_interval)
+        inner_residual = (residual * unconverged.reshape([-1] + [1] * (residual.ndim - 1))).astype(k.dtype)  # converged examples receive no correction
+        correction, inner = conjugate_gradient(inner_residual, apply_A, None, inner_accuracy, inner_iterations,
+                                               preconditioner=preconditioner, per_example=per_example, compact=per_example)
+        if np.max(inner) == 0:
+            break
+        x += correction
+        residual = k_high - apply_A_high(x)
+        example_iterations += inner if per_example else unconverged * int(inner)
+        iteration += int(np.max(inner))
+        if callback is not None:
+            callback(iteration, residual)
+    return x.astype(k.dtype), (example_iterations if per_example else iteration)
+
+
+def _compacted_conjugate_gradient(k, apply_A, initial_x, accuracy, max_iterations, preconditioner, norm='max', callback=None):
+    """
+    NumPy implementation of conjugate_gradient(per_example=True) that only iterates the unconverged examples.
+    Vectors of converged examples are removed from the batch instead of being masked.
+
+    :param accuracy: scalar or vector holding the accuracy of each example
+    """
+    accuracy = np.broadcast_to(accuracy, k.shape[:1])
+    x = np.zeros_like(k) if initial_x is None else np.array(initial_x)
+    residual = k if initial_x is None else k - apply_A(x)
+    momentum = preconditioner(residual)
+    A_times_momentum = apply_A(momentum)
+    example_iterations = np.zeros(k.shape[0], np.int32)
+    active = np.arange(k.shape[0])  # indices of unconverged examples
+    iteration = 0
+    while max_iterations is None or iteration < max_iterations:
+        unconverged = _unconverged(residual, accuracy, norm)
+        if not np.any(unconverged):
+            break
+        if not np.all(unconverged):
+            active, residual, momentum, A_times_momentum = active[unconverged], residual[unconverged], momentum[unconverged], A_times_momentum[unconverged]
+            accuracy = accuracy[unconverged]
+        tmp = _batch_dot(momentum, A_times_momentum)
+        a = math.divide_no_nan(_batch_dot(momentum, residual), tmp)
+        x[active] += a * momentum
+        residual = residual - a * A_times_momentum
+        preconditioned = preconditioner(residual)
+        momentum = preconditioned - math.divide_no_nan(_batch_dot(preconditioned, A_times_momentum) * momentum, tmp)
+        A_times_momentum = apply_A(momentum)
+        example_iterations[active] += 1
+        iteration += 1
+        if callback is not None:
+            callback(iteration, residual)
+    return x, example_iterations
+
+
+def _identity(x):
+    return x
+
+
+def residual_norm(residual, norm='max'):
+    """
+    Computes the norm of the residual for each example of the batch.
+
+    :param residual: tensor whose first dimension is the batch dimension
+    :param norm: one of 'max', 'l2', 'rms'
+    :return: vector holding the norm of each example
+    """
+    axes = tuple(range(1, math.ndims(residual)))
+    if norm == 'max':
+        return math.max(math.abs(residual), axis=axes)
+    if norm == 'l2':
+        return math.sqrt(math.sum(residual ** 2, axis=axes))
+    if norm == 'rms':
+        return math.sqrt(math.mean(residual ** 2, axis=axes))
+    raise ValueError('invalid norm: %s' % norm)
+
+
+def _stopping_threshold(k, accuracy, norm, relative):
+    """ Returns the accuracy, scaled by the norm of each example of k if relative. """
+    if not relative:
+        return accuracy
+    k_norm = residual_norm(k, norm)
+    return accuracy * math.where(k_norm > 0, k_norm, math.ones_like(k_norm))
+
+
+def _unconverged(residual, accuracy, norm='max'):
+    """ Boolean vector marking the examples whose residual norm exceeds the accuracy (scalar or vector). """
+    return residual_norm(residual, norm) >= accuracy
+
+
+def _batch_dot(a, b):
+    """ Inner product of a and b for each example of the batch, keeping all dimensions. """
+    return math.sum(a * b, axis=tuple(range(1, math.ndims(a))), keepdims=True)
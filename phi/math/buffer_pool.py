@@ -0,0 +1,94 @@
+import sys
+import threading
+
+import numpy as np
+
+
+class BufferPool(object):
+
+    def __init__(self, max_bytes=1024 ** 3, min_bytes=64 * 1024):
+        """
+        Pool of NumPy arrays that are reused as outputs of backend operations, see SciPyBackend(buffer_pool).
+
+        Arrays handed out by allocate() stay registered with the pool.
+        An array is reused for a later allocation of the same shape and dtype once nothing else references it,
+        i.e. once the result and all views of it have been garbage collected.
+        Results that are kept, e.g. as part of a simulation state, are therefore never overwritten.
+        When stepping a simulation, the temporaries of one step are reused by the next, so that steady-state stepping allocates few new arrays.
+
+        :param max_bytes: upper limit for the memory held by unreferenced arrays of the pool. Exceeding arrays are released, least recently used first.
+        :param min_bytes: arrays smaller than this are allocated normally as the system allocator handles them efficiently
+        """
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self._buffers = {}  # (shape, dtype) -> list of arrays, least recently used first
+        self._lock = threading.Lock()
+        self.reused = 0  # number of allocations served from the pool
+        self.allocated = 0  # number of new arrays allocated by the pool
+        self.reused_bytes = 0
+        self.allocated_bytes = 0
+
+    def allocate(self, shape, dtype=np.float32):
+        """
+        Returns an uninitialized array, reusing an unreferenced array of the pool if possible.
+
+        :param shape: shape of the array
+        :param dtype: NumPy dtype
+        :return: C-contiguous NumPy array
+        """
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in shape)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if nbytes < self.min_bytes:
+            return np.empty(shape, dtype)
+        key = (shape, dtype.str)
+        with self._lock:
+            buffers = self._buffers.setdefault(key, [])
+            for i in range(len(buffers)):
+                if _is_unreferenced(buffers, i):
+                    buffer = buffers.pop(i)
+                    buffers.append(buffer)
+                    self.reused += 1
+                    self.reused_bytes += nbytes
+                    return buffer
+            buffer = np.empty(shape, dtype)
+            buffers.append(buffer)
+            self.allocated += 1
+            self.allocated_bytes += nbytes
+            self._release_unreferenced(self.max_bytes)
+            return buffer
+
+    @property
+    def nbytes(self):
+        """ Total memory of all arrays registered with the pool, including arrays that are still referenced. """
+        return sum(buffer.nbytes for buffers in self._buffers.values() for buffer in buffers)
+
+    def clear(self):
+        """ Releases all arrays of the pool and resets the statistics. Referenced arrays remain valid. """
+        with self._lock:
+            self._buffers.clear()
+            self.reused = self.allocated = self.reused_bytes = self.allocated_bytes = 0
+
+    def _release_unreferenced(self, max_bytes):
+        free = [(key, buffers[i]) for key, buffers in self._buffers.items() for i in range(len(buffers) - 1) if _is_unreferenced(buffers, i)]
+        free_bytes = sum(buffer.nbytes for _, buffer in free)
+        for key, buffer in free:  # least recently used first within each key
+            if free_bytes <= max_bytes:
+                break
+            self._buffers[key] = [b for b in self._buffers[key] if b is not buffer]
+            free_bytes -= buffer.nbytes
+
+    def __repr__(self):
+        return 'BufferPool(%d reused, %d allocated, %.1f MB)' % (self.reused, self.allocated, self.nbytes / 1024. ** 2)
+
+
+def _is_unreferenced(buffers, index):
+    """ Tests whether the array buffers[index] is only referenced by the list. """
+    return _reference_count(buffers, index) <= _LIST_REFERENCES
+
+
+def _reference_count(buffers, index):
+    return sys.getrefcount(buffers[index])
+
+
+_LIST_REFERENCES = _reference_count([np.empty(0)], 0)  # count of an array only referenced by a list, independent of the interpreter version
@@ -1,11 +1,14 @@
 # Because division is different in Python 2 and 3
 from __future__ import division
 
+from collections import OrderedDict
+
 import numpy as np
+import six
 
 from phi import struct
 from phi.struct.tensorop import collapsed_gather_nd
-from .base_backend import DYNAMIC_BACKEND as math
+from .base_backend import Backend, DYNAMIC_BACKEND as math
 
 
 def spatial_rank(tensor):
@@ -109,8 +112,7 @@ Runs a blur kernel over the given tensor.
     else:
         raise ValueError("Unknown kernel: %s" % kernel)
     weights /= math.sum(weights)
-    weights = math.reshape(weights, list(weights.shape) + [1, 1])
-    return math.conv(field, weights)
+    return math.conv(field, _channelwise_kernel(weights, int(field.shape[-1])))
 
 
 def l1_loss(tensor, batch_norm=True, reduce_batches=True):
@@ -293,23 +295,22 @@ def laplace(tensor, padding='replicate', axes=None):
 
 
 def _conv_laplace_2d(tensor):
-    kernel = np.zeros((3, 3, 1, 1), np.float32)
-    kernel[1, 1, 0, 0] = -4
-    kernel[(0,1,1,2), (1,0,2,1), 0, 0] = 1
-    if tensor.shape[-1] == 1:
-        return math.conv(tensor, kernel, padding='VALID')
-    else:
-        return math.concat([math.conv(tensor[..., i:i+1], kernel, padding='VALID') for i in range(tensor.shape[-1])], -1)
+    kernel = np.zeros((3, 3), np.float32)
+    kernel[1, 1] = -4
+    kernel[(0,1,1,2), (1,0,2,1)] = 1
+    return math.conv(tensor, _channelwise_kernel(kernel, int(tensor.shape[-1])), padding='VALID')
 
 
 def _conv_laplace_3d(tensor):
-    kernel = np.zeros((3, 3, 3, 1, 1), np.float32)
-    kernel[1, 1, 1, 0, 0] = -6
-    kernel[(0,1,1,1,1,2), (1,0,2,1,1,1), (1,1,1,0,2,1), 0, 0] = 1
-    if tensor.shape[-1] == 1:
-        return math.conv(tensor, kernel, padding='VALID')
-    else:
-        return math.concat([math.conv(tensor[..., i:i+1], kernel, padding='VALID') for i in range(tensor.shape[-1])], -1)
+    kernel = np.zeros((3, 3, 3), np.float32)
+    kernel[1, 1, 1] = -6
+    kernel[(0,1,1,1,1,2), (1,0,2,1,1,1), (1,1,1,0,2,1)] = 1
+    return math.conv(tensor, _channelwise_kernel(kernel, int(tensor.shape[-1])), padding='VALID')
+
+
+def _channelwise_kernel(kernel, channels):
+    """ Convolution kernel applying the given spatial kernel to each of the channels independently. """
+    return kernel[..., None, None] * np.eye(channels, dtype=kernel.dtype)
 
 
 def _sliced_laplace_nd(tensor, axes=None):
@@ -342,24 +343,97 @@ def map_for_axes(function, obj, axes, rank):
 
 
 def fourier_laplace(tensor):
-    frequencies = math.fft(math.to_complex(tensor))
-    k = fftfreq(math.staticshape(tensor)[1:-1], mode='square')
-    fft_laplace = -(2*np.pi)**2 * k
-    return math.ifft(frequencies * fft_laplace)
+    """
+    Laplace operator with periodic boundaries, evaluated in frequency space.
+    Real tensors are transformed with real FFTs which only compute the non-negative frequencies of the last spatial dimension.
+    If the backend has no real FFT, the full complex FFT is used instead.
+
+    :param tensor: tensor of shape (batch, spatial dimensions..., components)
+    :return: tensor of same shape, real if the real FFT was used, complex otherwise
+    """
+    resolution = [int(n) for n in math.staticshape(tensor)[1:-1]]
+    real = use_real_fft(tensor)
+    fft_laplace = spectral_kernel(('laplace', tuple(resolution), real), lambda: -(2 * np.pi) ** 2 * fftfreq(resolution, mode='square', real=real))
+    if real:
+        return math.irfft(math.rfft(tensor) * fft_laplace, resolution)
+    return math.ifft(math.fft(math.to_complex(tensor)) * fft_laplace)
+
+
+def use_real_fft(tensor):
+    """
+    Tests whether math.rfft() and math.irfft() can replace math.fft() and math.ifft() for a tensor.
+    This is the case if the tensor is real and its backend implements the real FFT.
+
+    :param tensor: tensor of any backend
+    :return: bool
+    """
+    backend = math.choose_backend(tensor)
+    if six.get_unbound_function(backend.__class__.rfft) is six.get_unbound_function(Backend.rfft):
+        return False
+    return not _is_complex_dtype(backend.dtype(tensor))
+
+
+def _is_complex_dtype(dtype):
+    try:
+        return np.dtype(dtype).kind == 'c'
+    except TypeError:  # not a NumPy type, e.g. torch.dtype or tf.DType
+        return getattr(dtype, 'is_complex', True)
+
+
+SPECTRAL_KERNEL_CACHE_SIZE = 32
+_SPECTRAL_KERNELS = OrderedDict()  # key -> read-only NumPy array
+
 
+def spectral_kernel(key, create):
+    """
+    Returns a kernel in frequency space, such as the diffusion factors exp(-(2 pi k)^2 dt), from a bounded least-recently-used cache.
+    This avoids recomputing frequency grids and exponentials in every simulation step.
+
+    Only NumPy kernels are cached. Kernels are read-only.
+    Keys that cannot be hashed, e.g. because they contain arrays, bypass the cache.
 
-def fftfreq(resolution, mode='vector', dtype=np.float32):
+    :param key: hashable tuple of everything the kernel depends on, e.g. (name, resolution, dx, dt, coefficient)
+    :param create: function without arguments computing the kernel
+    :return: the kernel
+    """
+    try:
+        if key in _SPECTRAL_KERNELS:
+            _SPECTRAL_KERNELS[key] = kernel = _SPECTRAL_KERNELS.pop(key)
+            return kernel
+    except TypeError:  # unhashable
+        return create()
+    kernel = create()
+    if isinstance(kernel, np.ndarray):
+        kernel.flags.writeable = False
+        _SPECTRAL_KERNELS[key] = kernel
+        while len(_SPECTRAL_KERNELS) > SPECTRAL_KERNEL_CACHE_SIZE:
+            _SPECTRAL_KERNELS.popitem(last=False)
+    return kernel
+
+
+def fftfreq(resolution, mode='vector', dtype=np.float32, real=False):
+    """
+    Returns the frequencies of math.fft() or math.rfft() for every cell of a grid.
+    Results are cached, see spectral_kernel(), and must not be modified.
+
+    :param resolution: list of cell counts along each spatial dimension
+    :param mode: 'vector' for the frequency vectors, 'absolute' for their length or 'square' for their squared length
+    :param dtype: NumPy data type
+    :param real: if True, only the non-negative frequencies of the last dimension are returned, matching math.rfft()
+    :return: array of shape (1, resolution..., d) for mode='vector' and (1, resolution..., 1) otherwise where the last dimension has length n//2+1 if real
+    """
     assert mode in ('vector', 'absolute', 'square')
-    k = np.meshgrid(*[np.fft.fftfreq(int(n)) for n in resolution], indexing='ij')
-    k = math.expand_dims(math.stack(k, -1), 0)
-    k = k.astype(dtype)
-    if mode == 'vector':
-        return k
-    k = math.sum(k ** 2, axis=-1, keepdims=True)
-    if mode == 'square':
-        return k
-    else:
-        return math.sqrt(k)
+    resolution = tuple(int(n) for n in resolution)
+
+    def create():
+        frequencies = [np.fft.fftfreq(n) for n in resolution[:-1]] + [(np.fft.rfftfreq if real else np.fft.fftfreq)(resolution[-1])]
+        k = np.meshgrid(*frequencies, indexing='ij')
+        k = np.expand_dims(np.stack(k, -1), 0).astype(dtype)
+        if mode == 'vector':
+            return k
+        k = np.sum(k ** 2, axis=-1, keepdims=True)
+        return k if mode == 'square' else np.sqrt(k)
+    return spectral_kernel(('fftfreq', resolution, mode, np.dtype(dtype).str, real), create)
 
 
 # Downsample / Upsample
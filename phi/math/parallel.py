@@ -0,0 +1,112 @@
+import multiprocessing
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+def default_worker_count():
+    """
+    Returns the number of CPU cores available to this process.
+    """
+    try:
+        return max(len(os.sched_getaffinity(0)), 1)
+    except AttributeError:  # Python 2 or platforms without sched_getaffinity
+        return max(multiprocessing.cpu_count(), 1)
+
+
+class BatchThreadPool(object):
+
+    def __init__(self, workers=None, min_batch_size=2):
+        """
+        Evaluates a function independently for each example of a batch using a pool of threads.
+
+        This pays off for functions that release the GIL, such as SciPy's sparse matrix products, SuperLU solves or FFTs.
+        Each example is computed by exactly one call and results are returned in batch order,
+        so the output is identical to sequential evaluation.
+
+        The threads are created lazily on first use and shared by all calls.
+
+        :param workers: maximum number of threads, None to use all available cores. 1 disables threading.
+        :param min_batch_size: batches smaller than this are evaluated sequentially in the calling thread
+        """
+        assert workers is None or workers >= 1, 'invalid workers: %s' % workers
+        self._workers = workers
+        self.min_batch_size = min_batch_size
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def workers(self):
+        return self._workers if self._workers is not None else default_worker_count()
+
+    @workers.setter
+    def workers(self, workers):
+        assert workers is None or workers >= 1, 'invalid workers: %s' % workers
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+            self._workers = workers
+
+    def map(self, function, batch_size):
+        """
+        Evaluates function(i) for i in range(batch_size).
+
+        :param function: function taking the example index
+        :param batch_size: number of examples
+        :return: list of results in batch order
+        """
+        workers = min(self.workers, batch_size)
+        # nested batch evaluations run sequentially instead of waiting on their own pool
+        if workers <= 1 or batch_size < self.min_batch_size or getattr(_THREAD_STATE, 'in_pool', False):
+            return [function(i) for i in range(batch_size)]
+        return self._get_pool().map(_mark_pool_thread(function), range(batch_size), chunksize=1)
+
+    def map_slices(self, function, size, min_size=1):
+        """
+        Splits range(size) into at most one contiguous slice per worker and evaluates function(slice) for each of them.
+        This is used to split a single large operation along its batch or spatial axis, see SciPyBackend.
+
+        :param function: function taking a slice object
+        :param size: length of the axis to split
+        :param min_size: minimum length of each slice
+        :return: list of results in slice order
+        """
+        chunks = max(1, min(self.workers, size // max(min_size, 1)))
+        bounds = [size * i // chunks for i in range(chunks + 1)]
+        slices = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        if chunks == 1:
+            return [function(slices[0])]
+        return self.map(lambda i: function(slices[i]), chunks)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+
+    def __repr__(self):
+        return 'BatchThreadPool(workers=%d)' % self.workers
+
+
+def _mark_pool_thread(function):
+    def run(i):
+        _THREAD_STATE.in_pool = True  # pool threads only ever evaluate batch functions
+        return function(i)
+    return run
+
+
+_THREAD_STATE = threading.local()
+
+
+BATCH_THREAD_POOL = BatchThreadPool()
+
+
+def set_num_threads(workers):
+    """
+    Sets the number of threads used by the SciPy backend and solvers to process batches, see BATCH_THREAD_POOL.
+    This also sets the number of workers of SciPy's FFTs.
+
+    :param workers: number of threads, None to use all available cores. 1 disables threading.
+    """
+    BATCH_THREAD_POOL.workers = workers
@@ -1,4 +1,6 @@
 import collections
+import functools
+import itertools
 import numbers
 import warnings
 
@@ -6,15 +8,64 @@ import numpy as np
 import scipy.signal
 import scipy.sparse
 import six
+try:
+    import scipy.fft as fftpack  # single precision transforms, SciPy >= 1.4
+except ImportError:
+    fftpack = np.fft
 from phi.struct.tensorop import collapsed_gather_nd, expand
 
 from .base_backend import Backend
+from .parallel import BATCH_THREAD_POOL
+
+
+STENCIL_MAX_TAPS = 27  # kernels with more non-zero spatial entries are applied using FFTs
+PARALLEL_MIN_SIZE = 64 * 1024  # operations with fewer output elements are not split across threads
 
 
 class SciPyBackend(Backend):
 
-    def __init__(self):
+    def __init__(self, batch_pool=BATCH_THREAD_POOL, buffer_pool=None):
+        """
+        :param batch_pool: BatchThreadPool used to evaluate operations for each example of a batch in parallel or None to evaluate them sequentially
+        :param buffer_pool: (optional) BufferPool providing the result arrays of pad, add, sub, mul, div, resample, conv, concat and stack.
+            Enables reusing the arrays of previous simulation steps instead of allocating new ones.
+        """
         Backend.__init__(self, "SciPy")
+        self.batch_pool = batch_pool
+        self.buffer_pool = buffer_pool
+
+    def _allocate(self, shape, dtype, out=None):
+        """ Returns out if given, else an uninitialized array from the buffer pool or a new one. """
+        if out is not None:
+            assert out.shape == tuple(shape), 'out must have shape %s but has shape %s' % (tuple(shape), out.shape)
+            return out
+        if self.buffer_pool is not None:
+            return self.buffer_pool.allocate(shape, dtype)
+        return np.empty(shape, dtype)
+
+    def _is_parallel(self, elements):
+        """ Tests whether an operation producing the given number of elements is split across the threads of the batch pool. """
+        return self.batch_pool is not None and self.batch_pool.workers > 1 and elements >= PARALLEL_MIN_SIZE
+
+    def _map_slices(self, function, size, elements):
+        """ Evaluates function(slice) for contiguous slices covering range(size), in parallel threads if the operation is large enough. """
+        if self._is_parallel(elements):
+            self.batch_pool.map_slices(function, size, min_size=max(1, size * PARALLEL_MIN_SIZE // elements // 2))
+        else:
+            function(slice(0, size))
+
+    def _fft_workers(self):
+        """ Keyword arguments letting scipy.fft use the threads of the batch pool. """
+        if self.batch_pool is None or fftpack is np.fft:
+            return {}
+        return {'workers': self.batch_pool.workers}
+
+    def _binary(self, ufunc, a, b, out):
+        if out is None and self.buffer_pool is not None and (isinstance(a, np.ndarray) or isinstance(b, np.ndarray)):
+            dtype = np.result_type(a, b)
+            if dtype.kind in 'fc':
+                out = self.buffer_pool.allocate(np.broadcast(a, b).shape, dtype)
+        return ufunc(a, b, out=out)
 
     def is_applicable(self, values):
         if values is None:
@@ -68,35 +119,56 @@ class SciPyBackend(Backend):
         return np.tile(value, multiples)
 
     def stack(self, values, axis=0):
+        if self.buffer_pool is not None and len(values) > 0 and all(isinstance(v, np.ndarray) for v in values) and len(set(v.shape for v in values)) == 1:
+            shape = list(values[0].shape)
+            shape.insert(axis if axis >= 0 else len(shape) + 1 + axis, len(values))
+            return np.stack(values, axis, out=self.buffer_pool.allocate(shape, np.result_type(*values)))
         return np.stack(values, axis)
 
     def concat(self, values, axis):
+        if self.buffer_pool is not None and len(values) > 0 and all(isinstance(v, np.ndarray) and v.ndim == values[0].ndim for v in values):
+            shape = list(values[0].shape)
+            shape[axis] = sum(v.shape[axis] for v in values)
+            return np.concatenate(values, axis, out=self.buffer_pool.allocate(shape, np.result_type(*values)))
         return np.concatenate(values, axis)
 
-    def pad(self, value, pad_width, mode='constant', constant_values=0):
+    def pad(self, value, pad_width, mode='constant', constant_values=0, out=None):
         dims = range(len(self.shape(value)))
         constant_values = expand(constant_values, shape=(len(dims), 2))
         if isinstance(mode, six.string_types):
-            return self._single_mode_pad(value, pad_width, mode, constant_values)
+            return self._single_mode_pad(value, pad_width, mode, constant_values, out)
         else:
             mode = expand(mode, shape=(len(dims), 2))
-            for single_mode in ('wrap', 'circular', 'replicate', 'symmetric', 'reflect', 'constant'):  # order matters! circular first
+            passes = [m for m in ('wrap', 'circular', 'replicate', 'symmetric', 'reflect', 'constant') if any(m in modes for modes in mode)]  # order matters! circular first
+            for single_mode in passes:
                 widths = [[collapsed_gather_nd(pad_width, [d, upper]) if mode[d][upper] == single_mode else 0 for upper in (False, True)] for d in dims]
-                value = self._single_mode_pad(value, widths, single_mode, constant_values)
+                value = self._single_mode_pad(value, widths, single_mode, constant_values, out if single_mode == passes[-1] else None)
+            if out is not None and value is not out:
+                out[...] = value
+                return out
             return value
 
-    def _single_mode_pad(self, value, pad_width, single_mode, constant_values=0):
+    def _single_mode_pad(self, value, pad_width, single_mode, constant_values=0, out=None):
+        value = np.asarray(value)
+        pad_width = [[int(lower), int(upper)] for lower, upper in pad_width]
         if np.sum(np.array(pad_width)) == 0:
-            return value
+            if out is None:
+                return value
+            out[...] = value
+            return out
         if single_mode == 'wrap':
             warnings.warn("padding mode 'wrap' is deprecated. Use 'circular' instead.", DeprecationWarning, stacklevel=2)
-        if single_mode.lower() == 'constant':
-            return np.pad(value, pad_width, 'constant', constant_values=constant_values)
-        if single_mode.lower() == 'circular':
-            single_mode = 'wrap'
-        if single_mode.lower() == 'replicate':
-            single_mode = 'edge'
-        return np.pad(value, pad_width, single_mode.lower())
+        single_mode = {'circular': 'wrap', 'replicate': 'edge'}.get(single_mode.lower(), single_mode.lower())
+        if out is None and self.buffer_pool is None:
+            if single_mode == 'constant':
+                return np.pad(value, pad_width, 'constant', constant_values=constant_values)
+            return np.pad(value, pad_width, single_mode)
+        shape = [lower + n + upper for n, (lower, upper) in zip(value.shape, pad_width)]
+        if single_mode == 'constant' or single_mode == 'edge' or (single_mode == 'wrap' and all(max(w) <= n for n, w in zip(value.shape, pad_width))):
+            return pad_into(value, pad_width, single_mode, constant_values, self._allocate(shape, value.dtype, out))
+        result = self._allocate(shape, value.dtype, out)
+        result[...] = np.pad(value, pad_width, single_mode)
+        return result
 
     def reshape(self, value, shape):
         return value.reshape(shape)
@@ -122,16 +194,36 @@ class SciPyBackend(Backend):
         assert result.shape == shape_out, "returned value has wrong shape: {}, expected {}".format(result.shape, shape_out)
         return result
 
-    def resample(self, inputs, sample_coords, interpolation='linear', boundary='constant'):
-        if boundary.lower() == 'zero' or boundary.lower() == 'constant':
-            pass  # default
-        elif boundary.lower() == 'replicate':
-            sample_coords = clamp(sample_coords, inputs.shape[1:-1])
+    def resample(self, inputs, sample_coords, interpolation='linear', boundary='constant', out=None):
+        if boundary.lower() == 'zero':
+            boundary = 'constant'
+        if boundary.lower() not in ('constant', 'replicate', 'circular'):
+            raise ValueError("Unsupported boundary: %s" % boundary)
+        if interpolation.lower() in ('linear', 'nearest'):
+            inputs, sample_coords = np.asarray(inputs), np.asarray(sample_coords)
+            batch_size = max(inputs.shape[0], sample_coords.shape[0])
+            out_shape = (batch_size,) + (sample_coords.shape[1:-1] or (1,)) + inputs.shape[-1:]
+            elements = int(np.prod(out_shape)) * 2 ** sample_coords.shape[-1]
+            if not self._is_parallel(elements) or (batch_size == 1 and sample_coords.ndim < 3):
+                if out is None and self.buffer_pool is None:
+                    return gather_resample(inputs, sample_coords, interpolation.lower(), boundary.lower())
+                return gather_resample(inputs, sample_coords, interpolation.lower(), boundary.lower(), out=out, allocate=self._allocate)
+            result = self._allocate(out_shape, inputs.dtype, out)
+
+            def resample_slice(s):
+                if batch_size > 1:  # split along the batch
+                    gather_resample(inputs[s] if inputs.shape[0] > 1 else inputs, sample_coords[s] if sample_coords.shape[0] > 1 else sample_coords,
+                                    interpolation.lower(), boundary.lower(), out=result[s], allocate=self._allocate)
+                else:  # split along the first sample dimension
+                    gather_resample(inputs, sample_coords[:, s], interpolation.lower(), boundary.lower(), out=result[:, s], allocate=self._allocate)
+            self._map_slices(resample_slice, batch_size if batch_size > 1 else sample_coords.shape[1], elements)
+            return result
+        # other methods, e.g. 'cubic', are only supported by scipy.interpolate.interpn
+        if boundary.lower() == 'replicate':
+            sample_coords = clamp(np.array(sample_coords), inputs.shape[1:-1])
         elif boundary.lower() == 'circular':
             inputs = self.pad(inputs, [[0,0]] + [[0,1]] * tensor_spatial_rank(inputs) + [[0,0]], mode='circular')
             sample_coords = sample_coords % self.to_float(self.staticshape(inputs)[1:-1])
-        else:
-            raise ValueError("Unsupported boundary: %s" % boundary)
 
         import scipy.interpolate
         points = [np.arange(dim) for dim in inputs.shape[1:-1]]
@@ -144,6 +236,9 @@ class SciPyBackend(Backend):
             result.append(np.stack(components, -1))
 
         result = np.stack(result).astype(inputs.dtype)
+        if out is not None:
+            out[...] = result
+            return out
         return result
 
     def zeros_like(self, tensor):
@@ -159,6 +254,17 @@ class SciPyBackend(Backend):
         return np.tensordot(a, b, axes)
 
     def matmul(self, A, b):
+        if np.ndim(b) == 2 and (scipy.sparse.issparse(A) or isinstance(A, np.ndarray)):
+            # one product for the whole batch on the (N, batch) layout. The result is returned in (batch, N) layout again
+            # as NumPy reductions over the examples and broadcasting of per-example scalars are much slower on the transposed layout.
+            if b.shape[0] < 2 or not self._is_parallel(A.shape[0] * b.shape[0]):
+                return np.ascontiguousarray(A.dot(b.T).T)
+            result = np.empty((b.shape[0], A.shape[0]), np.result_type(A.dtype, b.dtype))
+
+            def multiply_slice(s):  # sparse products release the GIL
+                result[s] = A.dot(b[s].T).T
+            self.batch_pool.map_slices(multiply_slice, b.shape[0])
+            return result
         return np.stack([A.dot(b[i]) for i in range(b.shape[0])])
 
     def while_loop(self, cond, body, loop_vars, shape_invariants=None, parallel_iterations=10, back_prop=True,
@@ -207,21 +313,47 @@ class SciPyBackend(Backend):
     def exp(self, x):
         return np.exp(x)
 
-    def conv(self, tensor, kernel, padding="SAME"):
+    def conv(self, tensor, kernel, padding="SAME", out=None):
         assert tensor.shape[-1] == kernel.shape[-2]
-        # kernel = kernel[[slice(None)] + [slice(None, None, -1)] + [slice(None)]*(len(kernel.shape)-3) + [slice(None)]]
-        if padding.lower() == "same":
-            result = np.zeros(tensor.shape[:-1] + (kernel.shape[-1],), np.float32)
-        elif padding.lower() == "valid":
-            valid = [tensor.shape[i + 1] - (kernel.shape[i] + 1) // 2 for i in range(tensor_spatial_rank(tensor))]
-            result = np.zeros([tensor.shape[0]] + valid + [kernel.shape[-1]], np.float32)
-        else:
+        if padding.lower() not in ("same", "valid"):
             raise ValueError("Illegal padding: %s" % padding)
-        for batch in range(tensor.shape[0]):
-            for o in range(kernel.shape[-1]):
-                for i in range(tensor.shape[-1]):
-                    result[batch, ..., o] += scipy.signal.correlate(tensor[batch, ..., i], kernel[..., i, o], padding.lower())
-        return result
+        kernel = np.asarray(kernel)
+        taps = np.count_nonzero(np.any(kernel != 0, axis=(-2, -1)))
+        if taps <= STENCIL_MAX_TAPS:
+            out_shape = [tensor.shape[0]] + [n if padding.lower() == "same" else n - k + 1 for n, k in zip(tensor.shape[1:-1], kernel.shape[:-2])] + [kernel.shape[-1]]
+            elements = int(np.prod(out_shape)) * taps
+            if out is None and self.buffer_pool is None and not self._is_parallel(elements):
+                return stencil_correlate(tensor, kernel, padding.lower()).astype(np.float32)
+            if padding.lower() == "same":
+                paddings = _correlation_paddings(kernel.shape[:-2], "same")
+                tensor = self.pad(tensor, [(0, 0)] + paddings + [(0, 0)])
+            result = self._allocate(out_shape, np.float32, out)
+            halo = kernel.shape[0] - 1
+
+            def correlate_slice(s):
+                if out_shape[0] > 1:  # split along the batch
+                    stencil_correlate(tensor[s], kernel, "valid", out=result[s], allocate=self._allocate)
+                else:  # split along the first spatial dimension, each slice reads the rows of its neighbours
+                    stencil_correlate(tensor[:, s.start:s.stop + halo], kernel, "valid", out=result[:, s], allocate=self._allocate)
+            self._map_slices(correlate_slice, out_shape[0] if out_shape[0] > 1 else out_shape[1], elements)
+            return result
+        result = fft_correlate(tensor, kernel, padding.lower(), fft_arguments=self._fft_workers())
+        if out is not None:
+            out[...] = result
+            return out
+        return result.astype(np.float32)
+
+    def add(self, a, b, out=None):
+        return self._binary(np.add, a, b, out)
+
+    def sub(self, a, b, out=None):
+        return self._binary(np.subtract, a, b, out)
+
+    def mul(self, a, b, out=None):
+        return self._binary(np.multiply, a, b, out)
+
+    def div(self, numerator, denominator, out=None):
+        return self._binary(np.true_divide, numerator, denominator, out)
 
     def expand_dims(self, a, axis=0, number=1):
         for _i in range(number):
@@ -297,6 +429,8 @@ class SciPyBackend(Backend):
     def fft(self, x):
         rank = len(x.shape) - 2
         assert rank >= 1
+        if fftpack is not np.fft:  # multi-threaded
+            return fftpack.fftn(x, axes=list(range(1, rank + 1)), **self._fft_workers())
         if rank == 1:
             return np.fft.fft(x, axis=1)
         elif rank == 2:
@@ -307,6 +441,8 @@ class SciPyBackend(Backend):
     def ifft(self, k):
         rank = len(k.shape) - 2
         assert rank >= 1
+        if fftpack is not np.fft:
+            return fftpack.ifftn(k, axes=list(range(1, rank + 1)), **self._fft_workers())
         if rank == 1:
             return np.fft.ifft(k, axis=1)
         elif rank == 2:
@@ -314,6 +450,16 @@ class SciPyBackend(Backend):
         else:
             return np.fft.ifftn(k, axes=list(range(1,rank + 1)))
 
+    def rfft(self, x):
+        axes = list(range(1, len(x.shape) - 1))
+        assert len(axes) >= 1
+        return fftpack.rfftn(x, axes=axes, **self._fft_workers())
+
+    def irfft(self, k, resolution):
+        axes = list(range(1, len(k.shape) - 1))
+        assert len(axes) >= 1
+        return fftpack.irfftn(k, [int(n) for n in resolution], axes=axes, **self._fft_workers())
+
     def imag(self, complex):
         return np.imag(complex)
 
@@ -335,6 +481,217 @@ class SciPyBackend(Backend):
         return scipy.sparse.csc_matrix((values, self.unstack(indices, -1)), shape=shape)
 
 
+def pad_into(value, pad_width, mode, constant_values, out):
+    """
+    Pads value into the preallocated array out, see Backend.pad().
+    Results match np.pad, including the corner values which are filled axis by axis.
+
+    :param value: array to pad
+    :param pad_width: list of (lower, upper) for each axis
+    :param mode: 'constant', 'edge' or 'wrap'. With 'wrap', no padding may exceed the size of its axis.
+    :param constant_values: values of mode='constant', list of (lower, upper) for each axis
+    :param out: array with the padded shape
+    :return: out
+    """
+    center = tuple(slice(lower, lower + n) for n, (lower, _) in zip(value.shape, pad_width))
+    out[center] = value
+    for axis, (n, (lower, upper)) in enumerate(zip(value.shape, pad_width)):
+        def region(start, stop):
+            # axes already padded span the full array, later axes only the center
+            return (slice(None),) * axis + (slice(start, stop),) + center[axis + 1:]
+        for is_upper, width in ((False, lower), (True, upper)):
+            if width == 0:
+                continue
+            target = region(lower + n, lower + n + width) if is_upper else region(0, lower)
+            if mode == 'constant':
+                out[target] = collapsed_gather_nd(constant_values, [axis, int(is_upper)])
+            elif mode == 'edge':
+                out[target] = out[region(lower + n - 1, lower + n) if is_upper else region(lower, lower + 1)]
+            elif mode == 'wrap':
+                out[target] = out[region(lower, lower + width) if is_upper else region(lower + n - width, lower + n)]
+            else:
+                raise ValueError("Unsupported mode: %s" % mode)
+    return out
+
+
+def _correlation_paddings(kernel_shape, padding):
+    """ Zero padding (lower, upper) of each spatial dimension reproducing scipy.signal.correlate(mode=padding). """
+    if padding == "valid":
+        return [(0, 0)] * len(kernel_shape)
+    return [(k // 2, k - 1 - k // 2) for k in kernel_shape]
+
+
+def stencil_correlate(tensor, kernel, padding="same", out=None, allocate=None):
+    """
+    Cross-correlation of all examples and channels of tensor with a kernel by summing shifted slices of the tensor.
+    Only the non-zero spatial entries of the kernel are evaluated, each as one matrix product over the channels.
+    This is efficient for small sparse kernels such as finite difference stencils.
+
+    Results match scipy.signal.correlate applied to every example and channel pair.
+
+    :param tensor: array of shape (batch, spatial dimensions..., in channels)
+    :param kernel: array of shape (kernel spatial dimensions..., in channels, out channels)
+    :param padding: 'same' (zero-padded) or 'valid'
+    :param out: (optional) array the result is written to. The sum is accumulated in out, i.e. with its precision.
+    :param allocate: (optional) function (shape, dtype) -> array providing the temporary of each tap, e.g. from a BufferPool
+    :return: array of shape (batch, spatial dimensions..., out channels) where spatial dimensions shrink by kernel size - 1 if padding='valid'
+    """
+    spatial_kernel = kernel.shape[:-2]
+    paddings = _correlation_paddings(spatial_kernel, padding)
+    if padding == "same":
+        tensor = np.pad(tensor, [(0, 0)] + paddings + [(0, 0)], mode="constant")
+    out_shape = [tensor.shape[0]] + [n - k + 1 for n, k in zip(tensor.shape[1:-1], spatial_kernel)] + [kernel.shape[-1]]
+    result = out if out is not None else np.empty(out_shape, np.result_type(tensor, kernel))
+    product = (allocate or np.empty)(out_shape, result.dtype)
+    offsets = list(zip(*np.nonzero(np.any(kernel != 0, axis=(-2, -1)))))
+    if not offsets:
+        result[...] = 0
+    for i, offset in enumerate(offsets):
+        window = tensor[(slice(None),) + tuple(slice(o, o + n) for o, n in zip(offset, out_shape[1:-1]))]
+        target = result if i == 0 else product
+        if kernel.shape[-2] == 1:
+            np.multiply(window, kernel[offset][0], out=target, casting='same_kind')  # broadcast over output channels
+        else:
+            np.matmul(window, kernel[offset].astype(result.dtype, copy=False), out=target)
+        if i > 0:
+            result += product
+    return result
+
+
+KERNEL_SPECTRUM_CACHE_SIZE = 16
+_KERNEL_SPECTRA = collections.OrderedDict()  # (kernel bytes, dtype, kernel shape, FFT shape) -> spectrum of the flipped kernel
+
+
+def _kernel_spectrum(kernel, fft_shape):
+    """ Real FFT of the spatially flipped kernel, cached by content so that kernels rebuilt in every call, e.g. by blur(), are transformed once. The spectrum is read-only. """
+    key = (kernel.tobytes(), kernel.dtype.str, kernel.shape, tuple(fft_shape))
+    if key in _KERNEL_SPECTRA:
+        _KERNEL_SPECTRA[key] = spectrum = _KERNEL_SPECTRA.pop(key)
+        return spectrum
+    rank = kernel.ndim - 2
+    flipped = kernel[(slice(None, None, -1),) * rank]
+    spectrum = fftpack.rfftn(flipped, fft_shape, axes=tuple(range(rank)))
+    spectrum.flags.writeable = False
+    _KERNEL_SPECTRA[key] = spectrum
+    while len(_KERNEL_SPECTRA) > KERNEL_SPECTRUM_CACHE_SIZE:
+        _KERNEL_SPECTRA.popitem(last=False)
+    return spectrum
+
+
+def fft_correlate(tensor, kernel, padding="same", fft_arguments=None):
+    """
+    Cross-correlation of all examples and channels of tensor with a kernel using real FFTs, see stencil_correlate().
+    The cost is independent of the kernel size. The spectrum of the kernel is cached.
+
+    :param tensor: array of shape (batch, spatial dimensions..., in channels)
+    :param kernel: array of shape (kernel spatial dimensions..., in channels, out channels)
+    :param padding: 'same' (zero-padded) or 'valid'
+    :param fft_arguments: (optional) additional keyword arguments of the FFTs of tensor, e.g. workers for scipy.fft
+    :return: array of shape (batch, spatial dimensions..., out channels), see stencil_correlate()
+    """
+    fft_arguments = fft_arguments or {}
+    resolution = tensor.shape[1:-1]
+    spatial_kernel = kernel.shape[:-2]
+    rank = len(resolution)
+    fft_shape = [n + k - 1 for n, k in zip(resolution, spatial_kernel)]  # linear, not circular, convolution
+    if hasattr(fftpack, 'next_fast_len'):
+        fft_shape = [fftpack.next_fast_len(n, real=True) for n in fft_shape]
+    spectrum = fftpack.rfftn(tensor, fft_shape, axes=tuple(range(1, rank + 1)), **fft_arguments)
+    kernel_spectrum = _kernel_spectrum(kernel, fft_shape)
+    if kernel.shape[-2:] == (1, 1):
+        spectrum = spectrum * kernel_spectrum[..., 0, 0][..., None]
+    else:
+        spectrum = np.matmul(spectrum[..., None, :], kernel_spectrum)[..., 0, :]
+    full = fftpack.irfftn(spectrum, fft_shape, axes=tuple(range(1, rank + 1)), **fft_arguments)
+    if padding == "same":
+        crop = [slice(k - 1 - lower, k - 1 - lower + n) for n, k, (lower, _) in zip(resolution, spatial_kernel, _correlation_paddings(spatial_kernel, padding))]
+    else:
+        crop = [slice(k - 1, n) for n, k in zip(resolution, spatial_kernel)]
+    return full[(slice(None),) + tuple(crop)]
+
+
+def gather_resample(inputs, sample_coords, interpolation='linear', boundary='constant', out=None, allocate=None):
+    """
+    Vectorized multi-linear or nearest-neighbour interpolation of a regular grid, see Backend.resample().
+
+    All examples and components are interpolated in one pass.
+    The lower grid index and interpolation weight are computed once per sample point and dimension,
+    then the 2^d corner values of all components are gathered from the flattened grid.
+    Results match scipy.interpolate.interpn with fill_value=0, i.e. with boundary='constant', points outside the grid are zero.
+
+    :param inputs: grid data of shape (batch, spatial dimensions..., components)
+    :param sample_coords: sample points of shape (batch, any spatial shape..., d). The batch dimension of inputs or sample_coords may be 1.
+    :param interpolation: 'linear' or 'nearest'
+    :param boundary: 'constant', 'replicate' or 'circular'
+    :param out: (optional) array the result is written to
+    :param allocate: (optional) function (shape, dtype) -> array providing the result and the gathered values of all corners, e.g. from a BufferPool
+    :return: array of shape (batch, sample spatial shape..., components) with the dtype of inputs
+    """
+    allocate = allocate or (lambda shape, dtype, out=None: out if out is not None else np.empty(shape, dtype))
+    if out is not None and not out.flags.c_contiguous:
+        out[...] = gather_resample(inputs, sample_coords, interpolation, boundary, allocate=allocate)
+        return out
+    inputs = np.asarray(inputs)
+    sample_coords = np.asarray(sample_coords)
+    resolution = inputs.shape[1:-1]
+    assert sample_coords.shape[-1] == len(resolution), 'sample_coords must have %d components but got shape %s' % (len(resolution), sample_coords.shape)
+    batch_size = max(inputs.shape[0], sample_coords.shape[0])
+    assert inputs.shape[0] in (1, batch_size) and sample_coords.shape[0] in (1, batch_size), 'incompatible batch sizes: %s, %s' % (inputs.shape, sample_coords.shape)
+    sample_shape = sample_coords.shape[1:-1] or (1,)  # like interpn, a single point per example yields one value
+    coords = np.broadcast_to(sample_coords, (batch_size,) + sample_coords.shape[1:]).reshape([batch_size, -1, len(resolution)])
+    strides = [int(np.prod(resolution[dim + 1:])) for dim in range(len(resolution))]
+    # offsets of each example in the flattened grid
+    base = (np.arange(batch_size) * int(np.prod(resolution)) if inputs.shape[0] > 1 else np.zeros(batch_size, np.intp)).reshape([-1, 1])
+    flat_inputs = inputs.reshape([-1, inputs.shape[-1]])
+    valid = None
+    corners = []  # for each dimension: list of (index * stride, weight or None)
+    for dim, (size, stride) in enumerate(zip(resolution, strides)):
+        x = coords[..., dim]
+        if boundary == 'circular':
+            x = x % size
+        elif boundary == 'constant':
+            in_range = (x >= 0) & (x <= size - 1)
+            valid = in_range if valid is None else valid & in_range
+        if boundary != 'circular':
+            x = np.clip(x, 0, size - 1)
+        lower = np.floor(x)
+        if boundary != 'circular':
+            lower = np.minimum(lower, max(size - 2, 0))  # the last grid point is reached with weight 1
+        weight = x - lower
+        lower = lower.astype(np.intp) % size  # x % size can round up to size
+        upper = (lower + 1) % size if boundary == 'circular' else np.minimum(lower + 1, size - 1)
+        if interpolation == 'nearest':
+            corners.append([(np.where(weight > 0.5, upper, lower) * stride, None)])
+        else:
+            corners.append([(lower * stride, 1 - weight), (upper * stride, weight)])
+    out_shape = (batch_size,) + sample_shape + inputs.shape[-1:]
+    flat_shape = (batch_size, coords.shape[1], inputs.shape[-1])
+    dtype = np.result_type(inputs, coords) if interpolation == 'linear' else inputs.dtype  # precision of the weighted sum
+    if dtype == inputs.dtype:
+        final = allocate(out_shape, dtype, out)
+        result = final.reshape(flat_shape)
+    else:
+        result = allocate(flat_shape, dtype)
+    values = allocate(flat_shape, inputs.dtype)
+    weighted = allocate(flat_shape, dtype) if interpolation == 'linear' else None
+    for i, corner in enumerate(itertools.product(*corners)):
+        index = base + sum(offset for offset, _ in corner)
+        weights = [w for _, w in corner if w is not None]
+        if not weights:
+            np.take(flat_inputs, index, axis=0, mode='clip', out=result)
+            continue
+        np.take(flat_inputs, index, axis=0, mode='clip', out=values)  # NaN coordinates yield invalid indices
+        np.multiply(values, functools.reduce(np.multiply, weights)[..., None], out=result if i == 0 else weighted)
+        if i > 0:
+            result += weighted
+    if valid is not None:
+        result *= valid[..., None]
+    if dtype != inputs.dtype:
+        final = allocate(out_shape, inputs.dtype, out)
+        final.reshape(flat_shape)[...] = result
+    return final
+
+
 def clamp(coordinates, shape):
     assert coordinates.shape[-1] == len(shape)
     for i in range(len(shape)):
@@ -12,13 +12,18 @@ from .grid import CenteredGrid
 def diffuse(field, amount, substeps=1):
     assert isinstance(field, CenteredGrid)
     if field.extrapolation == 'periodic':
-        frequencies = math.fft(field.data)
-        k = math.fftfreq(field.resolution) / field.dx
-        k = math.sum(k ** 2, axis=-1, keepdims=True)
-        fft_laplace = -(2 * pi) ** 2 * k
-        diffuse_kernel = math.to_complex(math.exp(fft_laplace * amount))
-        data = math.ifft(frequencies * diffuse_kernel)
-        data = math.real(data)
+        real = math.use_real_fft(field.data)
+
+        def diffuse_kernel():
+            k = math.fftfreq(field.resolution, real=real) / field.dx
+            k = math.sum(k ** 2, axis=-1, keepdims=True)
+            fft_laplace = -(2 * pi) ** 2 * k
+            return math.to_complex(math.exp(fft_laplace * amount))
+        kernel = math.spectral_kernel(('diffuse', tuple(int(n) for n in field.resolution), tuple(np.reshape(field.dx, [-1]).tolist()), amount, real), diffuse_kernel)
+        if real:
+            data = math.irfft(math.rfft(field.data) * kernel, field.resolution)
+        else:
+            data = math.real(math.ifft(math.fft(field.data) * kernel))
     else:
         data = field.data
         for i in range(substeps):
@@ -1,6 +1,7 @@
 """
 Definition of Fluid, IncompressibleFlow as well as fluid-related functions.
 """
+import time
 from numbers import Number
 
 import numpy as np
@@ -11,6 +12,8 @@ from .field import CenteredGrid, StaggeredGrid, advect, union_mask
 from .field.effect import Gravity, effect_applied, gravity_tensor
 from .material import OPEN, Material
 from .physics import Physics, StateDependency
+from .pressuresolver.cache import mask_key
+from .pressuresolver.metrics import solve_converged
 from .pressuresolver.solver_api import FluidDomain
 from .pressuresolver.sparse import SparseCG
 
@@ -59,9 +62,26 @@ class IncompressibleFlow(Physics):
 Physics modelling the incompressible Navier-Stokes equations.
 Supports buoyancy proportional to the marker density.
 Supports obstacles, density effects, velocity effects, global gravity.
+
+With warm_start=True, the pressure of the previous step is used as initial guess for the pressure solve of the same fluid.
+With extrapolate_pressure=True, the guess is linearly extrapolated from the previous two pressures instead.
+Guesses are discarded if the resolution or batch size changes, and are only kept for NumPy pressures.
+If the active cells change, e.g. because an obstacle moved, the guess is re-masked and not extrapolated.
+If the cell size changes, the guess is rescaled so that pressure / dx, the unknown of the solver, is kept.
+
+With an accuracy_schedule (see AccuracySchedule), the accuracy of the pressure solver is adapted in every step
+based on the CFL number of the velocity and the iteration count of the previous solve of the same fluid.
+
+With metrics (see SolveMetrics), the solve_info of every pressure solve is recorded under the name of the fluid.
+The solve_info then also holds the remaining divergence and convergence of each solve, see divergence_free(diagnostics=True).
+Without metrics, these diagnostics are skipped as they cost an additional divergence evaluation per step.
+
+If the density and velocity are stored in NumPy arrays, the SciPy backend is pinned for the whole step (see math.use_backend()),
+so obstacles and effects must not introduce tensors of other backends.
     """
 
-    def __init__(self, pressure_solver=None, make_input_divfree=False, make_output_divfree=True, conserve_density=True):
+    def __init__(self, pressure_solver=None, make_input_divfree=False, make_output_divfree=True, conserve_density=True, warm_start=False, extrapolate_pressure=False,
+                 accuracy_schedule=None, metrics=None):
         Physics.__init__(self, [StateDependency('obstacles', 'obstacle'),
                                 StateDependency('gravity', 'gravity', single_state=True),
                                 StateDependency('density_effects', 'density_effect', blocking=True),
@@ -70,14 +90,26 @@ Supports obstacles, density effects, velocity effects, global gravity.
         self.make_input_divfree = make_input_divfree
         self.make_output_divfree = make_output_divfree
         self.conserve_density = conserve_density
+        self.warm_start = warm_start or extrapolate_pressure
+        self.extrapolate_pressure = extrapolate_pressure
+        self._pressure_history = {}  # fluid name -> list of (pressure, active mask key, dt, dx) of the last two solves
+        self.accuracy_schedule = accuracy_schedule
+        self.metrics = metrics
 
     def step(self, fluid, dt=1.0, obstacles=(), gravity=Gravity(), density_effects=(), velocity_effects=()):
         # pylint: disable-msg = arguments-differ
+        with math.use_backend('SciPy' if _is_numpy_state(fluid) else None):  # skips backend dispatch for NumPy simulations
+            return self._step(fluid, dt, obstacles, gravity, density_effects, velocity_effects)
+
+    def _step(self, fluid, dt, obstacles, gravity, density_effects, velocity_effects):
         gravity = gravity_tensor(gravity, fluid.rank)
         velocity = fluid.velocity
         density = fluid.density
         if self.make_input_divfree:
-            velocity, fluid.solve_info = divergence_free(velocity, fluid.domain, obstacles, pressure_solver=self.pressure_solver, return_info=True)
+            velocity, fluid.solve_info = divergence_free(velocity, fluid.domain, obstacles, pressure_solver=self.pressure_solver, return_info=True,
+                                                         diagnostics=self.metrics is not None)
+            if self.metrics is not None:
+                self.metrics.record(fluid.name, fluid.solve_info)
         # --- Advection ---
         density = advect.semi_lagrangian(density, velocity, dt=dt)
         velocity = advect.semi_lagrangian(velocity, velocity, dt=dt)
@@ -91,9 +123,49 @@ Supports obstacles, density effects, velocity effects, global gravity.
         velocity += buoyancy(fluid.density, gravity, fluid.buoyancy_factor) * dt
         # --- Pressure solve ---
         if self.make_output_divfree:
-            velocity, fluid.solve_info = divergence_free(velocity, fluid.domain, obstacles, pressure_solver=self.pressure_solver, return_info=True)
+            fluiddomain = fluid_domain(velocity, fluid.domain, obstacles)
+            pressure_guess = self._pressure_guess(fluid.name, dt, fluiddomain, velocity.dx[0]) if self.warm_start else None
+            pressure_solver = self.pressure_solver
+            if self.accuracy_schedule is not None:
+                pressure_solver = self.accuracy_schedule.scheduled_solver(pressure_solver or SparseCG(), fluid.name, cfl_number(velocity, dt))
+            velocity, fluid.solve_info = divergence_free(velocity, fluiddomain, pressure_solver=pressure_solver, return_info=True, pressure_guess=pressure_guess,
+                                                         diagnostics=self.metrics is not None)
+            if self.warm_start:
+                self._remember_pressure(fluid.name, fluid.solve_info, dt, velocity.dx[0])
+            if self.accuracy_schedule is not None:
+                fluid.solve_info['accuracy'] = getattr(pressure_solver, 'accuracy', None)
+                self.accuracy_schedule.update(fluid.name, fluid.solve_info['iterations'])
+            if self.metrics is not None:
+                self.metrics.record(fluid.name, fluid.solve_info)
         return fluid.copied_with(density=density, velocity=velocity, age=fluid.age + dt)
 
+    def _pressure_guess(self, name, dt, fluiddomain, dx):
+        history = self._pressure_history.get(name, ())
+        if not history:
+            return None
+        pressure, key, last_dt, last_dx = history[-1]
+        if pressure.shape[1:-1] != tuple(fluiddomain.domain.resolution):
+            return None
+        pressure = pressure * (dx / last_dx)  # the solver works on pressure / dx which does not depend on the cell size
+        current_key = mask_key(fluiddomain.domain.resolution, fluiddomain.active.data)
+        if key is None or key != current_key:  # the active cells changed, e.g. a moving obstacle
+            return pressure * fluiddomain.active.data
+        if self.extrapolate_pressure and len(history) == 2:
+            previous, previous_key, _, previous_dx = history[0]
+            if key == previous_key and previous.shape == pressure.shape:
+                return pressure + (pressure - previous * (dx / previous_dx)) * (dt / last_dt)
+        return pressure
+
+    def _remember_pressure(self, name, solve_info, dt, dx):
+        pressure = solve_info['pressure'].data
+        if not isinstance(pressure, np.ndarray):
+            self._pressure_history.pop(name, None)
+            return
+        fluiddomain = solve_info['fluiddomain']
+        key = mask_key(fluiddomain.domain.resolution, fluiddomain.active.data)
+        history = self._pressure_history.get(name, [])[-1:]
+        self._pressure_history[name] = history + [(pressure, key, dt, dx)]
+
 
 INCOMPRESSIBLE_FLOW = IncompressibleFlow()
 
@@ -112,6 +184,24 @@ Computes the buoyancy force proportional to the density.
     return result
 
 
+def cfl_number(velocity, dt):
+    """
+Computes the CFL number max(|v_i| dt / dx_i) of a staggered velocity field.
+    :param velocity: StaggeredGrid
+    :param dt: time increment
+    :return: CFL number as float or None if the velocity is not stored in NumPy arrays
+    """
+    components = velocity.unstack()
+    if not all(isinstance(component.data, np.ndarray) for component in components):
+        return None
+    return float(max(np.max(np.abs(component.data)) * dt / dx for component, dx in zip(components, velocity.dx)))
+
+
+def _is_numpy_state(fluid):
+    """ Tests whether the density and all velocity components of the fluid are stored in NumPy arrays. """
+    return isinstance(fluid.density.data, np.ndarray) and all(isinstance(component.data, np.ndarray) for component in fluid.velocity.unstack())
+
+
 def _is_div_free(velocity, is_div_free):
     assert is_div_free in (True, False, None)
     if isinstance(is_div_free, bool):
@@ -121,36 +211,35 @@ def _is_div_free(velocity, is_div_free):
     return False
 
 
-def solve_pressure(divergence, fluiddomain, pressure_solver=None):
+def solve_pressure(divergence, fluiddomain, pressure_solver=None, pressure_guess=None):
     """
     Computes the pressure from the given velocity or velocity divergence using the specified solver.
     :param divergence: CenteredGrid
     :param fluiddomain: FluidDomain instance
     :param pressure_solver: PressureSolver to use, None for default
+    :param pressure_guess: (optional) initial guess for the pressure tensor, ignored if the solver does not support guesses
     :return: pressure field, iteration count
     :rtype: CenteredGrid, int
     """
     assert isinstance(divergence, CenteredGrid)
     if pressure_solver is None:
         pressure_solver = SparseCG()
-    pressure, iteration = pressure_solver.solve(divergence.data, fluiddomain, pressure_guess=None)
+    if not pressure_solver.supports_guess:
+        pressure_guess = None
+    pressure, iteration = pressure_solver.solve(divergence.data, fluiddomain, pressure_guess=pressure_guess)
     if isinstance(divergence, CenteredGrid):
         pressure = CenteredGrid(pressure, divergence.box, name='pressure')
     return pressure, iteration
 
 
-def divergence_free(velocity, domain=None, obstacles=(), pressure_solver=None, return_info=False):
+def fluid_domain(velocity, domain=None, obstacles=()):
     """
-Projects the given velocity field by solving for and subtracting the pressure.
-    :param return_info: if True, returns a dict holding information about the solve as a second object
+Determines the active and accessible cells of the pressure solve.
     :param velocity: StaggeredGrid
-    :param domain: Domain matching the velocity field, used for boundary conditions
+    :param domain: Domain matching the velocity field, used for boundary conditions. Defaults to open boundaries.
     :param obstacles: list of Obstacles
-    :param pressure_solver: PressureSolver. Uses default solver if none provided.
-    :return: divergence-free velocity as StaggeredGrid
+    :return: FluidDomain
     """
-    assert isinstance(velocity, StaggeredGrid)
-    # --- Set up FluidDomain ---
     if domain is None:
         domain = Domain(velocity.resolution, OPEN)
     obstacle_mask = union_mask([obstacle.geometry for obstacle in obstacles])
@@ -160,12 +249,51 @@ Projects the given velocity field by solving for and subtracting the pressure.
     else:
         active_mask = math.ones(domain.centered_shape(name='active', extrapolation='constant'))
     accessible_mask = active_mask.copied_with(extrapolation=Material.accessible_extrapolation_mode(domain.boundaries))
-    fluiddomain = FluidDomain(domain, active=active_mask, accessible=accessible_mask)
+    return FluidDomain(domain, active=active_mask, accessible=accessible_mask)
+
+
+def divergence_free(velocity, domain=None, obstacles=(), pressure_solver=None, return_info=False, pressure_guess=None, diagnostics=False):
+    """
+Projects the given velocity field by solving for and subtracting the pressure.
+    :param return_info: if True, returns a dict holding information about the solve as a second object, including PressureSolver.solve_info.
+        In addition, the dict holds the wall time of the solve.
+    :param diagnostics: if True and return_info is set, the dict also holds the largest remaining divergence of active cells (in the units of the solver)
+        and whether the solver converged, see solve_converged(). Measuring the divergence costs an additional divergence evaluation.
+    :param pressure_guess: (optional) pressure CenteredGrid or tensor in the units of the returned pressure, used as initial guess. Ignored if its shape does not match.
+    :param velocity: StaggeredGrid
+    :param domain: Domain matching the velocity field, used for boundary conditions, or FluidDomain as returned by fluid_domain()
+    :param obstacles: list of Obstacles, must be empty if domain is a FluidDomain
+    :param pressure_solver: PressureSolver. Uses default solver if none provided.
+    :return: divergence-free velocity as StaggeredGrid
+    """
+    assert isinstance(velocity, StaggeredGrid)
+    if isinstance(domain, FluidDomain):
+        assert not obstacles, 'obstacles must be part of the FluidDomain'
+        fluiddomain = domain
+    else:
+        fluiddomain = fluid_domain(velocity, domain, obstacles)
     # --- Boundary Conditions, Pressure Solve ---
+    if pressure_solver is None:
+        pressure_solver = SparseCG()
     velocity = fluiddomain.with_hard_boundary_conditions(velocity)
     divergence_field = velocity.divergence(physical_units=False)
-    pressure, iterations = solve_pressure(divergence_field, fluiddomain, pressure_solver=pressure_solver)
+    if isinstance(pressure_guess, CenteredGrid):
+        pressure_guess = pressure_guess.data
+    if pressure_guess is not None and tuple(math.staticshape(pressure_guess)) == tuple(math.staticshape(divergence_field.data)):
+        pressure_guess = pressure_guess / velocity.dx[0] * fluiddomain.active.data  # the pressure of inactive cells is zero
+    else:
+        pressure_guess = None
+    solve_start = time.time()
+    pressure, iterations = solve_pressure(divergence_field, fluiddomain, pressure_solver=pressure_solver, pressure_guess=pressure_guess)
+    wall_time = time.time() - solve_start
     pressure *= velocity.dx[0]
     gradp = StaggeredGrid.gradient(pressure)
     velocity -= fluiddomain.with_hard_boundary_conditions(gradp)
-    return velocity if not return_info else (velocity, {'pressure': pressure, 'iterations': iterations})
+    if not return_info:
+        return velocity
+    info = dict(getattr(pressure_solver, 'solve_info', {}))  # subclasses may not call PressureSolver.__init__
+    info.update({'pressure': pressure, 'iterations': iterations, 'fluiddomain': fluiddomain, 'wall_time': wall_time})
+    if diagnostics:
+        remaining_divergence = math.max(math.abs(velocity.divergence(physical_units=False).data * fluiddomain.active.data))
+        info.update({'divergence': remaining_divergence, 'converged': solve_converged(pressure_solver, iterations)})
+    return velocity, info
@@ -0,0 +1,388 @@
+import time
+from numbers import Number
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
+
+from phi import math
+from .cache import OperatorCache, mask_key
+from .preconditioner import Preconditioner
+from .solver_api import PressureSolver, FluidDomain
+from .sparse import cached_pressure_matrix
+
+
+AMG_CACHE = OperatorCache(max_bytes=512 * 1024 ** 2, name='algebraic multigrid hierarchy')
+
+
+class AMGSolver(PressureSolver):
+
+    def __init__(self, accuracy=1e-5, max_cycles=100, cycle='V', smoothing_steps=2, theta=0., max_coarse=256, max_levels=12,
+                 gradient_accuracy='same', cache=AMG_CACHE):
+        """
+        Smoothed aggregation algebraic multigrid solver.
+
+        The hierarchy is built from the sparse pressure matrix (see sparse_pressure_matrix()) instead of downsampled masks.
+        Cells are grouped into aggregates of strongly connected neighbours which never cross obstacles,
+        making the cycle count largely independent of the obstacle geometry, e.g. for thin walls, mazes or fractional masks.
+        Hierarchies are cached per mask.
+
+        Only supported by the SciPy backend or through math.py_func.
+
+        :param accuracy: the maximally allowed error on the divergence channel for each cell
+        :param max_cycles: maximum number of cycles
+        :param cycle: 'V' or 'W'
+        :param smoothing_steps: number of weighted Jacobi sweeps before and after each coarse-grid correction
+        :param theta: strength of connection threshold, see amg_hierarchy()
+        :param max_coarse: the coarsening stops once a level has at most this many unknowns. The coarsest level is solved directly.
+        :param max_levels: maximum number of levels including the finest one
+        :param gradient_accuracy: accuracy applied during backpropagation, number of 'same' to use forward accuracy
+        :param cache: OperatorCache storing hierarchies per mask or None
+        """
+        PressureSolver.__init__(self, 'Algebraic multigrid %s-cycle' % cycle,
+                                supported_devices=('CPU',),
+                                supports_guess=True, supports_loop_counter=True, supports_continuous_masks=True)
+        assert isinstance(accuracy, Number), 'invalid accuracy: %s' % accuracy
+        assert cycle in ('V', 'W'), 'invalid cycle: %s' % cycle
+        assert gradient_accuracy == 'same' or isinstance(gradient_accuracy, Number), 'invalid gradient_accuracy: %s' % gradient_accuracy
+        self.accuracy = accuracy
+        self.gradient_accuracy = accuracy if gradient_accuracy == 'same' else gradient_accuracy
+        self.max_cycles = max_cycles
+        self.cycle = cycle
+        self.smoothing_steps = smoothing_steps
+        self.theta = theta
+        self.max_coarse = max_coarse
+        self.max_levels = max_levels
+        self.cache = cache
+
+    def solve(self, divergence, domain, pressure_guess):
+        assert isinstance(domain, FluidDomain)
+        setup_start = time.time()
+        hierarchy = cached_amg_hierarchy(domain, self.theta, self.max_coarse, self.max_levels, self.cache)
+        self.solve_info = {'setup_time': time.time() - setup_start, 'levels': len(hierarchy)}
+        cycles = [0]
+
+        def np_solve(div, guess=None, accuracy=self.accuracy):
+            pressure, cycles[0] = amg_solve(hierarchy, div, guess, accuracy, self.max_cycles, self.cycle, self.smoothing_steps)
+            return pressure.astype(np.float32)
+
+        inputs = [divergence] if pressure_guess is None else [divergence, pressure_guess]
+
+        def np_solve_gradient(op, grad_in):  # the pressure matrix is symmetric, the guess does not influence the converged result
+            gradient = math.py_func(lambda grad: np_solve(grad, accuracy=self.gradient_accuracy), [grad_in], np.float32, divergence.shape)
+            return [gradient] + [None] * (len(inputs) - 1)
+
+        solve_start = time.time()
+        pressure = math.py_func(np_solve, inputs, np.float32, divergence.shape, grad=np_solve_gradient)
+        self.solve_info['solve_time'] = time.time() - solve_start
+        return pressure, cycles[0] if isinstance(pressure, np.ndarray) else None
+
+
+class AMGPreconditioner(Preconditioner):
+
+    def __init__(self, cycle='V', smoothing_steps=1, theta=0., max_coarse=256, max_levels=12, cache=AMG_CACHE):
+        """
+        Applies one smoothed aggregation multigrid cycle to the residual.
+        The cycle is a fixed symmetric linear operator as required by preconditioned conjugate gradient.
+        Only supported by the SciPy backend.
+
+        See AMGSolver for a description of the parameters.
+        """
+        Preconditioner.__init__(self, 'Algebraic multigrid %s-cycle' % cycle)
+        self.cycle = cycle
+        self.smoothing_steps = smoothing_steps
+        self.theta = theta
+        self.max_coarse = max_coarse
+        self.max_levels = max_levels
+        self.cache = cache
+
+    def bind(self, domain, matrix=None):
+        hierarchy = cached_amg_hierarchy(domain, self.theta, self.max_coarse, self.max_levels, self.cache, matrix)
+
+        def apply(residual):
+            assert isinstance(residual, np.ndarray), 'AMGPreconditioner only supports NumPy arrays'
+            rhs = residual.reshape([residual.shape[0], -1]).T.astype(np.float64)
+            return amg_cycle(hierarchy, rhs, None, self.cycle, self.smoothing_steps).T.reshape(residual.shape).astype(residual.dtype)
+        return apply
+
+
+class AMGLevel(object):
+
+    def __init__(self, matrix, prolongation=None):
+        """
+        Holds the operator of one algebraic multigrid level and the prolongation from the next coarser level.
+
+        :param matrix: SciPy CSR matrix of this level
+        :param prolongation: SciPy CSR matrix mapping coarse unknowns to the unknowns of this level, None for the coarsest level
+        """
+        self.matrix = matrix
+        self.prolongation = prolongation
+        self.restriction = prolongation.T.tocsr() if prolongation is not None else None
+        diagonal = matrix.diagonal()
+        self.inverse_diagonal = np.where(diagonal != 0, 1. / np.where(diagonal != 0, diagonal, 1), 0)
+        # Gershgorin bound on the spectral radius of D^-1 A
+        row_sums = np.asarray(abs(matrix).sum(axis=1)).reshape(-1)
+        self.spectral_radius = max(float(np.max(row_sums * np.abs(self.inverse_diagonal))), 1.)
+        self.coarse_inverse = None  # dense pseudo-inverse or CoarseFactorization, only on the coarsest level
+
+    @property
+    def size(self):
+        return self.matrix.shape[0]
+
+    @property
+    def nbytes(self):
+        total = _csr_nbytes(self.matrix) + self.inverse_diagonal.nbytes
+        if self.prolongation is not None:
+            total += _csr_nbytes(self.prolongation) + _csr_nbytes(self.restriction)
+        if self.coarse_inverse is not None:
+            total += self.coarse_inverse.nbytes
+        return total
+
+
+class CoarseFactorization(object):
+
+    def __init__(self, matrix, nullspace):
+        """
+        Sparse LU factorization of a coarse operator that is too large for a dense pseudo-inverse.
+
+        Singular blocks, i.e. connected components on which the matrix annihilates the near-nullspace vector, e.g. closed regions,
+        are made regular by fixing the unknown with the largest nullspace entry of each block.
+        The nullspace component is projected out of the right-hand side and the solution,
+        so that dot() agrees with the pseudo-inverse and remains a symmetric linear operator.
+
+        :param matrix: symmetric SciPy sparse matrix
+        :param nullspace: near-nullspace vector of the level, see amg_hierarchy()
+        """
+        matrix = scipy.sparse.csr_matrix(matrix, dtype=np.float64, copy=True)
+        matrix.eliminate_zeros()  # stored zeros would connect otherwise separate components
+        N = matrix.shape[0]
+        component_count, components = scipy.sparse.csgraph.connected_components(matrix, directed=False)
+        scale = np.max(np.abs(matrix.data)) * np.max(np.abs(nullspace)) if matrix.nnz else 1.
+        norms = np.sqrt(np.bincount(components, nullspace ** 2, minlength=component_count))
+        singular = (np.bincount(components, np.abs(matrix.dot(nullspace)), minlength=component_count) <= 1e-10 * scale) & (norms > 0)
+        order = np.lexsort((-np.abs(nullspace), components))  # per component, the unknown with the largest nullspace entry comes first
+        first = order[np.unique(components[order], return_index=True)[1]]
+        self.unknowns = np.setdiff1d(np.arange(N), first[singular[components[first]]])
+        self.factorization = scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(matrix[self.unknowns][:, self.unknowns]))
+        rows = np.nonzero(singular[components])[0]
+        basis_columns = np.cumsum(singular) - 1
+        self.nullspace_basis = scipy.sparse.csr_matrix((nullspace[rows] / norms[components[rows]], (rows, basis_columns[components[rows]])), shape=(N, int(np.sum(singular))))
+
+    def dot(self, rhs):
+        rhs = rhs - self.nullspace_basis.dot(self.nullspace_basis.T.dot(rhs))
+        x = np.zeros_like(rhs)
+        x[self.unknowns] = self.factorization.solve(np.asfortranarray(rhs[self.unknowns]))
+        return x - self.nullspace_basis.dot(self.nullspace_basis.T.dot(x))
+
+    @property
+    def nbytes(self):
+        return (self.factorization.L.nnz + self.factorization.U.nnz) * 12 + self.unknowns.nbytes + _csr_nbytes(self.nullspace_basis)
+
+
+def _csr_nbytes(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def cached_amg_hierarchy(domain, theta=0., max_coarse=256, max_levels=12, cache=AMG_CACHE, matrix=None):
+    """
+    Returns the smoothed aggregation hierarchy of the pressure matrix of the given domain, reusing a cached hierarchy if the masks did not change.
+
+    :param domain: FluidDomain
+    :param cache: OperatorCache or None to always build the hierarchy
+    :param matrix: (optional) pressure matrix already assembled for the domain
+    :return: list of AMGLevel, see amg_hierarchy()
+    """
+    assert isinstance(domain, FluidDomain)
+    dimensions = [int(n) for n in domain.domain.resolution]
+    active_mask = domain.active_tensor(extend=1)
+    fluid_mask = domain.accessible_tensor(extend=1)
+
+    def create():
+        A = matrix if scipy.sparse.issparse(matrix) else cached_pressure_matrix(dimensions, active_mask, fluid_mask)
+        return amg_hierarchy(A, theta, max_coarse, max_levels)
+    if cache is None:
+        return create()
+    key = mask_key(dimensions, active_mask, fluid_mask)
+    return cache.get_or_create(key + (theta, max_coarse, max_levels) if key is not None else None, create,
+                               nbytes=lambda hierarchy: sum(level.nbytes for level in hierarchy))
+
+
+def amg_hierarchy(matrix, theta=0., max_coarse=256, max_levels=12):
+    """
+    Builds a smoothed aggregation multigrid hierarchy for a symmetric matrix such as the pressure matrix.
+
+    On each level, unknowns are grouped into aggregates of strongly connected neighbours (see standard_aggregation()).
+    The tentative prolongation interpolates constant pressure within each aggregate and is smoothed with one weighted Jacobi step.
+    Coarse operators are formed by the Galerkin product R A P with R = P^T.
+    The coarsest operator is inverted with a pseudo-inverse which also handles singular (closed) domains.
+    If coarsening stops early, e.g. because of max_levels, and the coarsest level has more than max_coarse unknowns,
+    it is factorized with a sparse LU decomposition instead, see CoarseFactorization.
+
+    :param matrix: SciPy sparse matrix
+    :param theta: strength of connection threshold. Off-diagonal entries with |a_ij| < theta * sqrt(|a_ii a_jj|) are ignored during aggregation.
+    :param max_coarse: maximum number of unknowns of the coarsest level
+    :param max_levels: maximum number of levels
+    :return: list of AMGLevel, starting with the finest
+    """
+    A = scipy.sparse.csr_matrix(matrix, dtype=np.float64, copy=True)  # the matrix may be shared with other solvers
+    A.eliminate_zeros()
+    hierarchy = []
+    near_nullspace = np.ones(A.shape[0])  # the pressure is determined up to a constant
+    while True:
+        if A.shape[0] <= max_coarse or len(hierarchy) + 1 >= max_levels:
+            break
+        aggregates = standard_aggregation(strength_of_connection(A, theta))
+        aggregate_count = int(np.max(aggregates)) + 1 if np.any(aggregates >= 0) else 0
+        if aggregate_count == 0 or aggregate_count >= A.shape[0]:
+            break
+        level = AMGLevel(A)
+        level.prolongation, near_nullspace = smoothed_prolongation(A, aggregates, aggregate_count, near_nullspace, level.inverse_diagonal, level.spectral_radius)
+        level.restriction = level.prolongation.T.tocsr()
+        hierarchy.append(level)
+        A = (level.restriction * A * level.prolongation).tocsr()
+        A.eliminate_zeros()
+    coarsest = AMGLevel(A)
+    if A.shape[0] <= max_coarse:
+        coarsest.coarse_inverse = np.linalg.pinv(A.toarray(), rcond=1e-10)  # drops the constant mode of singular (closed) domains
+    else:
+        coarsest.coarse_inverse = CoarseFactorization(A, near_nullspace)
+    hierarchy.append(coarsest)
+    return hierarchy
+
+
+def strength_of_connection(matrix, theta=0.):
+    """
+    Returns the strong off-diagonal connections of a CSR matrix as a CSR matrix with unit entries.
+    Entry (i, j) is strong if |a_ij| >= theta * sqrt(|a_ii a_jj|).
+    """
+    coo = matrix.tocoo()
+    diagonal = np.abs(matrix.diagonal())
+    strong = (coo.row != coo.col) & (np.abs(coo.data) >= theta * np.sqrt(diagonal[coo.row] * diagonal[coo.col])) & (coo.data != 0)
+    return scipy.sparse.csr_matrix((np.ones(np.count_nonzero(strong)), (coo.row[strong], coo.col[strong])), shape=matrix.shape)
+
+
+def standard_aggregation(strength, seed=0):
+    """
+    Groups unknowns into aggregates using the strong connections.
+
+    1. Root unknowns whose strong neighbours are all unaggregated form a new aggregate together with these neighbours.
+       Roots are chosen in rounds. In each round, every candidate that comes first within distance two becomes a root,
+       so aggregates of the same round never overlap.
+       Candidates with fewer candidate neighbours come first, which favours roots along walls and keeps aggregates compact. Ties are broken randomly.
+    2. Remaining unknowns join the smallest aggregate of step 1 among their strong neighbours.
+    3. Unknowns still left, only possible for non-symmetric connections, form single-unknown aggregates.
+
+    Unknowns without strong connections, e.g. obstacle cells, are not aggregated and are only treated by the smoother.
+    All steps operate on whole arrays so that large 3D matrices are aggregated without per-unknown Python loops.
+
+    :param strength: CSR matrix of strong connections, see strength_of_connection()
+    :param seed: seed of the random tie-breaking
+    :return: integer array assigning each unknown to an aggregate or -1
+    """
+    strength = scipy.sparse.csr_matrix(strength)
+    N = strength.shape[0]
+    rows = np.repeat(np.arange(N), np.diff(strength.indptr))
+    columns = strength.indices
+    has_neighbours = np.diff(strength.indptr) > 0
+    closed = (strength + scipy.sparse.identity(N, format='csr')).tocsr()  # includes each unknown in its own neighbourhood
+    tie_break = np.random.RandomState(seed).permutation(N)
+    aggregates = -np.ones(N, np.int64)
+    count = 0
+    candidates = has_neighbours.copy()
+    while np.any(candidates):
+        priority = closed.dot(candidates.astype(np.float64)).astype(np.int64) * N + tie_break
+        candidate_priority = np.where(candidates, priority, np.iinfo(np.int64).max)
+        nearest = _row_min(closed, candidate_priority)  # best candidate priority within distance one
+        roots = np.nonzero(candidates & (_row_min(closed, nearest) == priority))[0]
+        root_ids = -np.ones(N, np.int64)
+        root_ids[roots] = np.arange(count, count + len(roots))
+        members = root_ids[rows] >= 0
+        aggregates[roots] = root_ids[roots]
+        aggregates[columns[members]] = root_ids[rows[members]]
+        count += len(roots)
+        aggregated = aggregates >= 0
+        candidates = has_neighbours & ~aggregated & (strength.dot(aggregated.astype(np.float64)) == 0)
+    sizes = np.bincount(aggregates[aggregates >= 0], minlength=count)
+    joining = (aggregates[rows] < 0) & (aggregates[columns] >= 0)
+    joining_rows, joined = rows[joining], aggregates[columns[joining]]
+    order = np.lexsort((sizes[joined], joining_rows))
+    joining_rows, first = np.unique(joining_rows[order], return_index=True)
+    aggregates[joining_rows] = joined[order][first]
+    leftover = np.nonzero(has_neighbours & (aggregates < 0))[0]
+    aggregates[leftover] = np.arange(count, count + len(leftover))
+    return aggregates
+
+
+def _row_min(matrix, values):
+    """ Minimum of values[j] over the stored columns j of each row of a CSR matrix without empty rows. """
+    return np.minimum.reduceat(values[matrix.indices], matrix.indptr[:-1])
+
+
+def smoothed_prolongation(matrix, aggregates, aggregate_count, near_nullspace, inverse_diagonal, spectral_radius):
+    """
+    Builds the tentative prolongation that interpolates the near-nullspace vector exactly on each aggregate
+    and smooths it with one weighted Jacobi step P = (I - 4/3 / rho D^-1 A) T.
+
+    :param near_nullspace: vector that the coarse space must represent, constant on the finest level
+    :return: prolongation as CSR matrix, near-nullspace vector of the coarse level
+    """
+    rows = np.nonzero(aggregates >= 0)[0]
+    columns = aggregates[rows]
+    coarse_nullspace = np.sqrt(np.bincount(columns, near_nullspace[rows] ** 2, minlength=aggregate_count))
+    tentative = scipy.sparse.csr_matrix((near_nullspace[rows] / coarse_nullspace[columns], (rows, columns)), shape=(matrix.shape[0], aggregate_count))
+    omega = 4. / 3 / spectral_radius
+    prolongation = (tentative - omega * scipy.sparse.diags(inverse_diagonal) * matrix * tentative).tocsr()
+    return prolongation, coarse_nullspace
+
+
+def amg_cycle(hierarchy, rhs, x=None, cycle='V', smoothing_steps=2, level=0):
+    """
+    Performs one algebraic multigrid cycle.
+
+    :param hierarchy: list of AMGLevel, see amg_hierarchy()
+    :param rhs: NumPy array of shape (unknowns, batch size)
+    :param x: initial guess of the same shape or None for zero
+    :param cycle: 'V' or 'W'
+    :param smoothing_steps: number of weighted Jacobi sweeps before and after the coarse-grid correction
+    :param level: index of the current level
+    :return: improved solution
+    """
+    current = hierarchy[level]
+    if current.coarse_inverse is not None:
+        return current.coarse_inverse.dot(rhs)
+    omega = 4. / 3 / current.spectral_radius
+    inverse_diagonal = current.inverse_diagonal[:, None]
+    for _ in range(smoothing_steps):
+        x = omega * inverse_diagonal * rhs if x is None else x + omega * inverse_diagonal * (rhs - current.matrix.dot(x))
+    residual = rhs if x is None else rhs - current.matrix.dot(x)
+    coarse_rhs = current.restriction.dot(residual)
+    correction = amg_cycle(hierarchy, coarse_rhs, None, cycle, smoothing_steps, level + 1)
+    if cycle == 'W' and level + 2 < len(hierarchy):
+        correction = amg_cycle(hierarchy, coarse_rhs, correction, cycle, smoothing_steps, level + 1)
+    correction = current.prolongation.dot(correction)
+    x = correction if x is None else x + correction
+    for _ in range(smoothing_steps):
+        x = x + omega * inverse_diagonal * (rhs - current.matrix.dot(x))
+    return x
+
+
+def amg_solve(hierarchy, divergence, guess, accuracy, max_cycles, cycle='V', smoothing_steps=2):
+    """
+    Iterates multigrid cycles until the maximum absolute residual is below accuracy.
+
+    :param hierarchy: list of AMGLevel, see amg_hierarchy()
+    :param divergence: NumPy array of shape (batch size, spatial dimensions..., 1)
+    :param guess: NumPy array like divergence or None
+    :return: float64 pressure of the same shape as divergence, number of cycles
+    """
+    A = hierarchy[0].matrix
+    rhs = divergence.reshape([divergence.shape[0], -1]).T.astype(np.float64)
+    x = guess.reshape(rhs.shape[::-1]).T.astype(np.float64) if guess is not None else np.zeros_like(rhs)
+    residual = rhs - A.dot(x)
+    cycles = 0
+    while cycles < max_cycles and np.max(np.abs(residual)) >= accuracy:
+        x = amg_cycle(hierarchy, rhs, x, cycle, smoothing_steps)
+        residual = rhs - A.dot(x)
+        cycles += 1
+    return x.T.reshape(divergence.shape), cycles
@@ -0,0 +1,140 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse
+
+
+class OperatorCache(object):
+
+    def __init__(self, max_bytes=256 * 1024 ** 2, name='operators'):
+        """
+        Bounded least-recently-used cache for assembled linear operators, factorizations and similar objects
+        that only depend on the simulation resolution and the fluid masks.
+
+        Entries are evicted in least-recently-used order once the total size of all entries exceeds max_bytes.
+        Keys are typically created with mask_key().
+
+        :param max_bytes: memory budget in bytes. Entries larger than the budget are not stored. 0 disables the cache.
+        :param name: name used in the string representation
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._total_bytes = 0
+
+    def get(self, key, default=None):
+        """
+        Looks up an entry and marks it as most recently used.
+        Updates the hit/miss counters unless key is None.
+
+        :param key: key created by mask_key() or None
+        :return: cached value or default
+        """
+        if key is None:
+            return default
+        if key in self._entries:
+            self.hits += 1
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            return entry[0]
+        self.misses += 1
+        return default
+
+    def put(self, key, value, nbytes=None):
+        """
+        Stores an entry, evicting least recently used entries until the memory budget is met.
+
+        :param key: key created by mask_key() or None (no-op)
+        :param value: object to cache
+        :param nbytes: size of value in bytes. If None, the size is estimated with nbytes_of().
+        :return: value
+        """
+        if key is None:
+            return value
+        if nbytes is None:
+            nbytes = nbytes_of(value)
+        if key in self._entries:
+            self._total_bytes -= self._entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return value
+        self._entries[key] = (value, nbytes)
+        self._total_bytes += nbytes
+        while self._total_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self._total_bytes -= evicted_bytes
+        return value
+
+    def get_or_create(self, key, create, nbytes=None):
+        """
+        Returns the cached entry for key or creates, stores and returns a new one.
+
+        :param key: key created by mask_key() or None to bypass the cache
+        :param create: function without arguments that creates the value
+        :param nbytes: (optional) function mapping the created value to its size in bytes
+        """
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.put(key, value, nbytes(value) if nbytes is not None else None)
+        return value
+
+    def clear(self):
+        """ Removes all entries and resets the hit/miss counters. """
+        self._entries.clear()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self):
+        """ Total size of all cached entries in bytes. """
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __repr__(self):
+        return '%s cache: %d entries, %.1f MB / %.1f MB, %d hits, %d misses' % (self.name, len(self), self._total_bytes / 1024. ** 2, self.max_bytes / 1024. ** 2, self.hits, self.misses)
+
+
+def mask_key(dimensions, *masks):
+    """
+    Creates a cache key from the simulation resolution and the content of the given masks.
+
+    Only NumPy masks can be hashed. If any mask is a symbolic tensor (e.g. TensorFlow), None is returned
+    which disables caching for that call.
+
+    :param dimensions: simulation resolution
+    :param masks: NumPy arrays or None
+    :return: hashable key or None
+    """
+    digest = hashlib.sha1()
+    digest.update(np.array(dimensions, np.int64).tobytes())
+    for mask in masks:
+        if mask is None:
+            digest.update(b'none')
+            continue
+        if not isinstance(mask, np.ndarray):
+            return None
+        digest.update(str((mask.shape, mask.dtype.str)).encode())
+        digest.update(np.ascontiguousarray(mask).tobytes())
+    return tuple(int(d) for d in dimensions), digest.hexdigest()
+
+
+def nbytes_of(value):
+    """ Estimates the memory footprint of NumPy arrays, SciPy sparse matrices and tuples/lists thereof. """
+    if value is None:
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if scipy.sparse.issparse(value):
+        return sum(getattr(value, attr).nbytes for attr in ('data', 'indices', 'indptr', 'offsets', 'row', 'col') if isinstance(getattr(value, attr, None), np.ndarray))
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes_of(v) for v in value)
+    return getattr(value, 'nbytes', 0)
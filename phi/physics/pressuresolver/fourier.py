@@ -0,0 +1,155 @@
+import time
+
+import numpy as np
+try:
+    import scipy.fft as fftpack
+except ImportError:  # SciPy < 1.4
+    import scipy.fftpack as fftpack
+
+from phi import math
+from phi.struct.tensorop import collapsed_gather_nd
+from .cache import OperatorCache
+from .solver_api import PressureSolver, FluidDomain
+from .sparse import SparseCG
+
+
+SPECTRAL_CACHE = OperatorCache(max_bytes=64 * 1024 ** 2, name='spectral eigenvalues')
+
+
+class FourierSolver(PressureSolver):
+
+    def __init__(self, fallback=None, cache=SPECTRAL_CACHE):
+        """
+        Direct pressure solver for domains without obstacles.
+
+        Without obstacles, the pressure matrix is diagonal in a spectral basis which depends on the boundary type of each axis:
+        periodic boundaries use the discrete Fourier transform, closed boundaries the discrete cosine transform (DCT-II)
+        and open boundaries the discrete sine transform (DST-I).
+        Both boundaries of an axis must be of the same type.
+        The solve takes O(N log N) operations and requires no iterations.
+
+        For closed and open axes, the transforms diagonalize the same matrix as sparse_pressure_matrix().
+        Periodic axes are solved with the true periodic Laplacian whose stencil wraps around the domain.
+        sparse_pressure_matrix() has no periodic wrap, so on periodic domains the pressure differs from SparseCG and other matrix-based solvers.
+
+        If the domain contains obstacles or mixed boundaries, the solve is delegated to the fallback solver.
+
+        Fully periodic domains are solved with math.fft and support all backends.
+        Other boundary types are transformed with SciPy and require NumPy or math.py_func support.
+
+        For domains without zero-pressure boundaries, the pressure is only determined up to a constant and the solution has zero mean.
+
+        :param fallback: PressureSolver used when the domain is not supported, defaults to SparseCG()
+        :param cache: OperatorCache storing the eigenvalues per resolution and boundary types or None
+        """
+        PressureSolver.__init__(self, 'Fourier',
+                                supported_devices=('CPU', 'GPU'),
+                                supports_guess=False, supports_loop_counter=False, supports_continuous_masks=False)
+        self.fallback = fallback if fallback is not None else SparseCG()
+        self.cache = cache
+
+    def solve(self, divergence, domain, pressure_guess):
+        assert isinstance(domain, FluidDomain)
+        axis_types = spectral_axis_types(domain)
+        if axis_types is None:
+            pressure, iterations = self.fallback.solve(divergence, domain, pressure_guess)
+            self.solve_info = dict(self.fallback.solve_info, fallback=True)
+            return pressure, iterations
+        solve_start = time.time()
+        dimensions = [int(n) for n in domain.domain.resolution]
+        key = (tuple(dimensions), tuple(axis_types))
+        if self.cache is None:
+            inverse_eigenvalues = spectral_inverse_eigenvalues(dimensions, axis_types)
+        else:
+            inverse_eigenvalues = self.cache.get_or_create(key, lambda: spectral_inverse_eigenvalues(dimensions, axis_types))
+        if all(axis_type == 'periodic' for axis_type in axis_types):
+            pressure = math.to_float(math.real(math.ifft(math.fft(math.to_complex(divergence)) * inverse_eigenvalues.astype(np.complex64))))
+        else:
+            def np_solve(div):
+                return spectral_solve(div, inverse_eigenvalues, axis_types).astype(np.float32)
+
+            def np_solve_gradient(op, grad_in):  # the pressure matrix is symmetric
+                return math.py_func(np_solve, [grad_in], np.float32, divergence.shape)
+
+            pressure = math.py_func(np_solve, [divergence], np.float32, divergence.shape, grad=np_solve_gradient)
+        self.solve_info = {'solve_time': time.time() - solve_start, 'fallback': False}
+        return pressure, None
+
+
+def spectral_axis_types(domain):
+    """
+    Determines the spectral basis for each axis of an obstacle-free domain.
+
+    :param domain: FluidDomain
+    :return: list containing 'periodic', 'closed' or 'open' for each axis or None if the pressure matrix is not diagonal in any supported basis
+    """
+    for mask in (domain.active.data, domain.accessible.data):
+        if not isinstance(mask, np.ndarray) or not np.all(mask == 1):
+            return None
+    axis_types = []
+    for axis in range(domain.rank):
+        lower, upper = [collapsed_gather_nd(domain.domain.boundaries, [axis, side]) for side in (0, 1)]
+        if lower != upper:
+            return None
+        if lower.periodic:
+            axis_types.append('periodic')
+        elif lower.solid:
+            axis_types.append('closed')
+        else:
+            axis_types.append('open')
+    return axis_types
+
+
+def spectral_inverse_eigenvalues(dimensions, axis_types):
+    """
+    Computes the inverse eigenvalues of the pressure matrix in the spectral basis given by axis_types.
+    Zero eigenvalues (constant pressure) are mapped to zero.
+
+    :param dimensions: valid simulation dimensions
+    :param axis_types: list containing 'periodic', 'closed' or 'open' for each axis
+    :return: float64 array of shape (1, dimensions..., 1)
+    """
+    eigenvalues = 0
+    for axis, (n, axis_type) in enumerate(zip(dimensions, axis_types)):
+        k = np.arange(n)
+        if axis_type == 'periodic':
+            axis_eigenvalues = 2 * np.cos(2 * np.pi * k / n) - 2
+        elif axis_type == 'closed':
+            axis_eigenvalues = 2 * np.cos(np.pi * k / n) - 2
+        elif axis_type == 'open':
+            axis_eigenvalues = 2 * np.cos(np.pi * (k + 1) / (n + 1)) - 2
+        else:
+            raise ValueError(axis_type)
+        eigenvalues = eigenvalues + axis_eigenvalues.reshape([n if i == axis else 1 for i in range(len(dimensions))])
+    eigenvalues = np.reshape(eigenvalues, [1] + list(dimensions) + [1])
+    with np.errstate(divide='ignore'):
+        inverse = np.where(np.abs(eigenvalues) > 1e-12, 1. / eigenvalues, 0)
+    return inverse
+
+
+def spectral_solve(divergence, inverse_eigenvalues, axis_types):
+    """
+    Solves the pressure equation of an obstacle-free domain by transforming into the spectral basis using SciPy.
+
+    :param divergence: NumPy array of shape (batch size, spatial dimensions..., 1)
+    :param inverse_eigenvalues: see spectral_inverse_eigenvalues()
+    :param axis_types: list containing 'periodic', 'closed' or 'open' for each axis
+    :return: pressure as float64 NumPy array
+    """
+    transformed = np.asarray(divergence, np.float64)
+    for axis, axis_type in enumerate(axis_types):
+        if axis_type == 'closed':
+            transformed = fftpack.dct(transformed, type=2, axis=axis + 1, norm='ortho')
+        elif axis_type == 'open':
+            transformed = fftpack.dst(transformed, type=1, axis=axis + 1, norm='ortho')
+    periodic_axes = tuple([axis + 1 for axis, axis_type in enumerate(axis_types) if axis_type == 'periodic'])
+    if periodic_axes:
+        transformed = np.real(np.fft.ifftn(np.fft.fftn(transformed, axes=periodic_axes) * inverse_eigenvalues, axes=periodic_axes))
+    else:
+        transformed = transformed * inverse_eigenvalues
+    for axis, axis_type in enumerate(axis_types):
+        if axis_type == 'closed':
+            transformed = fftpack.idct(transformed, type=2, axis=axis + 1, norm='ortho')
+        elif axis_type == 'open':
+            transformed = fftpack.idst(transformed, type=1, axis=axis + 1, norm='ortho')
+    return transformed
@@ -1,8 +1,10 @@
+import time
 from numbers import Number
 
 from phi import math
-from phi.math.blas import conjugate_gradient
+from phi.math.blas import conjugate_gradient, RESIDUAL_NORMS
 from phi.physics.field import CenteredGrid
+from .metrics import ResidualHistory
 from .solver_api import PressureSolver, FluidDomain
 
 
@@ -13,13 +15,13 @@ class GeometricCG(PressureSolver):
 
     def __init__(self, accuracy=1e-5, gradient_accuracy='same',
                  max_iterations=2000, max_gradient_iterations='same',
-                 autodiff=False):
+                 autodiff=False, preconditioner=None, per_example=False, compact_batch=False, norm='max', relative=False, residual_history=None):
         '''
         Conjugate gradient solver that geometrically calculates laplace pressure in each iteration.
         Unlike most other solvers, this algorithm is TPU compatible but usually performs worse than SparseCG.
         At the moment, boundary conditions are only partly supported.
 
-        :param accuracy: the maximally allowed error on the divergence channel for each cell
+        :param accuracy: the maximally allowed norm of the residual of the divergence channel, see norm and relative
         :param gradient_accuracy: accuracy applied during backpropagation, number of 'same' to use forward accuracy
         :param max_iterations: integer specifying maximum conjugent gradient loop iterations or None for no limit
         :param max_gradient_iterations: maximum loop iterations during backpropagation,
@@ -29,6 +31,14 @@ class GeometricCG(PressureSolver):
             The intermediate results of each loop iteration will be permanently stored if backpropagation is used.
             If False, replaces autodiff by a forward pressure solve in reverse accumulation backpropagation.
             This requires less memory but is only accurate if the solution is fully converged.
+        :param preconditioner: (optional) Preconditioner, e.g. JacobiPreconditioner or MultigridPreconditioner
+        :param per_example: if True, examples of a batch stop iterating individually once they have converged.
+            The iteration count of each example is stored in solve_info['example_iterations'].
+        :param compact_batch: with per_example=True and NumPy, removes converged examples from the batch instead of masking them, see conjugate_gradient()
+        :param norm: norm of the residual compared against accuracy, 'max' (largest error of any cell), 'l2' or 'rms', see conjugate_gradient()
+        :param relative: if True, the accuracy is relative to the norm of the divergence of each example, ‖r‖ ≤ accuracy ‖∇·v‖.
+            With norm='max', the allowed error scales with the largest divergence, which avoids wasted iterations on nearly quiescent frames.
+        :param residual_history: (optional) sampling interval of the residual norm stored in solve_info['residual_history'], see SparseCG
         '''
         PressureSolver.__init__(self, 'Single-Phase Conjugate Gradient',
                                 supported_devices=('CPU', 'GPU', 'TPU'),
@@ -46,30 +56,48 @@ class GeometricCG(PressureSolver):
         else:
             self.max_gradient_iterations = max_gradient_iterations
             assert not autodiff, 'Cannot specify max_gradient_iterations when autodiff=True'
+        assert norm in RESIDUAL_NORMS, 'invalid norm: %s' % norm
         self.autodiff = autodiff
+        self.preconditioner = preconditioner
+        self.per_example = per_example
+        self.compact_batch = compact_batch
+        self.norm = norm
+        self.relative = relative
+        self.residual_history = residual_history
 
     def solve(self, divergence, domain, pressure_guess):
         assert isinstance(domain, FluidDomain)
         fluid_mask = domain.accessible_tensor(extend=1)
+        preconditioner = self.preconditioner.bind(domain) if self.preconditioner is not None else None
 
+        cg_options = (self.per_example, self.compact_batch, self.norm, self.relative)
+        history = ResidualHistory(self.residual_history, self.norm) if self.residual_history else None
+        solve_start = time.time()
         if self.autodiff:
-            return solve_pressure_forward(divergence, fluid_mask, self.max_iterations, pressure_guess, self.accuracy, domain, back_prop=True)
+            pressure, iteration = solve_pressure_forward(divergence, fluid_mask, self.max_iterations, pressure_guess, self.accuracy, domain, True, preconditioner, *cg_options, callback=history)
         else:
             def pressure_gradient(op, grad):
-                return solve_pressure_forward(grad, fluid_mask, max_gradient_iterations, None, self.gradient_accuracy, domain)[0]
+                return solve_pressure_forward(grad, fluid_mask, max_gradient_iterations, None, self.gradient_accuracy, domain, False, preconditioner, *cg_options)[0]
 
             pressure, iteration = math.with_custom_gradient(
                 solve_pressure_forward,
-                [divergence, fluid_mask, self.max_iterations, pressure_guess, self.accuracy, domain],
+                [divergence, fluid_mask, self.max_iterations, pressure_guess, self.accuracy, domain, False, preconditioner] + list(cg_options) + [history],
                 pressure_gradient,
                 input_index=0, output_index=0, name_base='geom_solve'
             )
 
-            max_gradient_iterations = iteration if self.max_gradient_iterations == 'mirror' else self.max_gradient_iterations
-            return pressure, iteration
+            max_gradient_iterations = math.max(iteration) if self.max_gradient_iterations == 'mirror' else self.max_gradient_iterations
+        self.solve_info = {'solve_time': time.time() - solve_start}
+        if history is not None and history.final is not None:
+            self.solve_info.update({'residual_history': history.samples, 'residual': history.final})
+        if self.per_example:
+            self.solve_info['example_iterations'] = iteration
+            iteration = math.max(iteration)
+        return pressure, iteration
 
 
-def solve_pressure_forward(divergence, fluid_mask, max_iterations, guess, accuracy, domain, back_prop=False):
+def solve_pressure_forward(divergence, fluid_mask, max_iterations, guess, accuracy, domain, back_prop=False, preconditioner=None, per_example=False, compact=False, norm='max', relative=False,
+                           callback=None):
 
     def apply_A(pressure):
         from phi.physics.material import Material
@@ -77,7 +105,7 @@ def solve_pressure_forward(divergence, fluid_mask, max_iterations, guess, accura
         padded = math.pad(pressure, [[0,0]] + [[1,1]]*(math.ndims(pressure)-2) + [[0,0]], mode=mode)
         return _weighted_sliced_laplace_nd(padded, weights=fluid_mask)
 
-    return conjugate_gradient(divergence, apply_A, guess, accuracy, max_iterations, back_prop=back_prop)
+    return conjugate_gradient(divergence, apply_A, guess, accuracy, max_iterations, back_prop=back_prop, preconditioner=preconditioner, per_example=per_example, compact=compact, norm=norm, relative=relative, callback=callback)
 
 
 def _weighted_sliced_laplace_nd(tensor, weights):
@@ -103,3 +131,50 @@ def _weighted_sliced_laplace_nd(tensor, weights):
                math.mul(center_values, center_weights)
         components.append(diff)
     return math.sum(components, 0)
+
+
+def pressure_stencil(extended_active_mask, extended_fluid_mask, dirichlet_weight=1.):
+    """
+    Computes the stencil weights of the pressure matrix built by sparse_pressure_matrix() in grid form.
+    Applying the stencil with apply_pressure_stencil() is equivalent to multiplying with the sparse matrix.
+
+    :param extended_active_mask: Binary tensor with 2 more entries in every spatial dimension than the pressure.
+    :param extended_fluid_mask: Binary tensor with 2 more entries in every spatial dimension than the pressure.
+    :param dirichlet_weight: diagonal contribution of accessible but inactive neighbours (zero pressure).
+        Values other than 1 move the zero-pressure boundary closer to the cell, as required on coarse multigrid levels.
+    :return: diagonal weights, list of (lower weights, upper weights) for each spatial dimension. All weights have the shape of the pressure.
+    """
+    dims = range(math.spatial_rank(extended_active_mask))
+    center_slices = (slice(None),) + tuple([slice(1, -1) for _ in dims]) + (slice(None),)
+    self_active = extended_active_mask[center_slices]
+    diagonal = 0
+    neighbours = []
+    for dimension in dims:
+        upper_slices = (slice(None),) + tuple([(slice(2, None) if i == dimension else slice(1, -1)) for i in dims]) + (slice(None),)
+        lower_slices = (slice(None),) + tuple([(slice(-2) if i == dimension else slice(1, -1)) for i in dims]) + (slice(None),)
+        neighbours.append((extended_active_mask[lower_slices] * self_active, extended_active_mask[upper_slices] * self_active))
+        for slices in (lower_slices, upper_slices):
+            if dirichlet_weight == 1:
+                diagonal = diagonal - extended_fluid_mask[slices]
+            else:
+                diagonal = diagonal - extended_fluid_mask[slices] * (1 + (dirichlet_weight - 1) * (1 - extended_active_mask[slices]))
+    return math.minimum(diagonal, -1.), neighbours
+
+
+def apply_pressure_stencil(pressure, stencil):
+    """
+    Multiplies the pressure with the pressure matrix represented by the given stencil.
+
+    :param pressure: tensor of shape (batch size, spatial dimensions..., 1)
+    :param stencil: stencil weights as returned by pressure_stencil()
+    :return: tensor of same shape as pressure
+    """
+    diagonal, neighbours = stencil
+    dims = range(math.spatial_rank(pressure))
+    padded = math.pad(pressure, [[0, 0]] + [[1, 1]] * len(dims) + [[0, 0]])
+    result = pressure * diagonal
+    for dimension, (lower_weights, upper_weights) in zip(dims, neighbours):
+        upper_slices = (slice(None),) + tuple([(slice(2, None) if i == dimension else slice(1, -1)) for i in dims]) + (slice(None),)
+        lower_slices = (slice(None),) + tuple([(slice(-2) if i == dimension else slice(1, -1)) for i in dims]) + (slice(None),)
+        result += padded[lower_slices] * lower_weights + padded[upper_slices] * upper_weights
+    return result
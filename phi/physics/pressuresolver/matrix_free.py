@@ -0,0 +1,229 @@
+import copy
+import inspect
+import time
+from numbers import Number
+
+import numpy as np
+import scipy.sparse.linalg
+
+from phi import math
+from phi.math.blas import conjugate_gradient
+from .cache import OperatorCache, mask_key
+from .geom import pressure_stencil
+from .solver_api import PressureSolver, FluidDomain
+
+
+STENCIL_CACHE = OperatorCache(name='pressure stencil')
+
+
+class PressureStencilOperator(scipy.sparse.linalg.LinearOperator):
+
+    def __init__(self, dimensions, extended_active_mask, extended_fluid_mask, dtype=np.float32):
+        """
+        Matrix-free representation of the pressure matrix (see sparse_pressure_matrix()) as a SciPy LinearOperator.
+
+        Products are computed with the sliced stencil of pressure_stencil() instead of a sparse matrix.
+        Because the matrix is symmetric, only the diagonal and the weights of the upper neighbours are stored,
+        i.e. (1 + d) values per cell for d spatial dimensions.
+        Operators created with with_buffers() write intermediate products to preallocated buffers.
+        Shared operators, e.g. from the STENCIL_CACHE, allocate them in every product so that concurrent solves never share scratch memory.
+
+        The operator can be passed to SciPy's Krylov solvers (cg, minres, gmres, ...) or used as apply_A of
+        phi.math.blas.conjugate_gradient via apply().
+
+        :param dimensions: valid simulation dimensions
+        :param extended_active_mask: NumPy array with 2 more entries in every spatial dimension than 'dimensions'.
+        :param extended_fluid_mask: NumPy array with 2 more entries in every spatial dimension than 'dimensions'.
+        :param dtype: data type of the stencil weights
+        """
+        self.dimensions = [int(n) for n in dimensions]
+        N = int(np.prod(self.dimensions))
+        scipy.sparse.linalg.LinearOperator.__init__(self, np.dtype(dtype), (N, N))
+        diagonal, neighbours = pressure_stencil(extended_active_mask, extended_fluid_mask)
+        self.diagonal = np.asarray(diagonal, dtype)[0, ..., 0]
+        # upper weights of the last cell along each dimension are zero and lower weights equal the upper weights of the lower neighbour
+        self.upper = [np.asarray(upper, dtype)[0, ..., 0][_shifted(dim, len(self.dimensions), lower=True)] for dim, (_, upper) in enumerate(neighbours)]
+        self._buffers = None  # (dim, batch size, dtype) -> array, None to allocate temporaries
+
+    @property
+    def nbytes(self):
+        return self.diagonal.nbytes + sum(upper.nbytes for upper in self.upper) + sum(buffer.nbytes for buffer in (self._buffers or {}).values())
+
+    def with_buffers(self):
+        """
+        Returns a copy of this operator sharing the stencil weights but owning its own scratch buffers.
+        Each solve should use its own copy.
+        """
+        operator = copy.copy(self)
+        operator._buffers = {}
+        return operator
+
+    def apply(self, pressure, out=None):
+        """
+        Multiplies the pressure matrix with a grid-shaped pressure tensor.
+
+        :param pressure: NumPy array of shape (batch size, spatial dimensions..., 1) or (batch size, spatial dimensions...)
+        :param out: (optional) NumPy array of the same shape to write the result to
+        :return: out or a new array of the same shape as pressure
+        """
+        grid = pressure.reshape([-1] + self.dimensions)
+        result_dtype = np.result_type(pressure.dtype, self.diagonal.dtype)
+        if out is None:
+            out = np.empty(pressure.shape, result_dtype)
+        result = out.reshape(grid.shape)
+        np.multiply(grid, self.diagonal, out=result)
+        rank = len(self.dimensions)
+        for dim, upper in enumerate(self.upper):
+            lower_cells = (slice(None),) + _shifted(dim, rank, lower=True)
+            upper_cells = (slice(None),) + _shifted(dim, rank, lower=False)
+            buffer = self._buffer(dim, grid.shape[0], result_dtype)
+            np.multiply(grid[upper_cells], upper, out=buffer)
+            result[lower_cells] += buffer
+            np.multiply(grid[lower_cells], upper, out=buffer)
+            result[upper_cells] += buffer
+        return out
+
+    def _buffer(self, dim, batch_size, dtype):
+        shape = [batch_size] + [n - 1 if i == dim else n for i, n in enumerate(self.dimensions)]
+        if self._buffers is None:
+            return np.empty(shape, dtype)
+        key = (dim, batch_size, np.dtype(dtype).str)
+        if key not in self._buffers:
+            self._buffers[key] = np.empty(shape, dtype)
+        return self._buffers[key]
+
+    def _matvec(self, x):
+        return self.apply(np.reshape(x, [1] + self.dimensions)).reshape(np.shape(x))
+
+    def _matmat(self, X):
+        return self.apply(np.ascontiguousarray(np.transpose(X))).reshape([X.shape[1], -1]).T
+
+    def _rmatvec(self, x):
+        return self._matvec(x)
+
+    def _adjoint(self):
+        return self
+
+
+def _shifted(dim, rank, lower):
+    """ Slices selecting all cells except the last (lower=True) or first (lower=False) along dim. """
+    return tuple([(slice(None, -1) if lower else slice(1, None)) if i == dim else slice(None) for i in range(rank)])
+
+
+def cached_stencil_operator(dimensions, extended_active_mask, extended_fluid_mask, cache=STENCIL_CACHE):
+    """
+    Returns the PressureStencilOperator for the given masks, reusing a previously created operator if the masks did not change.
+
+    :param cache: OperatorCache or None to always create the operator
+    """
+    create = lambda: PressureStencilOperator(dimensions, extended_active_mask, extended_fluid_mask)
+    if cache is None:
+        return create()
+    return cache.get_or_create(mask_key(dimensions, extended_active_mask, extended_fluid_mask), create)
+
+
+class MatrixFreeSciPy(PressureSolver):
+
+    def __init__(self, method='cg', accuracy=1e-5, max_iterations=2000, preconditioner=None, cache=STENCIL_CACHE):
+        """
+        Pressure solver that never assembles the pressure matrix.
+        The matrix is represented by a PressureStencilOperator whose memory scales with the number of cells.
+
+        Supported methods are the SciPy Krylov solvers 'cg', 'minres' and 'gmres' as well as 'blas' which runs
+        phi.math.blas.conjugate_gradient on the grid-shaped tensors.
+        The SciPy solvers stop once the L2 norm of the residual is below accuracy (minres: relative to the norm of the divergence),
+        'blas' uses the maximum norm like SparseCG.
+
+        :param method: one of ('cg', 'minres', 'gmres', 'blas')
+        :param accuracy: absolute residual tolerance
+        :param max_iterations: maximum number of iterations per example (gmres: restart cycles)
+        :param preconditioner: (optional) Preconditioner, e.g. JacobiPreconditioner or MultigridPreconditioner
+        :param cache: OperatorCache storing the operators per mask or None
+        """
+        PressureSolver.__init__(self, 'Matrix-free %s' % method,
+                                supported_devices=('CPU',),
+                                supports_guess=True, supports_loop_counter=True, supports_continuous_masks=True)
+        assert method in ('cg', 'minres', 'gmres', 'blas'), 'invalid method: %s' % method
+        assert isinstance(accuracy, Number), 'invalid accuracy: %s' % accuracy
+        self.method = method
+        self.accuracy = accuracy
+        self.max_iterations = max_iterations
+        self.preconditioner = preconditioner
+        self.cache = cache
+
+    def solve(self, divergence, domain, pressure_guess):
+        assert isinstance(domain, FluidDomain)
+        dimensions = [int(n) for n in domain.domain.resolution]
+        assembly_start = time.time()
+        operator = cached_stencil_operator(dimensions, domain.active_tensor(extend=1), domain.accessible_tensor(extend=1), self.cache)
+        self.solve_info = {'assembly_time': time.time() - assembly_start}
+        preconditioner = self.preconditioner.bind(domain) if self.preconditioner is not None else None
+        iterations = [0]
+
+        def np_solve(div, guess=None):
+            pressure, iterations[0] = stencil_solve(operator, div, guess, self.method, self.accuracy, self.max_iterations, preconditioner)
+            return pressure.astype(np.float32)
+
+        inputs = [divergence] if pressure_guess is None else [divergence, pressure_guess]
+
+        def np_solve_gradient(op, grad_in):  # the pressure matrix is symmetric, the guess does not influence the converged result
+            return [math.py_func(np_solve, [grad_in], np.float32, divergence.shape)] + [None] * (len(inputs) - 1)
+
+        solve_start = time.time()
+        pressure = math.py_func(np_solve, inputs, np.float32, divergence.shape, grad=np_solve_gradient)
+        self.solve_info['solve_time'] = time.time() - solve_start
+        return pressure, iterations[0] if isinstance(pressure, np.ndarray) else None
+
+
+def stencil_solve(operator, divergence, guess, method, accuracy, max_iterations, preconditioner=None):
+    """
+    Solves the pressure equation for all examples using a PressureStencilOperator.
+
+    :param operator: PressureStencilOperator
+    :param divergence: NumPy array of shape (batch size, spatial dimensions..., 1)
+    :param guess: NumPy array like divergence or None
+    :param method: one of ('cg', 'minres', 'gmres', 'blas'), see MatrixFreeSciPy
+    :param preconditioner: (optional) bound preconditioner function acting on grid-shaped residuals
+    :return: pressure of same shape as divergence, maximum number of iterations over all examples
+    """
+    operator = operator.with_buffers()
+    if method == 'blas':
+        return conjugate_gradient(divergence, operator.apply, guess, accuracy, max_iterations, preconditioner=preconditioner)
+    # SciPy's solvers expect positive definite operators, the pressure matrix is negative (semi-)definite
+    negated = -operator
+    M = None
+    if preconditioner is not None:
+        grid_shape = [1] + operator.dimensions + [1]
+        M = scipy.sparse.linalg.LinearOperator(operator.shape, matvec=lambda r: -np.reshape(preconditioner(np.reshape(r, grid_shape)), np.shape(r)), dtype=np.float64)
+    div_vec = divergence.reshape([divergence.shape[0], -1]).astype(np.float64)
+    guess_vec = guess.reshape(div_vec.shape) if guess is not None else [None] * div_vec.shape[0]
+    pressure = np.zeros_like(div_vec)
+    max_iterations_used = 0
+    for i in range(div_vec.shape[0]):
+        counter = [0]
+
+        def count(*_args):
+            counter[0] += 1
+        if method == 'cg':
+            pressure[i], _ = scipy.sparse.linalg.cg(negated, -div_vec[i], guess_vec[i], atol=accuracy, maxiter=max_iterations, M=M, callback=count,
+                                                    **{_relative_tolerance_keyword(scipy.sparse.linalg.cg): 0.})
+        elif method == 'gmres':
+            pressure[i], _ = scipy.sparse.linalg.gmres(negated, -div_vec[i], guess_vec[i], atol=accuracy, maxiter=max_iterations, M=M, callback=count,
+                                                       **{_relative_tolerance_keyword(scipy.sparse.linalg.gmres): 0.})
+        elif method == 'minres':
+            norm = np.linalg.norm(div_vec[i])
+            pressure[i], _ = scipy.sparse.linalg.minres(negated, -div_vec[i], guess_vec[i], maxiter=max_iterations, M=M, callback=count,
+                                                        **{_relative_tolerance_keyword(scipy.sparse.linalg.minres): accuracy / norm if norm > 0 else 1.})
+        else:
+            raise ValueError('Unknown method: %s' % method)
+        max_iterations_used = max(max_iterations_used, counter[0])
+    return pressure.reshape(divergence.shape), max_iterations_used
+
+
+def _relative_tolerance_keyword(solver):
+    """ SciPy 1.12 renamed the relative tolerance of its Krylov solvers from tol to rtol and removed tol in 1.14. """
+    try:
+        parameters = inspect.signature(solver).parameters
+    except AttributeError:  # Python 2
+        parameters = inspect.getargspec(solver).args
+    return 'rtol' if 'rtol' in parameters else 'tol'
@@ -0,0 +1,139 @@
+from numbers import Number
+
+import numpy as np
+
+from phi.math.blas import residual_norm
+
+
+class ResidualHistory(object):
+
+    def __init__(self, interval=1, norm='max'):
+        """
+        Records the residual norm of an iterative solve, see conjugate_gradient(callback).
+
+        Every interval iterations, the largest residual norm of all examples is appended to samples as (iteration, norm).
+        The norm of the most recent iteration is always available as final, independent of the interval.
+
+        :param interval: number of iterations between two samples
+        :param norm: one of 'max', 'l2', 'rms', see residual_norm()
+        """
+        assert interval >= 1, 'invalid interval: %s' % interval
+        self.interval = interval
+        self.norm = norm
+        self.samples = []
+        self.final = None
+
+    def __call__(self, iteration, residual):
+        value = float(np.max(residual_norm(residual, self.norm)))
+        self.final = value
+        if iteration % self.interval == 0:
+            self.samples.append((int(iteration), value))
+
+
+def iteration_limit(pressure_solver):
+    """
+    Returns the maximum number of iterations (or cycles) of an iterative pressure solver.
+
+    :return: the limit or None if the solver has no limit
+    """
+    for attribute in ('max_iterations', 'max_cycles'):
+        limit = getattr(pressure_solver, attribute, None)
+        if isinstance(limit, Number):
+            return limit
+    return None
+
+
+def solve_converged(pressure_solver, iterations):
+    """
+    Determines whether a pressure solve reached the accuracy of the solver, i.e. stopped before hitting its iteration limit.
+
+    :param pressure_solver: PressureSolver that performed the solve
+    :param iterations: iteration count returned by the solver
+    :return: True, False or None if unknown, e.g. for symbolic iteration counts
+    """
+    solve_info = getattr(pressure_solver, 'solve_info', {})
+    if 'converged' in solve_info:
+        return solve_info['converged']
+    limit = iteration_limit(pressure_solver)
+    if limit is None:
+        return None if pressure_solver.supports_loop_counter else True  # direct solvers are exact
+    if isinstance(iterations, np.ndarray) and iterations.dtype.kind in 'iu':
+        iterations = int(np.max(iterations))
+    if not isinstance(iterations, Number):
+        return None
+    return bool(iterations < limit)
+
+
+class SolveMetrics(object):
+
+    RECORDED_KEYS = ('iterations', 'converged', 'wall_time', 'solve_time', 'assembly_time', 'residual', 'divergence', 'accuracy')
+
+    def __init__(self, max_records=1000):
+        """
+        Lightweight registry aggregating the solve_info of pressure solves, see IncompressibleFlow(metrics).
+
+        Only the scalar entries listed in RECORDED_KEYS are kept, tensors such as the pressure are dropped.
+        Records are kept per fluid name and numbered by solve so that frames in which the solver hit its iteration limit can be located.
+
+        :param max_records: maximum number of records kept per fluid, the oldest ones are discarded first. None for no limit.
+        """
+        self.max_records = max_records
+        self._records = {}  # fluid name -> list of dicts
+        self._counts = {}  # fluid name -> number of recorded solves
+
+    def record(self, name, solve_info):
+        """
+        Stores the scalar entries of solve_info.
+
+        :param name: name of the fluid
+        :param solve_info: dict as returned by divergence_free(return_info=True)
+        :return: the stored record
+        """
+        record = {'solve': self._counts.get(name, 0)}
+        for key in self.RECORDED_KEYS:
+            value = solve_info.get(key, None)
+            if isinstance(value, np.ndarray) and value.size >= 1 and value.dtype.kind in 'biuf':
+                value = value.max().item()
+            if isinstance(value, Number):
+                record[key] = value
+        self._counts[name] = record['solve'] + 1
+        records = self._records.setdefault(name, [])
+        records.append(record)
+        if self.max_records is not None and len(records) > self.max_records:
+            del records[:len(records) - self.max_records]
+        return record
+
+    def records(self, name):
+        """ Returns the list of records of the given fluid, oldest first. """
+        return list(self._records.get(name, ()))
+
+    def unconverged(self, name):
+        """ Returns the records of all solves of the given fluid that did not converge. """
+        return [record for record in self._records.get(name, ()) if record.get('converged', None) is False]
+
+    def summary(self, name):
+        """
+        Aggregates the records of the given fluid.
+
+        :return: dict with the number of solves, unconverged solves, mean and maximum iterations, total and mean wall time and the largest divergence
+        """
+        records = self._records.get(name, ())
+        summary = {'solves': len(records), 'unconverged': len(self.unconverged(name))}
+        for key, reductions in (('iterations', ('mean', 'max')), ('wall_time', ('total', 'mean')), ('divergence', ('max',))):
+            values = [record[key] for record in records if key in record]
+            for reduction in reductions:
+                if values:
+                    summary['%s_%s' % (reduction, key)] = float({'mean': np.mean, 'max': np.max, 'total': np.sum}[reduction](values))
+        return summary
+
+    def reset(self, name=None):
+        """ Removes all records of the given fluid or all fluids if name is None. """
+        if name is None:
+            self._records.clear()
+            self._counts.clear()
+        else:
+            self._records.pop(name, None)
+            self._counts.pop(name, None)
+
+    def __repr__(self):
+        return 'SolveMetrics(%s)' % ', '.join('%s: %d solves' % (name, len(records)) for name, records in self._records.items())
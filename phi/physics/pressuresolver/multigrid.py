@@ -0,0 +1,304 @@
+import time
+from numbers import Number
+
+import numpy as np
+
+from phi import math
+from phi.math.blas import conjugate_gradient
+from .geom import pressure_stencil, apply_pressure_stencil
+from .preconditioner import Preconditioner
+from .sor import red_black_masks, red_black_sor
+from .solver_api import PressureSolver, FluidDomain
+
+
+class MultigridSolver(PressureSolver):
+
+    def __init__(self, accuracy=1e-5, max_cycles=100, cycle='V', smoother='rbgs',
+                 pre_smoothing=2, post_smoothing=2, omega=None, levels=None, min_resolution=4, coarse_iterations=50,
+                 gradient_accuracy='same'):
+        """
+        Geometric multigrid solver that iterates V-, W- or F-cycles until the residual is below accuracy.
+
+        Each cycle smooths the error on the fine grid, restricts the residual to a coarser grid (math.downsample2x),
+        recursively solves for the coarse correction and prolongates it back (math.upsample2x).
+        Coarse grids use downsampled active and accessible masks (see FluidDomain.downsampled2x()).
+        The coarsest grid is solved with conjugate gradient.
+
+        In contrast to MultiscaleSolver, which only passes upsampled solutions as initial guesses,
+        the number of cycles required for convergence is largely independent of the resolution.
+
+        :param accuracy: the maximally allowed error on the divergence channel for each cell
+        :param max_cycles: maximum number of cycles
+        :param cycle: cycle type, one of ('V', 'W', 'F')
+        :param smoother: 'jacobi' for weighted Jacobi, 'rbgs' for red-black Gauss-Seidel or 'sor' for red-black SOR
+        :param pre_smoothing: number of smoothing sweeps before the coarse-grid correction
+        :param post_smoothing: number of smoothing sweeps after the coarse-grid correction
+        :param omega: relaxation weight of the smoother, defaults to 2/3 for Jacobi, 1 for red-black Gauss-Seidel and 1.15 for red-black SOR
+        :param levels: number of grids including the finest one. If None, coarsens until the smallest dimension is below min_resolution.
+        :param min_resolution: minimum number of cells along each dimension of the coarsest grid if levels is None
+        :param coarse_iterations: maximum number of conjugate gradient iterations on the coarsest grid
+        :param gradient_accuracy: accuracy applied during backpropagation, number of 'same' to use forward accuracy
+        """
+        PressureSolver.__init__(self, 'Multigrid %s-cycle' % cycle,
+                                supported_devices=('CPU', 'GPU', 'TPU'),
+                                supports_guess=True, supports_loop_counter=True, supports_continuous_masks=True)
+        assert isinstance(accuracy, Number), 'invalid accuracy: %s' % accuracy
+        assert cycle in ('V', 'W', 'F'), 'invalid cycle: %s' % cycle
+        assert smoother in SMOOTHERS, 'invalid smoother: %s' % smoother
+        assert gradient_accuracy == 'same' or isinstance(gradient_accuracy, Number), 'invalid gradient_accuracy: %s' % gradient_accuracy
+        self.accuracy = accuracy
+        self.gradient_accuracy = accuracy if gradient_accuracy == 'same' else gradient_accuracy
+        self.max_cycles = max_cycles
+        self.cycle = cycle
+        self.smoother = smoother
+        self.pre_smoothing = pre_smoothing
+        self.post_smoothing = post_smoothing
+        self.omega = omega if omega is not None else DEFAULT_SMOOTHER_OMEGA[smoother]
+        self.levels = levels
+        self.min_resolution = min_resolution
+        self.coarse_iterations = coarse_iterations
+
+    def solve(self, divergence, domain, pressure_guess):
+        assert isinstance(domain, FluidDomain)
+        hierarchy = multigrid_hierarchy(domain, self.levels, self.min_resolution)
+        solve_start = time.time()
+
+        def pressure_gradient(op, grad):
+            return self._solve_forward(grad, hierarchy, None, self.gradient_accuracy)[0]
+
+        pressure, cycles = math.with_custom_gradient(self._solve_forward,
+                                                     [divergence, hierarchy, pressure_guess, self.accuracy],
+                                                     pressure_gradient, input_index=0, output_index=0,
+                                                     name_base='multigrid_solve')
+        self.solve_info = {'solve_time': time.time() - solve_start, 'levels': len(hierarchy)}
+        return pressure, cycles
+
+    def _solve_forward(self, divergence, hierarchy, guess, accuracy):
+        smooth = SMOOTHERS[self.smoother]
+        stencil = hierarchy[0].stencil
+        dtype = divergence.dtype if isinstance(divergence, np.ndarray) else None
+        if dtype is not None:
+            # The true residual of single precision arrays stagnates near the round-off error of the stencil
+            divergence = divergence.astype(np.float64)
+            guess = guess.astype(np.float64) if guess is not None else None
+
+        def loop_condition(pressure, residual, _cycles):
+            return math.max(math.abs(residual)) >= accuracy
+
+        def loop_body(pressure, residual, cycles):
+            pressure = multigrid_cycle(hierarchy, divergence, pressure, self.cycle, smooth, self.omega,
+                                       self.pre_smoothing, self.post_smoothing, self.coarse_iterations)
+            if hierarchy[0].singular:
+                pressure = subtract_mean(pressure, hierarchy[0])
+            return [pressure, divergence - apply_pressure_stencil(pressure, stencil), cycles + 1]
+
+        pressure = guess if guess is not None else math.zeros_like(divergence)
+        residual = divergence - apply_pressure_stencil(pressure, stencil)
+        pressure, residual, cycles = math.while_loop(loop_condition, loop_body, [pressure, residual, 0],
+                                                     back_prop=False, name='multigrid_loop', maximum_iterations=self.max_cycles)
+        if dtype is not None:
+            pressure = pressure.astype(dtype)
+        return pressure, cycles
+
+
+class MultigridPreconditioner(Preconditioner):
+
+    def __init__(self, levels=None, smoothing_steps=2, omega=2. / 3, coarse_iterations=30, min_resolution=4):
+        """
+        Geometric multigrid preconditioner applying one V-cycle with weighted Jacobi smoothing.
+
+        Coarse grids are created by downsampling the active and accessible masks (see FluidDomain.downsampled2x()).
+        Residuals are restricted with math.downsample2x and corrections are prolongated with math.upsample2x.
+        The cycle is a fixed linear operator as required by preconditioned conjugate gradient.
+
+        :param levels: number of grids including the finest one. If None, coarsens until the smallest dimension is below min_resolution.
+        :param smoothing_steps: number of Jacobi sweeps before and after each coarse-grid correction
+        :param omega: Jacobi relaxation weight
+        :param coarse_iterations: number of Jacobi sweeps on the coarsest grid
+        :param min_resolution: minimum number of cells along each dimension of the coarsest grid if levels is None
+        """
+        Preconditioner.__init__(self, 'Multigrid V-cycle')
+        self.levels = levels
+        self.smoothing_steps = smoothing_steps
+        self.omega = omega
+        self.coarse_iterations = coarse_iterations
+        self.min_resolution = min_resolution
+
+    def bind(self, domain, matrix=None):
+        hierarchy = multigrid_hierarchy(domain, self.levels, self.min_resolution)
+        return lambda residual: multigrid_cycle(hierarchy, residual, None, 'V', jacobi_smooth, self.omega,
+                                                self.smoothing_steps, self.smoothing_steps, self.coarse_iterations, coarse_solver='jacobi')
+
+
+class MultigridLevel(object):
+
+    def __init__(self, domain, index=0):
+        """
+        Holds the pressure stencil and masks of one multigrid level.
+
+        Zero-pressure (open) boundaries of the finest grid lie one cell outside the domain.
+        To keep their position fixed on coarse grids, the corresponding stencil weights are scaled with the level index.
+
+        :param domain: FluidDomain of this level
+        :param index: level index, 0 for the finest grid
+        """
+        self.resolution = [int(n) for n in domain.domain.resolution]
+        extended_active = domain.active_tensor(extend=1)
+        extended_fluid = domain.accessible_tensor(extend=1)
+        self.stencil = pressure_stencil(extended_active, extended_fluid, dirichlet_weight=2. ** (index + 1) / (2 ** index + 1))
+        self.active = domain.active.data
+        self.red, self.black = red_black_masks(self.resolution)
+        if isinstance(extended_active, np.ndarray) and isinstance(extended_fluid, np.ndarray):
+            # Without zero-pressure cells, the pressure is only determined up to a constant
+            self.singular = not np.any(extended_fluid * (1 - extended_active) > 0)
+        else:
+            self.singular = False
+
+
+def multigrid_hierarchy(domain, levels=None, min_resolution=4):
+    """
+    Builds all multigrid levels, starting with the finest.
+
+    :param domain: FluidDomain of the finest grid
+    :param levels: number of levels or None to coarsen until the smallest dimension is below min_resolution
+    :param min_resolution: minimum size of the coarsest grid if levels is None
+    :return: list of MultigridLevel
+    """
+    assert isinstance(domain, FluidDomain)
+    hierarchy = []
+    while True:
+        hierarchy.append(MultigridLevel(domain, len(hierarchy)))
+        resolution = domain.domain.resolution
+        if levels is not None and len(hierarchy) >= levels:
+            break
+        if levels is None and min(resolution) // 2 < min_resolution:
+            break
+        if min(resolution) < 2:
+            break
+        domain = domain.downsampled2x()
+    return hierarchy
+
+
+def jacobi_smooth(x, rhs, level, omega, iterations):
+    """
+    Applies weighted Jacobi sweeps to the pressure equation of the given level.
+
+    :param x: initial guess or None for zero
+    :param rhs: right-hand side of shape (batch size, spatial dimensions..., 1)
+    :param level: MultigridLevel
+    :param omega: relaxation weight
+    :param iterations: number of sweeps
+    :return: smoothed x
+    """
+    diagonal = level.stencil[0]
+    for _ in range(iterations):
+        if x is None:
+            x = omega * rhs / diagonal
+        else:
+            x = x + omega * (rhs - apply_pressure_stencil(x, level.stencil)) / diagonal
+    return x
+
+
+def red_black_gauss_seidel_smooth(x, rhs, level, omega, iterations):
+    """
+    Applies red-black Gauss-Seidel (or SOR for omega > 1) sweeps to the pressure equation of the given level.
+    Each sweep updates all red cells, then all black cells, using the already updated red values.
+
+    :param x: initial guess or None for zero
+    :param rhs: right-hand side of shape (batch size, spatial dimensions..., 1)
+    :param level: MultigridLevel
+    :param omega: relaxation weight
+    :param iterations: number of sweeps
+    :return: smoothed x
+    """
+    return red_black_sor(x, rhs, level.stencil, level.red, level.black, omega, iterations)
+
+
+SMOOTHERS = {'jacobi': jacobi_smooth, 'rbgs': red_black_gauss_seidel_smooth, 'sor': red_black_gauss_seidel_smooth}
+# Smoothing needs mild over-relaxation at most, the optimal weight for SOR as a solver (see optimal_sor_omega()) smooths poorly
+DEFAULT_SMOOTHER_OMEGA = {'jacobi': 2. / 3, 'rbgs': 1., 'sor': 1.15}
+
+
+def restrict(residual, fine_level):
+    """
+    Transfers the residual of the active fine cells to the coarse grid, scaled for the unit-spacing coarse operator.
+    The restriction is the transpose of prolongate() so that multigrid cycles are symmetric operators.
+    """
+    residual = residual * fine_level.active
+    rank = len(fine_level.resolution)
+    residual = math.pad(residual, [[0, 0]] + [[0, n % 2] for n in fine_level.resolution] + [[0, 0]])
+    for dim in range(rank):
+        def cells(start, stop=None, step=None):
+            return (slice(None),) + tuple([slice(start, stop, step) if i == dim else slice(None) for i in range(rank)]) + (slice(None),)
+        even, odd = residual[cells(0, None, 2)], residual[cells(1, None, 2)]
+        # transpose of linear interpolation with replicated boundary values, see math.upsample2x()
+        next_even = math.concat([even[cells(1)], odd[cells(-1)]], axis=dim + 1)
+        previous_odd = math.concat([even[cells(0, 1)], odd[cells(0, -1)]], axis=dim + 1)
+        residual = 0.75 * (even + odd) + 0.25 * (next_even + previous_odd)
+    return residual * (4. / 2 ** rank)
+
+
+def prolongate(correction, fine_level):
+    """ Interpolates a coarse-grid correction to the active cells of the fine grid. """
+    upsampled = math.upsample2x(correction)
+    upsampled = upsampled[(slice(None),) + tuple([slice(0, n) for n in fine_level.resolution]) + (slice(None),)]
+    return upsampled * fine_level.active
+
+
+def subtract_mean(x, level):
+    """
+    Removes the constant component of x on the active cells of a level.
+    On closed (singular) domains, this component lies in the null space of the pressure stencil.
+
+    :param x: tensor on the grid of the given level
+    :param level: MultigridLevel
+    :return: x without its mean over the active cells of each example
+    """
+    return x - math.sum(x * level.active, axis=tuple(math.dimrange(x)), keepdims=True) / np.sum(level.active ** 2) * level.active
+
+
+def multigrid_cycle(hierarchy, rhs, x, cycle, smooth, omega, pre_smoothing, post_smoothing, coarse_iterations, coarse_solver='cg', level=0):
+    """
+    Performs one multigrid cycle for the pressure equation on the given level.
+
+    :param hierarchy: list of MultigridLevel, see multigrid_hierarchy()
+    :param rhs: right-hand side on the grid of the given level
+    :param x: initial guess or None for zero
+    :param cycle: 'V', 'W' or 'F'
+    :param smooth: smoother function, e.g. jacobi_smooth or red_black_gauss_seidel_smooth
+    :param coarse_solver: 'cg' to solve the coarsest grid with conjugate gradient or 'jacobi' for a fixed number of Jacobi sweeps
+    :param level: index of the current level
+    :return: improved solution
+    """
+    current = hierarchy[level]
+    if level == len(hierarchy) - 1:
+        if current.singular:
+            # the restricted residual is only approximately compatible with closed boundaries
+            rhs = subtract_mean(rhs, current)
+        if coarse_solver == 'cg':
+            return conjugate_gradient(rhs, lambda p: apply_pressure_stencil(p, current.stencil), x, None, min(coarse_iterations, int(np.prod(current.resolution))))[0]
+        else:
+            return jacobi_smooth(x, rhs, current, omega, coarse_iterations)
+    if pre_smoothing > 0:
+        x = smooth(x, rhs, current, omega, pre_smoothing)
+    residual = rhs if x is None else rhs - apply_pressure_stencil(x, current.stencil)
+    coarse_rhs = restrict(residual, current)
+    coarse_args = (smooth, omega, pre_smoothing, post_smoothing, coarse_iterations, coarse_solver, level + 1)
+    if cycle == 'V':
+        correction = multigrid_cycle(hierarchy, coarse_rhs, None, 'V', *coarse_args)
+    elif cycle in ('W', 'F'):
+        # repeated coarse cycles amplify the constant null space component of closed domains, so it is removed from each correction
+        coarse = hierarchy[level + 1]
+        correction = multigrid_cycle(hierarchy, coarse_rhs, None, cycle, *coarse_args)
+        if coarse.singular:
+            correction = subtract_mean(correction, coarse)
+        correction = multigrid_cycle(hierarchy, coarse_rhs, correction, 'W' if cycle == 'W' else 'V', *coarse_args)
+        if coarse.singular:
+            correction = subtract_mean(correction, coarse)
+    else:
+        raise ValueError('Unknown cycle: %s' % cycle)
+    correction = prolongate(correction, current)
+    x = correction if x is None else x + correction
+    if post_smoothing > 0:
+        x = smooth(x, rhs, current, omega, post_smoothing)
+    return x
@@ -1,4 +1,6 @@
 import logging
+import time
+
 import numpy as np
 
 from phi import math
@@ -15,7 +17,8 @@ class MultiscaleSolver(PressureSolver):
 
         This approach reduces the number of high-resolution iterations required, especially if the previous solver had a higher accuracy.
 
-        :param solvers: tuple or list of PressureSolvers with length equal to number of grids
+        :param solvers: tuple or list of PressureSolvers with length equal to number of grids.
+            Solvers that support preconditioners, such as SparseCG, bind them to the FluidDomain of their grid.
         :param autodiff: if True, use autodiff, else use multigrid forward solver for backprop
         """
         if isinstance(solvers, PressureSolver):
@@ -31,43 +34,42 @@ class MultiscaleSolver(PressureSolver):
 
     def solve(self, divergence, domain, pressure_guess):
         assert isinstance(domain, FluidDomain)
+        solve_start = time.time()
 
         if self.autodiff:
-            return _mg_solve_forward(divergence, domain, pressure_guess, self.solvers)
-
-        def pressure_gradient(op, grad):
-            return  _mg_solve_forward(grad, domain, None, self.solvers)[0]
+            result = _mg_solve_forward(divergence, domain, pressure_guess, self.solvers)
+        else:
+            def pressure_gradient(op, grad):
+                return  _mg_solve_forward(grad, domain, None, self.solvers)[0]
 
-        return math.with_custom_gradient(_mg_solve_forward,
-                                         [divergence, domain, pressure_guess, self.solvers],
-                                         pressure_gradient,
-                                         input_index=0, output_index=0,
-                                         name_base='multiscale_solve')
+            result = math.with_custom_gradient(_mg_solve_forward,
+                                               [divergence, domain, pressure_guess, self.solvers],
+                                               pressure_gradient,
+                                               input_index=0, output_index=0,
+                                               name_base='multiscale_solve')
+        self.solve_info = {'solve_time': time.time() - solve_start}
+        return result
 
 
 def _mg_solve_forward(divergence, domain, pressure_guess, solvers):
-    fluid_mask = domain.accessible_tensor(extend=1)
-    active_mask = domain.active_tensor(extend=1)
-    if active_mask is not None or fluid_mask is not None:
-        if not np.all([s.supports_continuous_masks for s in solvers[:-1]]):
-            logging.warning(
-                "MultiscaleSolver solver: There are boundary conditions inside the domain but "
-                "not all intermediate solvers support continuous masks")
+    if not np.all([s.supports_continuous_masks for s in solvers[:-1]]):
+        logging.warning(
+            "MultiscaleSolver solver: Downsampled masks are continuous but "
+            "not all intermediate solvers support continuous masks")
     div_lvls = [divergence]
-    act_lvls = [active_mask]
-    fld_lvls = [fluid_mask]
+    domain_lvls = [domain]
     for grid_i in range(len(solvers) - 1):
         div_lvls.insert(0, math.downsample2x(div_lvls[0]))
-        act_lvls.insert(0, math.downsample2x(act_lvls[0]) if act_lvls[0] is not None else None)
-        fld_lvls.insert(0, math.downsample2x(fld_lvls[0]) if fld_lvls[0] is not None else None)
+        domain_lvls.insert(0, domain_lvls[0].downsampled2x())
         if pressure_guess is not None:
             pressure_guess = math.downsample2x(pressure_guess)
 
     iter_list = []
     for i, div in enumerate(div_lvls):
-        pressure_guess, iteration = solvers[i].solve(div, FluidDomain(act_lvls[i], fld_lvls[i], boundaries), pressure_guess)
+        pressure_guess, iteration = solvers[i].solve(div, domain_lvls[i], pressure_guess)
         iter_list.append(iteration)
-        if pressure_guess.shape[1] < divergence.shape[1]:
+        if i < len(div_lvls) - 1:
             pressure_guess = math.upsample2x(pressure_guess) * 2 ** math.spatial_rank(divergence)
+            pressure_guess = pressure_guess[(slice(None),) + tuple([slice(0, n) for n in div_lvls[i + 1].shape[1:-1]]) + (slice(None),)]
 
     return pressure_guess, iter_list
@@ -0,0 +1,113 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+from phi import math
+from .cache import OperatorCache, mask_key
+from .solver_api import FluidDomain
+from .sparse import sparse_values, cached_pressure_matrix
+
+
+class Preconditioner(object):
+
+    def __init__(self, name):
+        """
+        Base class for preconditioners of conjugate gradient pressure solvers such as SparseCG and GeometricCG.
+        Preconditioners approximate the inverse of the pressure matrix.
+        """
+        self.name = name
+
+    def bind(self, domain, matrix=None):
+        """
+        Prepares the preconditioner for the given fluid domain.
+
+        :param domain: FluidDomain defining the pressure matrix
+        :param matrix: (optional) pressure matrix already assembled by the solver, see sparse_pressure_matrix()
+        :return: function mapping a residual of shape (batch size, spatial dimensions..., 1) to an approximate solution of A x = residual of the same shape
+        """
+        raise NotImplementedError(self.__class__)
+
+    def __repr__(self):
+        return self.name
+
+
+class JacobiPreconditioner(Preconditioner):
+
+    def __init__(self):
+        """
+        Divides the residual by the diagonal of the pressure matrix.
+        Cheap to apply and supported by all backends.
+        """
+        Preconditioner.__init__(self, 'Jacobi')
+
+    def bind(self, domain, matrix=None):
+        assert isinstance(domain, FluidDomain)
+        dimensions = [int(n) for n in domain.domain.resolution]
+        N = int(np.prod(dimensions))
+        values = sparse_values(dimensions, domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        diagonal = math.reshape(values[:N], [1] + dimensions + [1])  # diagonal entries come first in sparse_values()
+        inverse_diagonal = 1. / diagonal
+        return lambda residual: residual * inverse_diagonal
+
+
+ILU_CACHE = OperatorCache(name='incomplete factorization')
+
+
+class IncompleteLUPreconditioner(Preconditioner):
+
+    def __init__(self, drop_tol=1e-4, fill_factor=10, cache=ILU_CACHE):
+        """
+        Symmetric incomplete factorization M = U^T D^-1 U of the sparse pressure matrix, built from scipy.sparse.linalg.spilu.
+        SciPy provides no incomplete Cholesky factorization.
+        spilu is therefore run without column reordering and without pivoting, and only its upper factor U and diagonal D are used.
+        This keeps the preconditioner symmetric, as required by conjugate gradient, which the plain L U factors of spilu are not.
+        Only supported by the SciPy backend.
+
+        :param drop_tol: drop tolerance for small entries of the factors, see spilu
+        :param fill_factor: maximum fill-in relative to the matrix, see spilu
+        :param cache: OperatorCache storing factorizations per mask, drop_tol and fill_factor or None
+        """
+        Preconditioner.__init__(self, 'Incomplete LU')
+        self.drop_tol = drop_tol
+        self.fill_factor = fill_factor
+        self.cache = cache
+
+    def bind(self, domain, matrix=None):
+        assert isinstance(domain, FluidDomain)
+        dimensions = [int(n) for n in domain.domain.resolution]
+        active_mask = domain.active_tensor(extend=1)
+        fluid_mask = domain.accessible_tensor(extend=1)
+        if not scipy.sparse.issparse(matrix):
+            matrix = cached_pressure_matrix(dimensions, active_mask, fluid_mask)
+        factorize = lambda: symmetric_incomplete_factorization(matrix, self.drop_tol, self.fill_factor)
+        if self.cache is None:
+            lower, diagonal = factorize()
+        else:
+            key = mask_key(dimensions, active_mask, fluid_mask)
+            lower, diagonal = self.cache.get_or_create(key + (self.drop_tol, self.fill_factor) if key is not None else None, factorize,
+                                                       nbytes=lambda factors: factors[0].L.nnz * 12 + factors[1].nbytes)
+
+        def apply(residual):
+            assert isinstance(residual, np.ndarray), 'IncompleteLUPreconditioner only supports NumPy arrays'
+            flat = np.array(residual.reshape([residual.shape[0], -1]).T, np.float64, order='F')
+            flat = lower.solve(lower.solve(flat) / diagonal[:, None], trans='T')
+            return flat.T.reshape(residual.shape).astype(residual.dtype)
+        return apply
+
+
+def symmetric_incomplete_factorization(matrix, drop_tol=1e-4, fill_factor=10):
+    """
+    Computes an incomplete factorization U^T D^-1 U of a symmetric sparse matrix.
+
+    :param matrix: symmetric sparse matrix
+    :param drop_tol: drop tolerance, see scipy.sparse.linalg.spilu
+    :param fill_factor: maximum fill-in, see scipy.sparse.linalg.spilu
+    :return: (lower, diagonal) where lower is a SuperLU object of the unit lower triangular matrix U^T D^-1 and diagonal holds D
+    """
+    ilu = scipy.sparse.linalg.spilu(scipy.sparse.csc_matrix(matrix, dtype=np.float64), drop_tol=drop_tol, fill_factor=fill_factor,
+                                    permc_spec='NATURAL', diag_pivot_thresh=0.)
+    diagonal = ilu.U.diagonal()
+    lower = scipy.sparse.csc_matrix(ilu.U.T.multiply(1. / diagonal[np.newaxis, :]))
+    # Triangular matrices have no fill-in, so this only stores lower for fast triangular solves
+    lower = scipy.sparse.linalg.splu(lower, permc_spec='NATURAL', diag_pivot_thresh=0.)
+    return lower, diagonal
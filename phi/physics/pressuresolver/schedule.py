@@ -0,0 +1,93 @@
+import copy
+from numbers import Number
+
+import numpy as np
+
+
+class AccuracySchedule(object):
+
+    def __init__(self, min_iterations=10, max_iterations=200, adjustment=1.5, reference_cfl=1., min_factor=0.1, max_factor=10.):
+        """
+        Adapts the accuracy of an iterative pressure solver from step to step, see IncompressibleFlow(accuracy_schedule).
+
+        The accuracy of each solve is the base accuracy of the solver times a factor, limited to [min_factor, max_factor].
+        The factor is the product of two terms:
+
+        * A CFL term reference_cfl / CFL, computed from the velocity before projection.
+          Nearly quiescent frames are solved with a looser tolerance, violent frames with a tighter one.
+        * An iteration term that is adjusted after each solve using its iteration count.
+          If the previous solve needed fewer than min_iterations, the tolerance is tightened by the given adjustment factor as further accuracy is cheap.
+          If it needed more than max_iterations, the tolerance is loosened again.
+
+        The schedule only applies to solvers with an accuracy attribute and keeps one state per fluid.
+
+        :param min_iterations: iteration count below which the tolerance is tightened
+        :param max_iterations: iteration count above which the tolerance is loosened
+        :param adjustment: factor by which the iteration term changes per step, > 1
+        :param reference_cfl: CFL number at which the CFL term is 1, None to ignore the CFL number
+        :param min_factor: lower limit of the factor (tightest tolerance)
+        :param max_factor: upper limit of the factor (loosest tolerance)
+        """
+        assert adjustment > 1, 'invalid adjustment: %s' % adjustment
+        assert 0 < min_factor <= 1 <= max_factor, 'invalid factor limits: %s, %s' % (min_factor, max_factor)
+        self.min_iterations = min_iterations
+        self.max_iterations = max_iterations
+        self.adjustment = adjustment
+        self.reference_cfl = reference_cfl
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self._iteration_factors = {}  # fluid name -> iteration term
+
+    def factor(self, name, cfl=None):
+        """
+        Returns the factor by which the base accuracy of the solver is multiplied for the next solve of the given fluid.
+
+        :param name: name of the fluid
+        :param cfl: (optional) CFL number of the velocity to be projected
+        """
+        factor = self._iteration_factors.get(name, 1.)
+        if self.reference_cfl is not None and cfl is not None:
+            factor *= self.reference_cfl / max(cfl, 1e-12)
+        return float(np.clip(factor, self.min_factor, self.max_factor))
+
+    def scheduled_solver(self, pressure_solver, name, cfl=None):
+        """
+        Returns a copy of pressure_solver whose accuracy and gradient_accuracy are scaled by factor().
+        Solvers without accuracy attribute are returned unchanged.
+        """
+        if not hasattr(pressure_solver, 'accuracy'):
+            return pressure_solver
+        factor = self.factor(name, cfl)
+        solver = copy.copy(pressure_solver)
+        solver.accuracy = pressure_solver.accuracy * factor
+        if isinstance(getattr(pressure_solver, 'gradient_accuracy', None), Number):
+            solver.gradient_accuracy = pressure_solver.gradient_accuracy * factor
+        return solver
+
+    def update(self, name, iterations):
+        """
+        Adjusts the iteration term of the given fluid after a solve.
+
+        :param name: name of the fluid
+        :param iterations: iteration count of the solve. Ignored unless it is a number.
+        """
+        if isinstance(iterations, np.ndarray) and iterations.size == 1:
+            iterations = iterations.item()
+        if not isinstance(iterations, Number):
+            return
+        factor = self._iteration_factors.get(name, 1.)
+        if iterations < self.min_iterations:
+            factor /= self.adjustment
+        elif iterations > self.max_iterations:
+            factor *= self.adjustment
+        self._iteration_factors[name] = float(np.clip(factor, self.min_factor, self.max_factor))
+
+    def reset(self, name=None):
+        """ Forgets the iteration terms of the given fluid or all fluids if name is None. """
+        if name is None:
+            self._iteration_factors.clear()
+        else:
+            self._iteration_factors.pop(name, None)
+
+    def __repr__(self):
+        return 'AccuracySchedule(iterations=[%d, %d], reference_cfl=%s)' % (self.min_iterations, self.max_iterations, self.reference_cfl)
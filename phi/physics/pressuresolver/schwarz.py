@@ -0,0 +1,323 @@
+import atexit
+import itertools
+import multiprocessing
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8, arrays are sent through pipes instead
+    shared_memory = None
+
+from phi.math.parallel import default_worker_count
+from .cache import OperatorCache, mask_key
+from .preconditioner import Preconditioner
+from .solver_api import FluidDomain
+from .sparse import SparseCG, sparse_pressure_matrix, _lu_nbytes
+
+
+SUBDOMAIN_CACHE = OperatorCache(max_bytes=1024 ** 3, name='subdomain factorizations')
+
+
+class SchwarzPreconditioner(Preconditioner):
+
+    def __init__(self, blocks=None, overlap=1, workers=None, cache=SUBDOMAIN_CACHE):
+        """
+        Additive Schwarz domain decomposition preconditioner.
+
+        The grid is partitioned into blocks which are extended by overlap cells in every direction.
+        The pressure matrix of each block is assembled from the masks of the block (see sparse_pressure_matrix()),
+        treating cells outside the block as zero pressure, and factorized with scipy.sparse.linalg.splu.
+        The preconditioner solves all block problems for the residual and adds the results.
+        With overlap=0, this is a block Jacobi preconditioner.
+
+        With more than one worker, the blocks are distributed among worker processes that keep their factorizations
+        in memory between steps. Residuals and block solutions are exchanged through shared memory.
+        Factorizations are cached per mask, so only mask changes trigger a refactorization.
+
+        Only supported by the SciPy backend.
+
+        :param blocks: number of blocks along each dimension. If None, the grid is split into one slab per worker along the first dimension.
+        :param overlap: number of cells by which each block is extended in every direction
+        :param workers: number of worker processes, None to use all available cores. With 1 worker, the blocks are solved in the calling process.
+        :param cache: OperatorCache storing factorizations per mask when solving in the calling process or None
+        """
+        Preconditioner.__init__(self, 'Additive Schwarz' if overlap > 0 else 'Block Jacobi')
+        assert overlap >= 0, 'invalid overlap: %s' % overlap
+        self.blocks = blocks
+        self.overlap = overlap
+        self.workers = workers if workers is not None else default_worker_count()
+        self.cache = cache
+        self._pool = None
+
+    def bind(self, domain, matrix=None):
+        assert isinstance(domain, FluidDomain)
+        resolution = [int(n) for n in domain.domain.resolution]
+        active_mask = domain.active_tensor(extend=1)
+        fluid_mask = domain.accessible_tensor(extend=1)
+        assert isinstance(active_mask, np.ndarray) and isinstance(fluid_mask, np.ndarray), 'SchwarzPreconditioner only supports NumPy arrays'
+        blocks = self.blocks if self.blocks is not None else [min(self.workers, resolution[0])] + [1] * (len(resolution) - 1)
+        partition = partition_grid(resolution, blocks, self.overlap)
+        subdomains = [(bounds, block_masks(active_mask, fluid_mask, bounds)) for bounds in partition]
+        indices = [block_indices(resolution, bounds) for bounds in partition]
+        key = mask_key(resolution, active_mask, fluid_mask) + (tuple(blocks), self.overlap)
+        if self.workers > 1:
+            if self._pool is None:
+                self._pool = SubdomainProcessPool(self.workers)
+            pool = self._pool
+            solve_blocks = lambda rhs: pool.solve(key, resolution, subdomains, rhs)
+        else:
+            def factorize():
+                return [factorize_subdomain(*subdomain) for subdomain in subdomains]
+            factorizations = self.cache.get_or_create(key, factorize, nbytes=lambda lus: sum(_lu_nbytes(lu) for lu in lus)) if self.cache is not None else factorize()
+            solve_blocks = lambda rhs: [lu.solve(np.array(rhs[:, idx].T, order='F')).T for lu, idx in zip(factorizations, indices)]
+
+        def apply(residual):
+            assert isinstance(residual, np.ndarray), 'SchwarzPreconditioner only supports NumPy arrays'
+            rhs = residual.reshape([residual.shape[0], -1]).astype(np.float64)
+            result = np.zeros_like(rhs)
+            for idx, block_result in zip(indices, solve_blocks(rhs)):
+                result[:, idx] += block_result
+            return result.reshape(residual.shape).astype(residual.dtype)
+        return apply
+
+    def close(self):
+        """ Stops the worker processes. They are restarted when the preconditioner is used again. """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+
+class SchwarzCG(SparseCG):
+
+    def __init__(self, accuracy=1e-5, blocks=None, overlap=1, workers=None, **kwargs):
+        """
+        Conjugate gradient preconditioned with additive Schwarz domain decomposition, see SchwarzPreconditioner.
+        The subdomain problems are solved in parallel worker processes.
+        Only supported by the SciPy backend.
+
+        :param accuracy: the maximally allowed error on the divergence channel for each cell
+        :param blocks: number of blocks along each dimension or None for one slab per worker
+        :param overlap: number of overlapping cells between neighbouring blocks, 0 for block Jacobi
+        :param workers: number of worker processes, None to use all available cores
+        :param kwargs: additional arguments for SparseCG
+        """
+        SparseCG.__init__(self, accuracy, preconditioner=SchwarzPreconditioner(blocks, overlap, workers), **kwargs)
+        self.name = 'Schwarz-preconditioned Conjugate Gradient'
+
+
+def partition_grid(resolution, blocks, overlap=0):
+    """
+    Splits a grid into blocks of nearly equal size.
+
+    :param resolution: list of cell counts along each dimension
+    :param blocks: number of blocks along each dimension
+    :param overlap: number of cells by which each block is extended in every direction, limited by the grid
+    :return: list of block bounds, each a tuple of (start, stop) pairs for all dimensions
+    """
+    assert len(blocks) == len(resolution), 'blocks must be specified for all %d dimensions' % len(resolution)
+    edges = [np.linspace(0, n, min(b, n) + 1).astype(int) for n, b in zip(resolution, blocks)]
+    ranges = [[(max(0, int(e[i]) - overlap), min(n, int(e[i + 1]) + overlap)) for i in range(len(e) - 1)] for e, n in zip(edges, resolution)]
+    return [tuple(bounds) for bounds in itertools.product(*ranges)]
+
+
+def block_indices(resolution, bounds):
+    """ Returns the flat indices of all cells of a block in the pressure vector, ordered like the block's own pressure vector. """
+    grid = np.meshgrid(*[np.arange(start, stop) for start, stop in bounds], indexing='ij')
+    return np.ravel_multi_index([g.flatten() for g in grid], resolution)
+
+
+def block_masks(extended_active_mask, extended_fluid_mask, bounds):
+    """ Returns the extended active and fluid masks of a block, see FluidDomain.active_tensor(extend=1). """
+    slices = (slice(None),) + tuple([slice(start, stop + 2) for start, stop in bounds]) + (slice(None),)
+    return extended_active_mask[slices], extended_fluid_mask[slices]
+
+
+def factorize_subdomain(bounds, masks):
+    """
+    Assembles and factorizes the pressure matrix of a block.
+
+    Fluid regions of the block that are not connected to a zero-pressure cell make the block matrix singular.
+    One cell of each such region is grounded by increasing its diagonal entry.
+
+    :param bounds: block bounds, see partition_grid()
+    :param masks: extended active and fluid masks of the block, see block_masks()
+    :return: SuperLU object
+    """
+    dimensions = [stop - start for start, stop in bounds]
+    A = scipy.sparse.csc_matrix(sparse_pressure_matrix(dimensions, *masks), dtype=np.float64)
+    diagonal = A.diagonal()
+    off_diagonal = A - scipy.sparse.diags(diagonal)
+    # rows of the pressure matrix sum to zero unless the cell borders a zero-pressure cell
+    grounded = np.abs(np.asarray(A.sum(axis=1)).reshape(-1)) > 1e-6 * np.abs(diagonal)
+    component_count, labels = scipy.sparse.csgraph.connected_components(off_diagonal != 0, directed=False)
+    floating = np.ones(component_count, bool)
+    floating[labels[grounded]] = False
+    _, first_cells = np.unique(labels, return_index=True)
+    pinned = first_cells[floating]
+    if len(pinned) > 0:
+        A = A + scipy.sparse.csc_matrix((diagonal[pinned], (pinned, pinned)), shape=A.shape)
+    return scipy.sparse.linalg.splu(A)
+
+
+class SubdomainProcessPool(object):
+
+    def __init__(self, workers, max_masks=4):
+        """
+        Worker processes holding factorized subdomain problems, see SchwarzPreconditioner.
+        Blocks are assigned to workers round-robin. Each worker keeps the factorizations of the max_masks most recently used masks.
+
+        :param workers: number of processes
+        :param max_masks: number of masks whose factorizations are kept by each worker
+        """
+        self.workers = workers
+        self.max_masks = max_masks
+        self._connections = []
+        self._processes = []
+        self._keys = OrderedDict()  # keys factorized by all workers, mirrors the LRU state of the workers
+        self._buffers = {}  # 'input' / 'output' -> SharedMemory
+        if shared_memory is not None:
+            from multiprocessing import resource_tracker
+            resource_tracker.ensure_running()  # workers must share the resource tracker that unlinks the shared memory
+        for _ in range(workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_subdomain_worker, args=(child, max_masks))
+            process.daemon = True
+            process.start()
+            child.close()
+            self._connections.append(parent)
+            self._processes.append(process)
+        _POOLS.add(self)
+
+    def solve(self, key, resolution, subdomains, rhs):
+        """
+        Solves all subdomain problems for the given right-hand sides.
+
+        :param key: cache key of the masks, see mask_key()
+        :param resolution: resolution of the whole grid
+        :param subdomains: list of (bounds, masks), see block_masks()
+        :param rhs: float64 array of shape (batch size, cells)
+        :return: list holding the solution of each block, arrays of shape (batch size, block cells)
+        """
+        if key in self._keys:
+            self._keys[key] = self._keys.pop(key)  # most recently used
+        else:
+            self._send_all([('factorize', key, resolution, [(i, subdomain) for i, subdomain in enumerate(subdomains) if i % self.workers == w]) for w in range(self.workers)])
+            self._keys[key] = True
+            while len(self._keys) > self.max_masks:
+                self._keys.popitem(last=False)
+        sizes = [int(np.prod([stop - start for start, stop in bounds])) for bounds, _ in subdomains]
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        batch = rhs.shape[0]
+        if shared_memory is None:
+            results = self._send_all([('solve', key, rhs, None) for _ in range(self.workers)])
+            output = {}
+            for worker_results in results:
+                output.update(worker_results)
+            return [output[i] for i in range(len(subdomains))]
+        input_array = self._shared_array('input', rhs.shape)
+        input_array[...] = rhs
+        output_array = self._shared_array('output', (batch, int(offsets[-1])))
+        specs = (self._buffers['input'].name, rhs.shape, self._buffers['output'].name, output_array.shape, offsets)
+        self._send_all([('solve', key, None, specs) for _ in range(self.workers)])
+        return [np.array(output_array[:, offsets[i]:offsets[i + 1]]) for i in range(len(subdomains))]
+
+    def _send_all(self, messages):
+        for connection, message in zip(self._connections, messages):
+            connection.send(message)
+        replies = [connection.recv() for connection in self._connections]
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    def _shared_array(self, name, shape):
+        nbytes = int(np.prod(shape)) * 8
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.size < nbytes:
+            if buffer is not None:
+                buffer.close()
+                buffer.unlink()
+            buffer = self._buffers[name] = shared_memory.SharedMemory(create=True, size=max(nbytes, 8))
+        return np.ndarray(shape, np.float64, buffer=buffer.buf)
+
+    def close(self):
+        for connection in self._connections:
+            try:
+                connection.send(None)
+                connection.close()
+            except (OSError, IOError):
+                pass
+        for process in self._processes:
+            process.join(timeout=1)
+        for buffer in self._buffers.values():
+            buffer.close()
+            buffer.unlink()
+        self._connections, self._processes, self._buffers = [], [], {}
+        self._keys.clear()
+
+    def __del__(self):
+        if self._processes:
+            self.close()
+
+
+_POOLS = weakref.WeakSet()
+
+
+@atexit.register
+def _close_pools():
+    for pool in list(_POOLS):
+        pool.close()
+
+
+def _subdomain_worker(connection, max_masks):
+    """ Main loop of a SubdomainProcessPool worker. """
+    factorizations = OrderedDict()  # key -> list of (block index, cell indices, SuperLU)
+    buffers = {}  # shared memory name -> SharedMemory
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        try:
+            command, key = message[:2]
+            if command == 'factorize':
+                resolution, subdomains = message[2:]
+                factorizations[key] = [(i, block_indices(resolution, bounds), factorize_subdomain(bounds, masks)) for i, (bounds, masks) in subdomains]
+                while len(factorizations) > max_masks:
+                    factorizations.popitem(last=False)
+                connection.send(True)
+            elif command == 'solve':
+                factorizations[key] = factorizations.pop(key)  # most recently used
+                rhs, specs = message[2:]
+                if specs is None:
+                    connection.send(dict((i, lu.solve(np.array(rhs[:, idx].T, order='F')).T) for i, idx, lu in factorizations[key]))
+                    continue
+                input_name, input_shape, output_name, output_shape, offsets = specs
+                input_buffer, output_buffer = _attach_buffers(buffers, [input_name, output_name])
+                rhs = np.ndarray(input_shape, np.float64, buffer=input_buffer.buf)
+                output = np.ndarray(output_shape, np.float64, buffer=output_buffer.buf)
+                for i, idx, lu in factorizations[key]:
+                    output[:, offsets[i]:offsets[i + 1]] = lu.solve(np.array(rhs[:, idx].T, order='F')).T
+                connection.send(True)
+        except Exception as exc:
+            connection.send(exc)
+    for buffer in buffers.values():
+        buffer.close()
+
+
+def _attach_buffers(buffers, names):
+    """ Attaches to the shared memory blocks with the given names and releases blocks that the pool has replaced. """
+    for name in list(buffers.keys()):
+        if name not in names:
+            buffers.pop(name).close()
+    for name in names:
+        if name not in buffers:
+            buffers[name] = shared_memory.SharedMemory(name=name)
+    return [buffers[name] for name in names]
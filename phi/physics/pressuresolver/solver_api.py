@@ -18,6 +18,7 @@ class PressureSolver(object):
         self.supports_guess = supports_guess
         self.supports_loop_counter = supports_loop_counter
         self.supports_continuous_masks = supports_continuous_masks
+        self.solve_info = {}  # details of the most recent solve, e.g. matrix assembly time. Returned by divergence_free(return_info=True)
 
     def solve(self, divergence, domain, pressure_guess):
         """
@@ -96,6 +97,19 @@ class FluidDomain(struct.Struct):
         result = math.pad(self.accessible.data, [[0,0]] + [[extend, extend]] * self.rank + [[0,0]], constant_values=pad_values)
         return result
 
+    def downsampled2x(self):
+        """
+        Creates a FluidDomain with half the resolution (rounded up) by linearly downsampling the active and accessible masks.
+        The resulting masks are continuous. Boundary conditions and the physical size are preserved.
+
+        :return: FluidDomain
+        """
+        resolution = [(n + 1) // 2 for n in self.domain.resolution]
+        domain = Domain(resolution, boundaries=self.domain.boundaries, box=self.domain.box)
+        active = self.active.copied_with(data=math.downsample2x(self.active.data), box=domain.box)
+        accessible = self.accessible.copied_with(data=math.downsample2x(self.accessible.data), box=domain.box)
+        return FluidDomain(domain, active=active, accessible=accessible)
+
     def with_hard_boundary_conditions(self, velocity):
         masked = velocity * self._frictionless_velocity_mask(velocity)
         return masked  # TODO add surface velocity
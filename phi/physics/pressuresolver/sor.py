@@ -0,0 +1,138 @@
+import time
+from numbers import Number
+
+import numpy as np
+
+from phi import math
+from .geom import pressure_stencil, apply_pressure_stencil
+from .metrics import ResidualHistory
+from .solver_api import PressureSolver, FluidDomain
+
+
+class SORSolver(PressureSolver):
+
+    def __init__(self, accuracy=1e-5, max_iterations=2000, omega='optimal', iterations=None, gradient_accuracy='same', residual_history=None):
+        """
+        Red-black successive over-relaxation (SOR).
+
+        Each sweep updates all red cells (odd sum of indices), then all black cells using the already updated red values.
+        Both half-sweeps are vectorized applications of the pressure stencil (see pressure_stencil()), so the solver runs on all backends.
+
+        SOR converges much slower than conjugate gradient or multigrid but every sweep has the same, small cost.
+        With a fixed number of iterations, the solver performs exactly that many sweeps without evaluating the residual,
+        giving a predictable cost per step for approximate projections, e.g. in interactive previews.
+
+        :param accuracy: the maximally allowed error on the divergence channel for each cell. Ignored if iterations is set.
+        :param max_iterations: maximum number of sweeps
+        :param omega: relaxation weight in (0, 2) or 'optimal' to use optimal_sor_omega() for the resolution. omega=1 yields red-black Gauss-Seidel.
+        :param iterations: (optional) fixed number of sweeps. If set, the residual is never evaluated.
+        :param gradient_accuracy: accuracy applied during backpropagation, number of 'same' to use forward accuracy
+        :param residual_history: (optional) sampling interval of the residual norm stored in solve_info['residual_history'], see SparseCG. Ignored if iterations is set.
+        """
+        PressureSolver.__init__(self, 'Red-black SOR',
+                                supported_devices=('CPU', 'GPU', 'TPU'),
+                                supports_guess=True, supports_loop_counter=True, supports_continuous_masks=True)
+        assert isinstance(accuracy, Number), 'invalid accuracy: %s' % accuracy
+        assert omega == 'optimal' or 0 < omega < 2, 'invalid omega: %s' % omega
+        assert gradient_accuracy == 'same' or isinstance(gradient_accuracy, Number), 'invalid gradient_accuracy: %s' % gradient_accuracy
+        self.accuracy = accuracy
+        self.gradient_accuracy = accuracy if gradient_accuracy == 'same' else gradient_accuracy
+        self.max_iterations = max_iterations
+        self.omega = omega
+        self.iterations = iterations
+        self.residual_history = residual_history
+
+    def solve(self, divergence, domain, pressure_guess):
+        assert isinstance(domain, FluidDomain)
+        resolution = [int(n) for n in domain.domain.resolution]
+        stencil = pressure_stencil(domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        red, black = red_black_masks(resolution)
+        omega = optimal_sor_omega(resolution) if self.omega == 'optimal' else self.omega
+        history = ResidualHistory(self.residual_history) if self.residual_history and self.iterations is None else None
+        solve_start = time.time()
+
+        def sor_forward(div, guess, accuracy, callback=None):
+            if self.iterations is not None:
+                return red_black_sor(guess, div, stencil, red, black, omega, self.iterations), self.iterations
+
+            def loop_condition(pressure, residual, _iterations):
+                return math.max(math.abs(residual)) >= accuracy
+
+            def loop_body(pressure, residual, iterations):
+                pressure = red_black_sor(pressure, div, stencil, red, black, omega, 1)
+                residual = div - apply_pressure_stencil(pressure, stencil)
+                if callback is not None and isinstance(residual, np.ndarray):
+                    callback(iterations + 1, residual)
+                return [pressure, residual, iterations + 1]
+
+            pressure = guess if guess is not None else math.zeros_like(div)
+            residual = div - apply_pressure_stencil(pressure, stencil)
+            pressure, _, iterations = math.while_loop(loop_condition, loop_body, [pressure, residual, 0],
+                                                      back_prop=False, name='sor_loop', maximum_iterations=self.max_iterations)
+            return pressure, iterations
+
+        def pressure_gradient(op, grad):
+            return sor_forward(grad, None, self.gradient_accuracy)[0]
+
+        pressure, iterations = math.with_custom_gradient(sor_forward, [divergence, pressure_guess, self.accuracy, history],
+                                                         pressure_gradient, input_index=0, output_index=0, name_base='sor_solve')
+        self.solve_info = {'solve_time': time.time() - solve_start, 'omega': omega}
+        if self.iterations is not None:
+            self.solve_info['converged'] = None  # fixed sweep count, the residual is never evaluated
+        elif history is not None and history.final is not None:
+            self.solve_info.update({'residual_history': history.samples, 'residual': history.final})
+        return pressure, iterations
+
+
+def optimal_sor_omega(resolution):
+    """
+    Estimates the optimal SOR relaxation weight for the pressure equation at the given resolution.
+
+    For the Poisson equation on a box with n_i cells along dimension i, the spectral radius of the Jacobi iteration is
+    rho = mean(cos(pi / (n_i + 1))) and the optimal weight is 2 / (1 + sqrt(1 - rho^2)).
+    Obstacles and boundary conditions change the spectrum so this is an estimate for general domains.
+
+    :param resolution: list of cell counts along each dimension
+    :return: relaxation weight in [1, 2)
+    """
+    rho = np.mean([np.cos(np.pi / (n + 1)) for n in resolution])
+    return float(2. / (1 + np.sqrt(1 - rho ** 2)))
+
+
+def red_black_masks(resolution):
+    """
+    Returns the masks of the red (odd sum of indices) and black cells of a grid.
+
+    :param resolution: list of cell counts along each dimension
+    :return: red mask, black mask, both float32 arrays of shape (1, resolution..., 1)
+    """
+    parity = np.sum(np.meshgrid(*[np.arange(n) for n in resolution], indexing='ij'), axis=0) % 2
+    red = parity.reshape([1] + list(resolution) + [1]).astype(np.float32)
+    return red, 1 - red
+
+
+def red_black_sor(x, rhs, stencil, red, black, omega, iterations):
+    """
+    Applies red-black SOR sweeps to the pressure equation A x = rhs where A is given by the stencil.
+
+    :param x: initial guess or None for zero
+    :param rhs: right-hand side of shape (batch size, spatial dimensions..., 1)
+    :param stencil: stencil weights as returned by pressure_stencil()
+    :param red: red cell mask, see red_black_masks()
+    :param black: black cell mask
+    :param omega: relaxation weight
+    :param iterations: number of sweeps
+    :return: updated x
+    """
+    diagonal = stencil[0]
+    if iterations <= 0:
+        return x if x is not None else math.zeros_like(rhs)
+    if x is None:
+        # with x = 0, the red half-sweep needs no stencil application
+        x = red * omega * rhs / diagonal
+        x = x + black * omega * (rhs - apply_pressure_stencil(x, stencil)) / diagonal
+        iterations -= 1
+    for _ in range(iterations):
+        for color in (red, black):
+            x = x + color * omega * (rhs - apply_pressure_stencil(x, stencil)) / diagonal
+    return x
@@ -1,4 +1,5 @@
 import logging
+import time
 from numbers import Number
 import numpy as np
 import scipy
@@ -6,38 +7,103 @@ import scipy.sparse
 import scipy.sparse.linalg
 
 from phi import math
-from phi.math.blas import conjugate_gradient
+from phi.math.blas import conjugate_gradient, refined_conjugate_gradient, RESIDUAL_NORMS
+from phi.math.parallel import BATCH_THREAD_POOL
+from .cache import OperatorCache, mask_key
+from .metrics import ResidualHistory
 from .solver_api import PressureSolver, FluidDomain
 
 
+PRESSURE_MATRIX_CACHE = OperatorCache(name='pressure matrix')
+PRESSURE_FACTORIZATION_CACHE = OperatorCache(max_bytes=1024 ** 3, name='pressure factorization')
+SPARSE_INDEX_CACHE = OperatorCache(name='sparse pressure indices')
+
+
 class SparseSciPy(PressureSolver):
 
-    def __init__(self):
+    def __init__(self, factorize=False, matrix_cache=PRESSURE_MATRIX_CACHE, factorization_cache=PRESSURE_FACTORIZATION_CACHE, batch_pool=BATCH_THREAD_POOL):
         """
         The SciPy solver uses the function scipy.sparse.linalg.spsolve to determine the pressure.
         It does not support initial guesses for the pressure and does not keep track of a loop counter.
+
+        With factorize=True, the solver computes a sparse LU factorization (scipy.sparse.linalg.splu) once per distinct
+        pressure matrix and reuses it for all examples of a batch, all subsequent time steps with the same masks and the backward pass.
+
+        :param factorize: if True, solve by back-substitution using a cached LU factorization instead of calling spsolve for every example
+        :param matrix_cache: OperatorCache storing assembled pressure matrices or None to assemble the matrix in every solve
+        :param factorization_cache: OperatorCache storing LU factorizations if factorize=True or None to factorize in every solve
+        :param batch_pool: BatchThreadPool solving the examples of a batch in parallel threads (spsolve) or None to solve them sequentially.
+          Results do not depend on the number of threads.
         """
         PressureSolver.__init__(self, 'SciPy sparse solver',
                                 supported_devices=('CPU',),
                                 supports_guess=False, supports_loop_counter=False, supports_continuous_masks=True)
+        self.factorize = factorize
+        self.matrix_cache = matrix_cache
+        self.factorization_cache = factorization_cache
+        self.batch_pool = batch_pool
 
     def solve(self, divergence, domain, pressure_guess):
         assert isinstance(domain, FluidDomain)
         dimensions = list(divergence.shape[1:-1])
-        A = sparse_pressure_matrix(dimensions, domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        active_mask = domain.active_tensor(extend=1)
+        fluid_mask = domain.accessible_tensor(extend=1)
+        assembly_start = time.time()
+        A = cached_pressure_matrix(dimensions, active_mask, fluid_mask, self.matrix_cache)
+        self.solve_info = {'assembly_time': time.time() - assembly_start, 'nnz': A.nnz}
+        if self.factorize:
+            factorization_start = time.time()
+            factorize = lambda: scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(A, dtype=np.float64))
+            if self.factorization_cache is None:
+                lu = factorize()
+            else:
+                lu = self.factorization_cache.get_or_create(mask_key(dimensions, active_mask, fluid_mask), factorize, nbytes=_lu_nbytes)
+            self.solve_info['factorization_time'] = time.time() - factorization_start
+        else:
+            lu = None
 
-        def np_solve_p(div):
+        def np_solve_p(div, transpose=False):
             div_vec = div.reshape([-1, A.shape[0]])
-            pressure = [scipy.sparse.linalg.spsolve(A, div_vec[i, ...]) for i in range(div_vec.shape[0])]
+            if lu is not None:
+                # all examples are solved in one multi-RHS back-substitution, the transposed system shares the factors
+                pressure = lu.solve(np.array(div_vec.T, np.float64, order='F'), trans='T' if transpose else 'N').T
+            else:
+                A_ = A.T if transpose else A
+                solve_example = lambda i: scipy.sparse.linalg.spsolve(A_, div_vec[i, ...])
+                if self.batch_pool is None:
+                    pressure = [solve_example(i) for i in range(div_vec.shape[0])]
+                else:
+                    pressure = self.batch_pool.map(solve_example, div_vec.shape[0])
             return np.array(pressure).reshape(div.shape).astype(np.float32)
 
         def np_solve_p_gradient(op, grad_in):
-            return math.py_func(np_solve_p, [grad_in], np.float32, divergence.shape)
+            return math.py_func(lambda grad: np_solve_p(grad, transpose=True), [grad_in], np.float32, divergence.shape)
 
         pressure = math.py_func(np_solve_p, [divergence], np.float32, divergence.shape, grad=np_solve_p_gradient)
         return pressure, None
 
 
+def _lu_nbytes(lu):
+    return (lu.L.nnz + lu.U.nnz) * (8 + 4) + (lu.L.shape[0] + 1) * 4 * 2 + lu.perm_r.nbytes + lu.perm_c.nbytes
+
+
+def cached_pressure_matrix(dimensions, extended_active_mask, extended_fluid_mask, cache=PRESSURE_MATRIX_CACHE):
+    """
+    Returns the pressure matrix for the given masks, reusing a previously assembled matrix if the masks did not change.
+    Matrices are only cached for NumPy masks.
+
+    :param dimensions: valid simulation dimensions
+    :param extended_active_mask: Binary tensor with 2 more entries in every dimension than 'dimensions'.
+    :param extended_fluid_mask: Binary tensor with 2 more entries in every dimension than 'dimensions'.
+    :param cache: OperatorCache or None to always assemble the matrix
+    :return: SciPy sparse matrix, see sparse_pressure_matrix()
+    """
+    if cache is None:
+        return sparse_pressure_matrix(dimensions, extended_active_mask, extended_fluid_mask)
+    key = mask_key(dimensions, extended_active_mask, extended_fluid_mask)
+    return cache.get_or_create(key, lambda: sparse_pressure_matrix(dimensions, extended_active_mask, extended_fluid_mask))
+
+
 def sparse_pressure_matrix(dimensions, extended_active_mask, extended_fluid_mask):
     """
     Builds a sparse matrix such that when applied to a flattened pressure channel, it calculates the laplace
@@ -46,61 +112,27 @@ def sparse_pressure_matrix(dimensions, extended_active_mask, extended_fluid_mask
     :param dimensions: valid simulation dimensions. Pressure channel should be of shape (batch size, dimensions..., 1)
     :param extended_active_mask: Binary tensor with 2 more entries in every dimension than 'dimensions'.
     :param extended_fluid_mask: Binary tensor with 2 more entries in every dimension than 'dimensions'.
-    :return: SciPy sparse matrix that acts as a laplace on a flattened pressure channel given obstacles and empty cells
+    :return: SciPy CSR matrix that acts as a laplace on a flattened pressure channel given obstacles and empty cells
     """
     N = int(np.prod(dimensions))
-    d = len(dimensions)
-    A = scipy.sparse.lil_matrix((N, N), dtype=np.float32)
-    dims = range(d)
-
-    center_values = None # diagonal matrix entries
-
-    gridpoints_linear = np.arange(N)
-    gridpoints = np.stack(np.unravel_index(gridpoints_linear, dimensions))  # d * (N^2) array mapping from linear to spatial frames
-
-    for dim in dims:
-        upper_indices = tuple([slice(None)] + [slice(2, None) if i == dim else slice(1, -1) for i in dims] + [slice(None)])
-        center_indices = tuple([slice(None)] + [slice(1, -1) if i == dim else slice(1, -1) for i in dims] + [slice(None)])
-        lower_indices = tuple([slice(None)] + [slice(0, -2) if i == dim else slice(1, -1) for i in dims] + [slice(None)])
-
-        self_active = extended_active_mask[center_indices]
-        stencil_upper = extended_active_mask[upper_indices] * self_active
-        stencil_lower = extended_active_mask[lower_indices] * self_active
-        stencil_center = - extended_fluid_mask[upper_indices] - extended_fluid_mask[lower_indices]
-
-        if center_values is None:
-            center_values = math.flatten(stencil_center)
-        else:
-            center_values = center_values + math.flatten(stencil_center)
-
-        # Find entries in matrix
-        dim_direction = np.zeros_like(gridpoints)
-        dim_direction[dim] = 1
-        # Upper frames
-        upper_indices = gridpoints + dim_direction
-        upper_in_range_inx = np.nonzero(upper_indices[dim] < dimensions[dim])
-        upper_indices_linear = np.ravel_multi_index(upper_indices[:, upper_in_range_inx], dimensions)
-        A[gridpoints_linear[upper_in_range_inx], upper_indices_linear] = stencil_upper.flatten()[upper_in_range_inx]
-        # Lower frames
-        lower_indices = gridpoints - dim_direction
-        lower_in_range_inx = np.nonzero(lower_indices[dim] >= 0)
-        lower_indices_linear = np.ravel_multi_index(lower_indices[:, lower_in_range_inx], dimensions)
-        A[gridpoints_linear[lower_in_range_inx], lower_indices_linear] = stencil_lower.flatten()[lower_in_range_inx]
-
-    A[gridpoints_linear, gridpoints_linear] = math.minimum(center_values, -1)
-
-    return scipy.sparse.csc_matrix(A)
+    indices, sorting = cached_sparse_indices(dimensions)
+    values = sparse_values(dimensions, extended_active_mask, extended_fluid_mask, sorting)
+    # indices are sorted by row, then column which is the CSR layout
+    row_pointers = np.concatenate([[0], np.cumsum(np.bincount(indices[:, 0], minlength=N))])
+    return scipy.sparse.csr_matrix((values, indices[:, 1], row_pointers), shape=(N, N))
 
 
 class SparseCG(PressureSolver):
 
     def __init__(self, accuracy=1e-5, gradient_accuracy='same',
                  max_iterations=2000, max_gradient_iterations='same',
-                 autodiff=False):
+                 autodiff=False, matrix_cache=PRESSURE_MATRIX_CACHE, preconditioner=None,
+                 per_example=False, compact_batch=False, mixed_precision=False, norm='max', relative=False, index_cache=SPARSE_INDEX_CACHE,
+                 residual_history=None):
         """
         Conjugate gradient solver using sparse matrix multiplications.
 
-        :param accuracy: the maximally allowed error on the divergence channel for each cell
+        :param accuracy: the maximally allowed norm of the residual of the divergence channel, see norm and relative
         :param gradient_accuracy: accuracy applied during backpropagation, number of 'same' to use forward accuracy
         :param max_iterations: integer specifying maximum conjugent gradient loop iterations or None for no limit
         :param max_gradient_iterations: maximum loop iterations during backpropagation,
@@ -110,6 +142,19 @@ class SparseCG(PressureSolver):
             The intermediate results of each loop iteration will be permanently stored if backpropagation is used.
             If False, replaces autodiff by a forward pressure solve in reverse accumulation backpropagation.
             This requires less memory but is only accurate if the solution is fully converged.
+        :param matrix_cache: OperatorCache storing assembled pressure matrices (SciPy only) or None to assemble the matrix in every solve
+        :param index_cache: OperatorCache storing the sparse matrix indices per resolution (other backends) or None to compute them in every solve
+        :param preconditioner: (optional) Preconditioner, e.g. JacobiPreconditioner, IncompleteLUPreconditioner or MultigridPreconditioner
+        :param per_example: if True, examples of a batch stop iterating individually once they have converged.
+            The iteration count of each example is stored in solve_info['example_iterations'].
+        :param compact_batch: with per_example=True and NumPy, removes converged examples from the batch instead of masking them, see conjugate_gradient()
+        :param mixed_precision: SciPy only. If True, iterates in single precision and periodically recomputes the true residual in float64,
+            restarting CG on the remaining residual (see refined_conjugate_gradient()). This reaches accuracies at which single precision CG stagnates.
+        :param norm: norm of the residual compared against accuracy, 'max' (largest error of any cell), 'l2' or 'rms', see conjugate_gradient()
+        :param relative: if True, the accuracy is relative to the norm of the divergence of each example, ‖r‖ ≤ accuracy ‖∇·v‖.
+            With norm='max', the allowed error scales with the largest divergence, which avoids wasted iterations on nearly quiescent frames.
+        :param residual_history: (optional) sampling interval. If set, the residual norm of NumPy solves is recorded every residual_history iterations
+            and stored in solve_info['residual_history'] as list of (iteration, norm). The final norm is stored in solve_info['residual'].
         """
         PressureSolver.__init__(self, 'Sparse Conjugate Gradient',
                                 supported_devices=('CPU', 'GPU'),
@@ -127,7 +172,18 @@ class SparseCG(PressureSolver):
         else:
             self.max_gradient_iterations = max_gradient_iterations
             assert not autodiff, 'Cannot specify max_gradient_iterations when autodiff=True'
+        assert not (mixed_precision and autodiff), 'mixed_precision does not support autodiff'
+        assert norm in RESIDUAL_NORMS, 'invalid norm: %s' % norm
         self.autodiff = autodiff
+        self.matrix_cache = matrix_cache
+        self.index_cache = index_cache
+        self.preconditioner = preconditioner
+        self.per_example = per_example
+        self.compact_batch = compact_batch
+        self.mixed_precision = mixed_precision
+        self.norm = norm
+        self.relative = relative
+        self.residual_history = residual_history
 
     def solve(self, divergence, domain, pressure_guess):
         assert isinstance(domain, FluidDomain)
@@ -136,67 +192,122 @@ class SparseCG(PressureSolver):
         dimensions = list(divergence.shape[1:-1])
         N = int(np.prod(dimensions))
 
+        assembly_start = time.time()
         if math.choose_backend(divergence).matches_name('SciPy'):
-            A = sparse_pressure_matrix(dimensions, active_mask, fluid_mask)
+            A = cached_pressure_matrix(dimensions, active_mask, fluid_mask, self.matrix_cache)
+            nnz = A.nnz
         else:
-            sidx, sorting = sparse_indices(dimensions)
+            sidx, sorting = cached_sparse_indices(dimensions, self.index_cache)  # only the values depend on the masks
             sval_data = sparse_values(dimensions, active_mask, fluid_mask, sorting)
             A = math.choose_backend(divergence).sparse_tensor(indices=sidx, values=sval_data, shape=[N, N])
-
+            nnz = len(sidx)
+        self.solve_info = {'assembly_time': time.time() - assembly_start, 'nnz': nnz}
+        preconditioner = self.preconditioner.bind(domain, A) if self.preconditioner is not None else None
+
+        if self.mixed_precision:
+            assert scipy.sparse.issparse(A), 'mixed_precision is only supported by the SciPy backend'
+        cg_options = (self.per_example, self.compact_batch, self.mixed_precision, self.norm, self.relative)
+        history = ResidualHistory(self.residual_history, self.norm) if self.residual_history else None
+        solve_start = time.time()
         if self.autodiff:
-            return sparse_cg(divergence, A, self.max_iterations, pressure_guess, self.accuracy, back_prop=True)
+            pressure, iteration = sparse_cg(divergence, A, self.max_iterations, pressure_guess, self.accuracy, True, preconditioner, *cg_options, callback=history)
         else:
             def pressure_gradient(op, grad):
-                return sparse_cg(grad, A, max_gradient_iterations, None, self.gradient_accuracy)[0]
+                return sparse_cg(grad, A, max_gradient_iterations, None, self.gradient_accuracy, False, preconditioner, *cg_options)[0]
 
             pressure, iteration = math.with_custom_gradient(sparse_cg,
-                                                            [divergence, A, self.max_iterations, pressure_guess, self.accuracy],
+                                                            [divergence, A, self.max_iterations, pressure_guess, self.accuracy, False, preconditioner] + list(cg_options) + [history],
                                                             pressure_gradient, input_index=0, output_index=0,
                                                             name_base='scg_pressure_solve')
 
-            max_gradient_iterations = iteration if self.max_gradient_iterations == 'mirror' else self.max_gradient_iterations
-            return pressure, iteration
+            max_gradient_iterations = math.max(iteration) if self.max_gradient_iterations == 'mirror' else self.max_gradient_iterations
+        self.solve_info['solve_time'] = time.time() - solve_start
+        if history is not None and history.final is not None:
+            self.solve_info.update({'residual_history': history.samples, 'residual': history.final})
+        if self.per_example:
+            self.solve_info['example_iterations'] = iteration
+            iteration = math.max(iteration)
+        return pressure, iteration
 
 
-def sparse_cg(divergence, A, max_iterations, guess, accuracy, back_prop=False):
+def sparse_cg(divergence, A, max_iterations, guess, accuracy, back_prop=False, preconditioner=None, per_example=False, compact=False, mixed_precision=False, norm='max', relative=False,
+              callback=None):
     div_vec = math.reshape(divergence, [-1, int(np.prod(divergence.shape[1:]))])
     if guess is not None:
         guess = math.reshape(guess, [-1, int(np.prod(divergence.shape[1:]))])
     apply_A = lambda pressure: math.matmul(A, pressure)
-    result_vec, iterations = conjugate_gradient(div_vec, apply_A, guess, accuracy, max_iterations, back_prop)
+    if preconditioner is not None:
+        grid_shape = [-1] + list(divergence.shape[1:])
+        flat_preconditioner = lambda residual: math.reshape(preconditioner(math.reshape(residual, grid_shape)), math.shape(residual))
+    else:
+        flat_preconditioner = None
+    if mixed_precision:
+        A_high = scipy.sparse.csr_matrix(A, dtype=np.float64)
+        apply_A_high = lambda pressure: A_high.dot(pressure.T).T
+        result_vec, iterations = refined_conjugate_gradient(div_vec, apply_A, apply_A_high, guess, accuracy, max_iterations, flat_preconditioner, per_example=per_example, norm=norm, relative=relative, callback=callback)
+    else:
+        result_vec, iterations = conjugate_gradient(div_vec, apply_A, guess, accuracy, max_iterations, back_prop, preconditioner=flat_preconditioner, per_example=per_example, compact=compact, norm=norm, relative=relative, callback=callback)
     return math.reshape(result_vec, math.shape(divergence)), iterations
 
 
+def cached_sparse_indices(dimensions, cache=SPARSE_INDEX_CACHE):
+    """
+    Returns the indices and sorting computed by sparse_indices(), reusing previous results for the same resolution.
+    The returned arrays are shared between calls and must not be modified.
+
+    :param dimensions: valid simulation dimensions
+    :param cache: OperatorCache or None to always compute the indices
+    :return: sorted indices of shape (nnz, 2), permutation mapping the values computed by sparse_values() to the sorted indices
+    """
+    if cache is None:
+        return sparse_indices(dimensions)
+
+    def create():
+        indices, sorting = sparse_indices(dimensions)
+        indices.flags.writeable = False
+        sorting.flags.writeable = False
+        return indices, sorting
+    return cache.get_or_create(mask_key(dimensions), create)
+
+
 def sparse_indices(dimensions):
+    """
+    Computes the matrix indices of all non-zero entries of the pressure matrix, see sparse_pressure_matrix().
+
+    The indices are generated per stencil diagonal and are already sorted by row, then column (CSR order).
+
+    :param dimensions: valid simulation dimensions
+    :return: sorted indices of shape (nnz, 2), permutation mapping the values computed by sparse_values() to the sorted indices
+    """
     N = int(np.prod(dimensions))
     d = len(dimensions)
     dims = range(d)
 
     gridpoints_linear = np.arange(N)
-    gridpoints = np.stack(np.unravel_index(gridpoints_linear, dimensions)) # d * (N^2) array mapping from linear to spatial frames
-
-    indices_list = [np.stack([gridpoints_linear] * 2, axis=-1)]
+    gridpoints = np.unravel_index(gridpoints_linear, dimensions)  # d arrays mapping from linear to spatial frames
+    strides = [int(np.prod(dimensions[dim + 1:])) for dim in dims]
 
+    # Positions of the entries within the concatenated values of sparse_values(): center, then (upper, lower) for each dimension
+    center = (gridpoints_linear, np.ones(N, bool), gridpoints_linear)
+    upper, lower = [], []
+    value_count = N
     for dim in dims:
-        dim_direction = np.zeros_like(gridpoints)
-        dim_direction[dim] = 1
-        # Upper frames
-        upper_indices = gridpoints + dim_direction
-        upper_in_range_inx = np.nonzero(upper_indices[dim] < dimensions[dim])
-        upper_indices_linear = np.ravel_multi_index(upper_indices[:, upper_in_range_inx], dimensions)[0, :]
-        indices_list.append(np.stack([gridpoints_linear[upper_in_range_inx], upper_indices_linear], axis=-1))
-        # Lower frames
-        lower_indices = gridpoints - dim_direction
-        lower_in_range_inx = np.nonzero(lower_indices[dim] >= 0)
-        lower_indices_linear = np.ravel_multi_index(lower_indices[:, lower_in_range_inx], dimensions)[0, :]
-        indices_list.append(np.stack([gridpoints_linear[lower_in_range_inx], lower_indices_linear], axis=-1))
-
-    indices = np.concatenate(indices_list, axis=0)
-
-    sorting = np.lexsort(np.transpose(indices)[:, ::-1])
-
-    sorted_indices = indices[sorting]
-
+        for direction, diagonals in ((1, upper), (-1, lower)):
+            in_range = gridpoints[dim] < dimensions[dim] - 1 if direction > 0 else gridpoints[dim] > 0
+            positions = np.full(N, -1, np.int64)
+            positions[in_range] = np.arange(value_count, value_count + np.count_nonzero(in_range))
+            value_count += np.count_nonzero(in_range)
+            diagonals.append((gridpoints_linear + direction * strides[dim], in_range, positions))
+
+    # Within a row, columns increase from the lower neighbour in the first dimension to the upper neighbour in the first dimension
+    diagonals = lower + [center] + upper[::-1]
+    columns = np.stack([diagonal[0] for diagonal in diagonals], axis=-1)
+    valid = np.stack([diagonal[1] for diagonal in diagonals], axis=-1)
+    positions = np.stack([diagonal[2] for diagonal in diagonals], axis=-1)
+    rows = np.repeat(gridpoints_linear, valid.sum(axis=-1))
+
+    sorted_indices = np.stack([rows, columns[valid]], axis=-1).astype(np.int64)
+    sorting = positions[valid]
     return sorted_indices, sorting
 
 
@@ -210,16 +321,12 @@ def sparse_values(dimensions, extended_active_mask, extended_fluid_mask, sorting
     :param extended_fluid_mask: Binary tensor with 2 more entries in every dimension than 'dimensions'.
     :return: SciPy sparse matrix that acts as a laplace on a flattened pressure channel given obstacles and empty cells
     """
-    N = int(np.prod(dimensions))
     d = len(dimensions)
     dims = range(d)
 
     values_list = []
     center_values = None # diagonal matrix entries
 
-    gridpoints_linear = np.arange(N)
-    gridpoints = np.stack(np.unravel_index(gridpoints_linear, dimensions)) # d * (N^2) array mapping from linear to spatial frames
-
     for dim in dims:
         upper_indices = tuple([slice(None)] + [slice(2, None) if i == dim else slice(1, -1) for i in dims] + [slice(None)])
         center_indices = tuple([slice(None)] + [slice(1, -1) if i == dim else slice(1, -1) for i in dims] + [slice(None)])
@@ -235,16 +342,12 @@ def sparse_values(dimensions, extended_active_mask, extended_fluid_mask, sorting
         else:
             center_values = center_values + math.flatten(stencil_center)
 
-        dim_direction = np.zeros_like(gridpoints)
-        dim_direction[dim] = 1
-        # Upper frames
-        upper_indices = gridpoints + dim_direction
-        upper_in_range_inx = np.nonzero(upper_indices[dim] < dimensions[dim])[0]
-        values_list.append(math.gather(math.flatten(stencil_upper), upper_in_range_inx))
-        # Lower frames
-        lower_indices = gridpoints - dim_direction
-        lower_in_range_inx = np.nonzero(lower_indices[dim] >= 0)[0]
-        values_list.append(math.gather(math.flatten(stencil_lower), lower_in_range_inx))
+        # Upper frames: all cells except the last along dim, in linear order
+        upper_in_range = tuple([slice(None)] + [slice(None, -1) if i == dim else slice(None) for i in dims] + [slice(None)])
+        values_list.append(math.flatten(stencil_upper[upper_in_range]))
+        # Lower frames: all cells except the first along dim, in linear order
+        lower_in_range = tuple([slice(None)] + [slice(1, None) if i == dim else slice(None) for i in dims] + [slice(None)])
+        values_list.append(math.flatten(stencil_lower[lower_in_range]))
 
     center_values = math.minimum(center_values, -1.)
     values_list.insert(0, center_values)
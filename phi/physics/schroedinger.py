@@ -59,8 +59,11 @@ class Schroedinger(Physics):
 
         # Move by rotating in Fourier space
         amplitude_fft = math.fft(amplitude)
-        laplace = math.fftfreq(state.resolution, mode='square')
-        amplitude_fft *= math.exp(-1j * (2 * np.pi)**2 * math.to_complex(dt) * laplace / (2 * state.mass))
+
+        def propagator():
+            laplace = math.fftfreq(state.resolution, mode='square')
+            return math.exp(-1j * (2 * np.pi)**2 * math.to_complex(dt) * laplace / (2 * state.mass))
+        amplitude_fft *= math.spectral_kernel(('schroedinger', tuple(int(n) for n in state.resolution), dt, state.mass), propagator)
         amplitude = math.ifft(amplitude_fft)
 
         obstacle_mask = union_mask([obstacle.geometry for obstacle in obstacles]).at(state.amplitude).data
@@ -57,7 +57,8 @@ class TFBackend(Backend):
     def concat(self, values, axis):
         return tf.concat(values, axis)
 
-    def pad(self, value, pad_width, mode='constant', constant_values=0):
+    def pad(self, value, pad_width, mode='constant', constant_values=0, out=None):
+        assert out is None, 'TensorFlow does not support out'
         dims = range(len(self.staticshape(value)))
         if isinstance(mode, six.string_types) and len(self.staticshape(constant_values)) == 0:
             return self._single_mode_single_constant_pad(value, pad_width, mode, constant_values)
@@ -145,7 +146,8 @@ class TFBackend(Backend):
             result.set_shape(shape_out)
         return result
 
-    def resample(self, inputs, sample_coords, interpolation='linear', boundary='constant'):
+    def resample(self, inputs, sample_coords, interpolation='linear', boundary='constant', out=None):
+        assert out is None, 'TensorFlow does not support out'
         if boundary.lower() == 'constant':
             boundary = 'zero'
         boundary_func = SUPPORTED_BOUNDARY[boundary.lower()]
@@ -230,7 +232,8 @@ class TFBackend(Backend):
     def exp(self, x):
         return tf.exp(x)
 
-    def conv(self, tensor, kernel, padding="SAME"):
+    def conv(self, tensor, kernel, padding="SAME", out=None):
+        assert out is None, 'TensorFlow does not support out'
         rank = tensor_spatial_rank(tensor)
         padding = padding.upper()
         if rank == 1:
@@ -342,6 +345,32 @@ class TFBackend(Backend):
         else:
             raise NotImplementedError('n-dimensional inverse FFT not implemented.')
 
+    def rfft(self, x):
+        rank = len(x.shape) - 2
+        assert rank >= 1
+        x = self.to_float(x)
+        if rank == 1:
+            return tf.stack([tf.spectral.rfft(c) for c in tf.unstack(x, axis=-1)], axis=-1)
+        elif rank == 2:
+            return tf.stack([tf.spectral.rfft2d(c) for c in tf.unstack(x, axis=-1)], axis=-1)
+        elif rank == 3:
+            return tf.stack([tf.spectral.rfft3d(c) for c in tf.unstack(x, axis=-1)], axis=-1)
+        else:
+            raise NotImplementedError('n-dimensional real FFT not implemented.')
+
+    def irfft(self, k, resolution):
+        rank = len(k.shape) - 2
+        assert rank >= 1
+        resolution = [int(n) for n in resolution]
+        if rank == 1:
+            return tf.stack([tf.spectral.irfft(c, resolution) for c in tf.unstack(k, axis=-1)], axis=-1)
+        elif rank == 2:
+            return tf.stack([tf.spectral.irfft2d(c, resolution) for c in tf.unstack(k, axis=-1)], axis=-1)
+        elif rank == 3:
+            return tf.stack([tf.spectral.irfft3d(c, resolution) for c in tf.unstack(k, axis=-1)], axis=-1)
+        else:
+            raise NotImplementedError('n-dimensional inverse real FFT not implemented.')
+
     def imag(self, complex):
         return tf.imag(complex)
 
@@ -43,7 +43,8 @@ class TorchBackend(Backend):
     def concat(self, values, axis):
         return torch.cat(values, dim=axis)
 
-    def pad(self, value, pad_width, mode='constant', constant_values=0):
+    def pad(self, value, pad_width, mode='constant', constant_values=0, out=None):
+        assert out is None, 'PyTorch does not support out'
         mode = mode.lower()
         if mode == 'wrap':
             warnings.warn("'wrap' is deprecated, use 'circular' instead", DeprecationWarning, stacklevel=2)
@@ -86,7 +87,8 @@ class TorchBackend(Backend):
     def py_func(self, func, inputs, Tout, shape_out, stateful=True, name=None, grad=None):
         raise NotImplementedError()
 
-    def resample(self, inputs, sample_coords, interpolation='linear', boundary='constant'):
+    def resample(self, inputs, sample_coords, interpolation='linear', boundary='constant', out=None):
+        assert out is None, 'PyTorch does not support out'
         inputs = channels_first(self.as_tensor(inputs))
         sample_coords = self.as_tensor(sample_coords)
         # --- Interpolation ---
@@ -182,7 +184,8 @@ class TorchBackend(Backend):
     def exp(self, x):
         return torch.exp(x)
 
-    def conv(self, tensor, kernel, padding='same'):
+    def conv(self, tensor, kernel, padding='same', out=None):
+        assert out is None, 'PyTorch does not support out'
         tensor = self.as_tensor(tensor)
         kernel = self.as_tensor(kernel)
         if padding.lower() == 'valid':
@@ -0,0 +1,46 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy
+
+from phi.benchmark.pressure import SCENARIOS, benchmark_divergence, compare_results, load_results, main, run_benchmark, save_results
+
+
+class TestBenchmark(TestCase):
+
+    def test_scenarios(self):
+        for name, scenario in SCENARIOS.items():
+            for resolution in ([16, 16], [8, 8, 8]):
+                domain = scenario(resolution)
+                self.assertEqual(list(domain.domain.resolution), resolution, name)
+                divergence = benchmark_divergence(domain, 2)
+                self.assertEqual(divergence.shape, tuple([2] + resolution + [1]))
+                numpy.testing.assert_equal(divergence * (1 - domain.active.data), 0)
+
+    def test_run_and_compare(self):
+        records = run_benchmark(['SparseCG', 'GeometricCG'], ['open_box', 'maze'], resolutions=[[16, 16], [8, 8, 8]], batch_sizes=[1, 2])
+        self.assertEqual(len(records), 2 * 2 * 2 * 2)
+        for record in records:
+            self.assertNotIn('error', record)
+            self.assertLess(record['residual'], 1e-3)
+            self.assertGreater(record['iterations'], 0)
+        path = os.path.join(tempfile.mkdtemp(), 'results.json')
+        save_results(records, path)
+        loaded = load_results(path)
+        self.assertEqual(compare_results(records, loaded), [])
+        slower = json.loads(json.dumps(loaded))
+        slower[0]['wall_time'] = records[0]['wall_time'] * 2 + 1
+        slower[1]['iterations'] = records[1]['iterations'] * 2
+        slower[2] = dict(slower[2], error='RuntimeError: diverged')
+        regressions = compare_results(records, slower)
+        self.assertEqual(len(regressions), 3)
+
+    def test_command_line(self):
+        directory = tempfile.mkdtemp()
+        baseline, current = os.path.join(directory, 'baseline.json'), os.path.join(directory, 'current.json')
+        arguments = ['--solvers', 'SparseSciPy', '--scenarios', 'closed_box', '--resolutions', '8x8', '--batch-sizes', '1']
+        self.assertEqual(main(['run', baseline] + arguments), 0)
+        self.assertEqual(main(['run', current] + arguments), 0)
+        self.assertEqual(main(['compare', baseline, current, '--time-tolerance', '1000']), 0)
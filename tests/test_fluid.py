@@ -8,7 +8,8 @@ from phi.physics.domain import Domain
 from phi.physics.field import StaggeredGrid
 from phi.physics.field.effect import Fan, Inflow
 from phi.physics.material import CLOSED, OPEN
-from phi.physics.fluid import Fluid, INCOMPRESSIBLE_FLOW, IncompressibleFlow
+from phi.physics.obstacle import Obstacle
+from phi.physics.fluid import Fluid, INCOMPRESSIBLE_FLOW, IncompressibleFlow, divergence_free, fluid_domain
 from phi.physics.pressuresolver.sparse import SparseCG
 from phi.physics.world import World
 
@@ -94,4 +95,44 @@ class TestFluid(TestCase):
 
         numpy.testing.assert_equal(d1, d2)
         numpy.testing.assert_equal(vy1, vy2)
-        numpy.testing.assert_equal(vx1, vx2)
\ No newline at end of file
+        numpy.testing.assert_equal(vx1, vx2)
+
+    def test_warm_start(self):
+        def simulate(physics):
+            world = World()
+            fluid = world.add(Fluid(Domain([32, 32], boundaries=CLOSED), buoyancy_factor=0.1), physics=physics)
+            world.add(Inflow(Sphere((6, 16), radius=4), rate=0.2))
+            iterations = []
+            for _ in range(6):
+                world.step(dt=0.25)
+                iterations.append(fluid.solve_info['iterations'])
+            return sum(iterations)
+
+        cold = simulate(IncompressibleFlow())
+        self.assertLess(simulate(IncompressibleFlow(warm_start=True, extrapolate_pressure=True)), cold)
+        self.assertLessEqual(simulate(IncompressibleFlow(warm_start=True)), cold)
+
+    def test_pressure_guess_resolution_change(self):
+        velocity = Fluid(Domain([16, 16]), velocity=lambda s: math.randn(s)).velocity
+        _, info = divergence_free(velocity, return_info=True)
+        guess = numpy.ones([1, 8, 8, 1], numpy.float32)
+        _, guessed_info = divergence_free(velocity, return_info=True, pressure_guess=guess)
+        numpy.testing.assert_equal(info['iterations'], guessed_info['iterations'])
+        _, warm_info = divergence_free(velocity, return_info=True, pressure_guess=info['pressure'])
+        self.assertLess(warm_info['iterations'], info['iterations'])
+        # the warm start keeps pressure / dx, the unknown of the solver, if the cell size changes between steps
+        physics = IncompressibleFlow(warm_start=True)
+        fluid = Fluid(Domain([16, 16], box=AABox(0, [16, 16])), velocity=velocity.staggered_tensor())
+        physics.step(fluid, dt=0.)
+        large = Domain([16, 16], box=AABox(0, [32, 32]))
+        large_velocity = Fluid(large, velocity=velocity.staggered_tensor()).velocity
+        guess = physics._pressure_guess(fluid.name, 0., fluid_domain(large_velocity, large), large_velocity.dx[0])
+        numpy.testing.assert_allclose(guess / 2., fluid.solve_info['pressure'].data, rtol=1e-5)
+        _, cold_info = divergence_free(large_velocity, large, return_info=True)
+        _, warm_info = divergence_free(large_velocity, large, return_info=True, pressure_guess=guess)
+        self.assertLess(warm_info['iterations'], cold_info['iterations'] / 4)
+        # cells covered by a new obstacle are reset
+        blocked = fluid_domain(large_velocity, large, [Obstacle(AABox([0, 0], [16, 16]))])
+        guess = physics._pressure_guess(fluid.name, 0., blocked, large_velocity.dx[0])
+        numpy.testing.assert_equal(guess[:, :8, :8, :], 0)
+        numpy.testing.assert_allclose(guess[:, 8:, 8:, :] / 2., fluid.solve_info['pressure'].data[:, 8:, 8:, :], rtol=1e-5)
@@ -106,3 +106,153 @@ class TestMath(TestCase):
         y = tf.convert_to_tensor(y)
         result = divide_no_nan(x, y).eval()
         np.testing.assert_equal(result, [1, -0.5, 0, 0, 0])
+
+    def test_resample(self):
+        import scipy.interpolate
+        random = np.random.RandomState(0)
+        for shape in ([2, 7, 1], [2, 6, 5, 2], [1, 4, 5, 3, 3]):
+            inputs = random.randn(*shape).astype(np.float32)
+            resolution = np.array(shape[1:-1])
+            coords = (random.rand(shape[0], 9, 8, len(resolution)) * (resolution + 4) - 2).astype(np.float32)
+            points = [np.arange(n) for n in resolution]
+            for interpolation in ('linear', 'nearest'):
+                for boundary, transform in (('constant', lambda x: x), ('replicate', lambda x: np.clip(x, 0, resolution - 1))):
+                    expected = np.stack([np.stack([scipy.interpolate.interpn(points, inputs[b, ..., c], transform(coords[b]), method=interpolation, bounds_error=False, fill_value=0)
+                                                   for c in range(shape[-1])], -1) for b in range(shape[0])])
+                    np.testing.assert_allclose(resample(inputs, coords, interpolation, boundary), expected, atol=1e-5)
+            # circular boundaries are periodic with the resolution and agree with the other modes inside the grid
+            inside = np.clip(coords, 0, resolution - 1)
+            np.testing.assert_allclose(resample(inputs, inside - resolution, boundary='circular'), resample(inputs, inside, boundary='constant'), atol=1e-4)
+        # the batch dimension of inputs or coordinates may be 1
+        inputs = random.randn(3, 4, 4, 2).astype(np.float32)
+        coords = random.rand(1, 5, 2).astype(np.float32) * 3
+        np.testing.assert_allclose(resample(inputs, coords), np.stack([resample(inputs[i:i + 1], coords)[0] for i in range(3)]), atol=1e-6)
+
+    def test_conv(self):
+        import scipy.signal
+        random = np.random.RandomState(0)
+        for tensor_shape, kernel_shape in (([2, 8, 7, 2], [3, 3, 2, 3]), ([2, 10, 9, 1], [7, 7, 1, 2]), ([1, 6, 5, 7, 1], [3, 3, 3, 1, 1])):
+            tensor = random.randn(*tensor_shape).astype(np.float32)
+            kernel = random.randn(*kernel_shape).astype(np.float32)
+            for padding in ('same', 'valid'):
+                expected = np.stack([np.stack([np.sum([scipy.signal.correlate(tensor[b, ..., i], kernel[..., i, o], padding) for i in range(tensor_shape[-1])], 0)
+                                               for o in range(kernel_shape[-1])], -1) for b in range(tensor_shape[0])])
+                np.testing.assert_allclose(conv(tensor, kernel, padding), expected, atol=1e-4)
+                np.testing.assert_allclose(conv(tensor, kernel, padding), expected, atol=1e-4)  # cached kernel spectrum
+        from phi.math.scipy_backend import _KERNEL_SPECTRA
+        self.assertTrue(_KERNEL_SPECTRA)  # the 7x7 kernel is large enough for the FFT path
+        for spectrum in _KERNEL_SPECTRA.values():
+            self.assertFalse(spectrum.flags.writeable)
+        # multi-channel laplace applies the stencil to each component
+        tensor = random.randn(2, 6, 5, 3).astype(np.float32)
+        np.testing.assert_allclose(laplace(tensor), np.concatenate([laplace(tensor[..., i:i + 1]) for i in range(3)], -1), atol=1e-5)
+
+    def test_default_arithmetic(self):
+        from phi.math.base_backend import Backend
+        backend = SciPyBackend()  # the default implementations of Backend only use as_tensor()
+        a, b = np.array([2., 3.]), np.array([4., 5.])
+        np.testing.assert_equal(Backend.add(backend, a, b), [6, 8])  # used to return a * b
+        np.testing.assert_equal(Backend.sub(backend, a, b), [-2, -2])
+        np.testing.assert_equal(Backend.mul(backend, a, b), [8, 15])
+        np.testing.assert_equal(Backend.div(backend, a, b), [0.5, 0.6])
+
+    def test_sparse_matmul(self):
+        import scipy.sparse
+        A = scipy.sparse.random(20, 20, density=0.2, format='csr', random_state=0, dtype=np.float32)
+        b = np.random.RandomState(0).randn(3, 20).astype(np.float32)
+        result = matmul(A, b)
+        np.testing.assert_allclose(result, np.stack([A.dot(b[i]) for i in range(3)]), atol=1e-6)
+        self.assertTrue(result.flags['C_CONTIGUOUS'])
+        np.testing.assert_allclose(matmul(A.toarray(), b), result, atol=1e-5)
+
+    def test_choose_backend(self):
+        from phi.math.base_backend import DYNAMIC_BACKEND, NoBackendFound
+        array = np.zeros([2, 3])
+        scipy_backend = choose_backend(array)
+        self.assertEqual(scipy_backend.name, 'SciPy')
+        self.assertIs(choose_backend((array, None, 1.)), scipy_backend)
+        self.assertIn((np.ndarray,), DYNAMIC_BACKEND._dispatch_cache)
+        self.assertEqual(choose_backend([array, AABox(0, 1)]).name, 'StructBroadcast')
+        self.assertNotIn((list,), DYNAMIC_BACKEND._dispatch_cache)  # containers are dispatched by content
+        with use_backend('SciPy') as backend:
+            self.assertIs(backend, scipy_backend)
+            self.assertIs(choose_backend(object()), scipy_backend)
+            self.assertEqual(choose_backend(AABox(0, 1)).name, 'StructBroadcast')
+            with use_backend(None):
+                self.assertIs(choose_backend(object()), scipy_backend)
+        self.assertRaises(NoBackendFound, lambda: choose_backend(object()))
+
+    def test_buffer_pool(self):
+        pool = BufferPool(min_bytes=0)
+        kept = pool.allocate([4, 8])
+        temporary = pool.allocate([4, 8])
+        self.assertIsNot(kept, temporary)
+        temporary_id = id(temporary)
+        del temporary
+        self.assertEqual(id(pool.allocate([4, 8])), temporary_id)  # unreferenced arrays are reused
+        self.assertEqual((pool.reused, pool.allocated), (1, 2))
+        backend = SciPyBackend(buffer_pool=pool)
+        tensor = np.random.RandomState(0).rand(2, 6, 5, 3).astype(np.float32)
+        for mode in ('constant', 'replicate', 'circular', [['constant', 'circular'], ['replicate', 'constant'], ['circular', 'replicate'], ['constant', 'constant']]):
+            np.testing.assert_equal(backend.pad(tensor, [[0, 0], [2, 1], [0, 3], [0, 0]], mode), SCIPY_BACKEND.pad(tensor, [[0, 0], [2, 1], [0, 3], [0, 0]], mode))
+        coords = np.random.RandomState(1).rand(2, 4, 4, 2) * 7 - 1
+        out = np.empty([2, 4, 4, 3], np.float32)
+        self.assertIs(backend.resample(tensor, coords, boundary='circular', out=out), out)
+        np.testing.assert_equal(out, SCIPY_BACKEND.resample(tensor, coords, boundary='circular'))
+        kernel = np.random.RandomState(2).rand(3, 3, 3, 2)
+        np.testing.assert_allclose(backend.conv(tensor, kernel), SCIPY_BACKEND.conv(tensor, kernel), atol=1e-5)
+        np.testing.assert_equal(backend.add(tensor, 1), tensor + 1)
+
+    def test_threaded_backend(self):
+        import scipy.sparse
+        from phi.math.parallel import BatchThreadPool
+        serial, threaded = SciPyBackend(batch_pool=None), SciPyBackend(batch_pool=BatchThreadPool(workers=3))
+        random = np.random.RandomState(0)
+        for batch_size in (1, 4):
+            tensor = random.rand(batch_size, 64, 64, 2).astype(np.float32)
+            coords = random.rand(batch_size, 64, 64, 2) * 66 - 1
+            np.testing.assert_equal(threaded.resample(tensor, coords), serial.resample(tensor, coords))
+            kernel = np.zeros([3, 3, 2, 2], np.float32)
+            kernel[1, :] = kernel[:, 1] = random.rand(3, 2, 2)
+            np.testing.assert_allclose(threaded.conv(tensor, kernel), serial.conv(tensor, kernel), atol=1e-5)
+            np.testing.assert_allclose(threaded.ifft(threaded.fft(tensor)).real, tensor, atol=1e-5)
+        A = scipy.sparse.random(4096, 4096, density=1e-3, format='csr', random_state=0, dtype=np.float32)
+        b = random.randn(16, 4096).astype(np.float32)
+        np.testing.assert_allclose(threaded.matmul(A, b), serial.matmul(A, b), rtol=1e-5)
+
+    def test_real_fft(self):
+        tensor = np.random.RandomState(0).rand(2, 12, 9, 3).astype(np.float32)
+        spectrum = rfft(tensor)
+        self.assertEqual(spectrum.shape, (2, 12, 5, 3))
+        np.testing.assert_allclose(spectrum, fft(tensor)[:, :, :5], atol=1e-4)
+        np.testing.assert_allclose(irfft(spectrum, [12, 9]), tensor, atol=1e-5)
+        real_laplace = fourier_laplace(tensor)
+        self.assertEqual(real_laplace.dtype, np.float32)
+        np.testing.assert_allclose(real_laplace, np.real(fourier_laplace(tensor.astype(np.complex64))), atol=1e-4)
+        self.assertFalse(fftfreq([12, 9], real=True).flags.writeable)  # cached
+        self.assertIs(fftfreq([12, 9], real=True), fftfreq([12, 9], real=True))
+
+    def test_real_fft_backend_neutral(self):
+        from phi.math.base_backend import Backend
+
+        class Dtype(object):  # like torch.dtype, not readable by NumPy
+            def __init__(self, is_complex):
+                self.is_complex = is_complex
+
+        class ForeignDtypeBackend(SciPyBackend):
+            def dtype(self, array):
+                return Dtype(np.iscomplexobj(array))
+
+        class NoRealFFTBackend(ForeignDtypeBackend):
+            rfft = Backend.rfft
+            irfft = Backend.irfft
+
+        tensor = np.random.RandomState(0).rand(2, 12, 9, 1).astype(np.float32)
+        expected = fourier_laplace(tensor)
+        with use_backend(ForeignDtypeBackend()):
+            self.assertTrue(use_real_fft(tensor))
+            self.assertFalse(use_real_fft(tensor.astype(np.complex64)))
+            np.testing.assert_allclose(fourier_laplace(tensor), expected, atol=1e-4)
+        with use_backend(NoRealFFTBackend()):
+            self.assertFalse(use_real_fft(tensor))
+            np.testing.assert_allclose(np.real(fourier_laplace(tensor)), expected, atol=1e-4)
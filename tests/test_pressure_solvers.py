@@ -0,0 +1,437 @@
+from unittest import TestCase
+
+import numpy
+from scipy.sparse import coo_matrix
+
+from phi.geom import Sphere
+from phi.math.parallel import BatchThreadPool
+from phi.physics.domain import Domain
+from phi.physics.fluid import Fluid, IncompressibleFlow
+from phi.physics.material import CLOSED, OPEN, PERIODIC
+from phi.physics.obstacle import Obstacle
+from phi.physics.field import CenteredGrid
+from phi.physics.pressuresolver.amg import AMGPreconditioner, AMGSolver, CoarseFactorization, cached_amg_hierarchy
+from phi.physics.pressuresolver.cache import OperatorCache, mask_key, nbytes_of
+from phi.physics.pressuresolver.fourier import FourierSolver
+from phi.physics.pressuresolver.geom import GeometricCG
+from phi.physics.pressuresolver.metrics import SolveMetrics, solve_converged
+from phi.physics.pressuresolver.matrix_free import MatrixFreeSciPy, PressureStencilOperator
+from phi.physics.pressuresolver.multigrid import MultigridPreconditioner, MultigridSolver
+from phi.physics.pressuresolver.multiscale import MultiscaleSolver
+from phi.physics.pressuresolver.schedule import AccuracySchedule
+from phi.physics.pressuresolver.schwarz import SchwarzCG, partition_grid
+from phi.physics.pressuresolver.sor import SORSolver, optimal_sor_omega
+from phi.physics.pressuresolver.preconditioner import JacobiPreconditioner, IncompleteLUPreconditioner
+from phi.physics.pressuresolver.solver_api import FluidDomain, PressureSolver
+from phi.physics.pressuresolver.sparse import SparseCG, SparseSciPy, cached_sparse_indices, sparse_indices, sparse_pressure_matrix, sparse_values
+from phi.physics.world import World
+
+
+def _simulate(pressure_solver, steps=2, obstacle=True):
+    world = World()
+    density = numpy.tile(numpy.linspace(0, 1, 16).reshape([1, 16, 1, 1]), [1, 1, 16, 1])
+    fluid = world.add(Fluid(Domain([16, 16], boundaries=CLOSED), density=density, buoyancy_factor=0.1),
+                      physics=IncompressibleFlow(pressure_solver=pressure_solver))
+    if obstacle:
+        world.add(Obstacle(Sphere([8, 8], radius=3)))
+    for _ in range(steps):
+        world.step()
+    return fluid
+
+
+def _closed_box_problem(size, batch_size=2):
+    active = numpy.ones([1, size, size, 1], numpy.float32)
+    active[:, size // 4:size // 2, size // 4:size // 3, :] = 0
+    domain = FluidDomain(Domain([size, size], boundaries=CLOSED), active=CenteredGrid(active, extrapolation='constant'), accessible=CenteredGrid(active, extrapolation='constant'))
+    divergence = numpy.random.RandomState(0).randn(batch_size, size, size, 1).astype(numpy.float32) * active
+    divergence -= numpy.sum(divergence, axis=(1, 2, 3), keepdims=True) / numpy.sum(active) * active  # compatible with closed boundaries
+    return domain, divergence
+
+
+class TestPressureSolvers(TestCase):
+
+    def test_operator_cache_eviction(self):
+        cache = OperatorCache(max_bytes=2000)
+        cache.put('a', numpy.zeros(100, numpy.float64))  # 800 bytes
+        cache.put('b', numpy.zeros(100, numpy.float64))
+        self.assertIsNotNone(cache.get('a'))  # b is now least recently used
+        cache.put('c', numpy.zeros(100, numpy.float64))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.hits, 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.misses, 1)
+        cache.put('d', numpy.zeros(1000))  # larger than budget
+        self.assertNotIn('d', cache)
+        self.assertLessEqual(cache.nbytes, 2000)
+
+    def test_mask_key(self):
+        mask = numpy.ones([1, 6, 6, 1], numpy.float32)
+        self.assertEqual(mask_key([4, 4], mask, mask), mask_key([4, 4], mask.copy(), mask))
+        changed = mask.copy()
+        changed[0, 2, 2, 0] = 0
+        self.assertNotEqual(mask_key([4, 4], mask, mask), mask_key([4, 4], changed, mask))
+        self.assertIsNone(mask_key([4, 4], mask, 'symbolic'))
+
+    def test_matrix_cache(self):
+        cache = OperatorCache()
+        fluid = _simulate(SparseCG(matrix_cache=cache), steps=3)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.misses, 1)
+        self.assertGreaterEqual(cache.hits, 2)
+        reference = _simulate(SparseCG(matrix_cache=None), steps=3)
+        numpy.testing.assert_equal(fluid.velocity.staggered_tensor(), reference.velocity.staggered_tensor())
+        cache = OperatorCache()
+        _simulate(SparseSciPy(matrix_cache=cache), steps=2)
+        self.assertEqual(cache.misses, 1)
+
+    def test_sparse_matrix_assembly(self):
+        dimensions = [5, 6]
+        mask = numpy.zeros([1, 7, 8, 1], numpy.float32)
+        mask[:, 1:-1, 1:-1, :] = 1  # closed boundaries
+        mask[0, 3, 3, 0] = 0
+        A = sparse_pressure_matrix(dimensions, mask, mask)
+        self.assertEqual(A.format, 'csr')
+        indices, sorting = sparse_indices(dimensions)
+        values = sparse_values(dimensions, mask, mask, sorting)
+        numpy.testing.assert_equal(A.toarray(), coo_matrix((values, (indices[:, 0], indices[:, 1])), shape=A.shape).toarray())
+        numpy.testing.assert_equal(A.toarray(), A.toarray().T)
+        numpy.testing.assert_equal(A.diagonal()[:6], [-2, -3, -3, -3, -3, -2])
+        cache = OperatorCache()
+        cached_indices, cached_sorting = cached_sparse_indices(dimensions, cache)
+        numpy.testing.assert_equal(cached_indices, indices)
+        numpy.testing.assert_equal(cached_sorting, sorting)
+        self.assertIs(cached_sparse_indices(dimensions, cache)[0], cached_indices)
+        self.assertFalse(cached_indices.flags.writeable)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_solve_info(self):
+        fluid = _simulate(SparseCG(), steps=1)
+        self.assertIn('assembly_time', fluid.solve_info)
+        self.assertEqual(fluid.solve_info['nnz'], 16 * 16 * 5 - 4 * 16)
+
+    def test_solver_without_base_init(self):
+        class LegacySolver(PressureSolver):
+            def __init__(self):  # does not call PressureSolver.__init__, so there is no solve_info
+                self.name = 'Legacy'
+                self.supports_guess = False
+                self.supports_loop_counter = False
+
+            def solve(self, divergence, domain, pressure_guess):
+                return SparseSciPy().solve(divergence, domain, pressure_guess)
+        fluid = _simulate(LegacySolver(), steps=1)
+        self.assertIn('iterations', fluid.solve_info)
+        metrics = SolveMetrics()
+        world = World()
+        fluid = world.add(Fluid(Domain([16, 16])), physics=IncompressibleFlow(pressure_solver=LegacySolver(), metrics=metrics))
+        world.step()
+        self.assertTrue(metrics.records(fluid.name)[0]['converged'])  # direct solvers are exact
+
+    def test_sparse_scipy_factorization(self):
+        cache = OperatorCache()
+        fluid = _simulate(SparseSciPy(factorize=True, factorization_cache=cache), steps=3)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 2)
+        reference = _simulate(SparseSciPy(), steps=3)
+        numpy.testing.assert_allclose(fluid.velocity.staggered_tensor(), reference.velocity.staggered_tensor(), atol=1e-4)
+
+    def test_threaded_batch(self):
+        domain, divergence = _closed_box_problem(16, batch_size=5)
+        A = sparse_pressure_matrix([16, 16], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        sequential, _ = SparseSciPy(batch_pool=None).solve(divergence, domain, None)
+        threaded, _ = SparseSciPy(batch_pool=BatchThreadPool(workers=3)).solve(divergence, domain, None)
+        numpy.testing.assert_equal(threaded, sequential)
+        pool = BatchThreadPool(workers=3)
+        products = pool.map(lambda i: A.dot(divergence[i].flatten()), 5)
+        numpy.testing.assert_equal(numpy.stack(products), A.dot(divergence.reshape([5, -1]).T).T)
+        nested = pool.map(lambda i: pool.map(lambda j: i * j, 3), 4)
+        self.assertEqual(nested, [[i * j for j in range(3)] for i in range(4)])
+
+    def test_preconditioners(self):
+        domain, divergence = _closed_box_problem(32)
+        A = sparse_pressure_matrix([32, 32], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        iterations = {}
+        for preconditioner in (None, JacobiPreconditioner(), IncompleteLUPreconditioner(), MultigridPreconditioner()):
+            solver = SparseCG(accuracy=1e-3, preconditioner=preconditioner)
+            pressure, iterations[str(preconditioner)] = solver.solve(divergence, domain, None)
+            residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+            self.assertLess(numpy.max(numpy.abs(residual)), 1e-3)
+            self.assertIn('solve_time', solver.solve_info)
+        self.assertLess(iterations['Incomplete LU'], iterations['None'])
+        self.assertLess(iterations['Multigrid V-cycle'], iterations['None'] / 4)
+        pressure, geom_iterations = GeometricCG(accuracy=1e-3, preconditioner=MultigridPreconditioner()).solve(divergence, domain, None)
+        self.assertLess(geom_iterations, iterations['None'] / 4)
+
+    def test_incomplete_lu_preconditioner(self):
+        domain, divergence = _closed_box_problem(64)
+        cache = OperatorCache()
+        coarse = IncompleteLUPreconditioner(drop_tol=1e-2, cache=cache).bind(domain)
+        fine = IncompleteLUPreconditioner(drop_tol=1e-5, cache=cache).bind(domain)
+        self.assertEqual(len(cache), 2)  # drop_tol is part of the key
+        x, y = numpy.random.RandomState(1).randn(2, 1, 64, 64, 1)
+        self.assertGreater(numpy.max(numpy.abs(coarse(x) - fine(x))), 1e-3)
+        for apply in (coarse, fine):
+            self.assertAlmostEqual(numpy.sum(x * apply(y)), numpy.sum(y * apply(x)), places=6)  # symmetric, required by CG
+        _, iterations = SparseCG(accuracy=1e-3, preconditioner=IncompleteLUPreconditioner(cache=cache)).solve(divergence, domain, None)
+        _, plain_iterations = SparseCG(accuracy=1e-3).solve(divergence, domain, None)
+        self.assertLess(iterations, plain_iterations / 2)
+
+    def test_per_example_convergence(self):
+        domain, divergence = _closed_box_problem(32, batch_size=3)
+        divergence[1] *= 1e-3
+        divergence[2] = 0
+        reference, iterations = SparseCG(accuracy=1e-3).solve(divergence, domain, None)
+        for solver in (SparseCG(accuracy=1e-3, per_example=True), SparseCG(accuracy=1e-3, per_example=True, compact_batch=True), GeometricCG(accuracy=1e-3, per_example=True, compact_batch=True)):
+            pressure, max_iterations = solver.solve(divergence, domain, None)
+            example_iterations = solver.solve_info['example_iterations']
+            self.assertEqual(len(example_iterations), 3)
+            self.assertEqual(max_iterations, numpy.max(example_iterations))
+            self.assertLess(example_iterations[1], example_iterations[0])
+            self.assertEqual(example_iterations[2], 0)
+            numpy.testing.assert_allclose(pressure[0], reference[0], atol=1e-3)
+            numpy.testing.assert_equal(pressure[2], 0)
+
+    def test_mixed_precision(self):
+        domain, divergence = _closed_box_problem(64)
+        A = sparse_pressure_matrix([64, 64], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1)).astype(numpy.float64)
+        max_residual = {}
+        for mixed_precision in (False, True):
+            pressure, iterations = SparseCG(accuracy=1e-5, mixed_precision=mixed_precision).solve(divergence, domain, None)
+            self.assertEqual(pressure.dtype, numpy.float32)
+            residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+            max_residual[mixed_precision] = numpy.max(numpy.abs(residual))
+        self.assertLess(max_residual[True], 5e-5)
+        self.assertLess(max_residual[True], max_residual[False] / 4)
+        solver = SparseCG(accuracy=1e-5, mixed_precision=True, per_example=True)
+        pressure, iterations = solver.solve(divergence, domain, None)
+        self.assertEqual(iterations, numpy.max(solver.solve_info['example_iterations']))
+
+    def test_stopping_criteria(self):
+        domain, divergence = _closed_box_problem(32, batch_size=3)
+        divergence[1] *= 1e-3
+        A = sparse_pressure_matrix([32, 32], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        norms = {'max': lambda x: numpy.max(numpy.abs(x), axis=1), 'l2': lambda x: numpy.sqrt(numpy.sum(x ** 2, axis=1)), 'rms': lambda x: numpy.sqrt(numpy.mean(x ** 2, axis=1))}
+        for norm, norm_function in norms.items():
+            for solver in (SparseCG(accuracy=1e-3, norm=norm, relative=True), SparseCG(accuracy=1e-3, norm=norm, relative=True, per_example=True, compact_batch=True), GeometricCG(accuracy=1e-3, norm=norm, relative=True, per_example=True)):
+                pressure, _ = solver.solve(divergence, domain, None)
+                residual = divergence.reshape([3, -1]) - A.dot(pressure.reshape([3, -1]).T).T
+                numpy.testing.assert_array_less(norm_function(residual), 2e-3 * norm_function(divergence.reshape([3, -1])))
+        _, iterations = SparseCG(accuracy=1e-4, relative=True).solve(divergence[:1], domain, None)
+        _, scaled_iterations = SparseCG(accuracy=1e-4, relative=True).solve(divergence[:1] * 1e3, domain, None)
+        self.assertLessEqual(abs(iterations - scaled_iterations), 2)  # relative criteria are independent of the magnitude of the divergence
+        pressure, _ = SparseCG(accuracy=1e-4, relative=True, mixed_precision=True).solve(divergence, domain, None)
+        residual = divergence.reshape([3, -1]) - A.dot(pressure.reshape([3, -1]).T).T
+        numpy.testing.assert_array_less(numpy.max(numpy.abs(residual), axis=1), 1e-3 * numpy.max(numpy.abs(divergence.reshape([3, -1])), axis=1))
+
+    def test_accuracy_schedule(self):
+        schedule = AccuracySchedule(min_iterations=10, max_iterations=100, adjustment=2., reference_cfl=1.)
+        self.assertEqual(schedule.factor('fluid', cfl=0.5), 2.)
+        self.assertEqual(schedule.factor('fluid', cfl=0.), 10.)
+        schedule.update('fluid', 5)
+        self.assertEqual(schedule.factor('fluid', cfl=1.), 0.5)
+        schedule.update('fluid', 500)
+        schedule.update('fluid', 500)
+        self.assertEqual(schedule.factor('fluid', cfl=1.), 2.)
+        self.assertEqual(schedule.factor('other', cfl=1.), 1.)
+        solver = SparseCG(accuracy=1e-3)
+        scheduled = schedule.scheduled_solver(solver, 'fluid', cfl=1.)
+        self.assertEqual(scheduled.accuracy, 2e-3)
+        self.assertEqual(solver.accuracy, 1e-3)
+        direct_solver = SparseSciPy()
+        self.assertIs(schedule.scheduled_solver(direct_solver, 'fluid'), direct_solver)
+        world = World()
+        fluid = world.add(Fluid(Domain([16, 16], boundaries=CLOSED), buoyancy_factor=0.1, density=1), physics=IncompressibleFlow(pressure_solver=SparseCG(accuracy=1e-3), accuracy_schedule=AccuracySchedule()))
+        world.step()
+        self.assertIn('accuracy', fluid.solve_info)
+
+    def test_solve_metrics(self):
+        metrics = SolveMetrics()
+        world = World()
+        density = numpy.tile(numpy.linspace(0, 1, 16).reshape([1, 16, 1, 1]), [1, 1, 16, 1])
+        fluid = world.add(Fluid(Domain([16, 16], boundaries=CLOSED), density=density, buoyancy_factor=0.1),
+                          physics=IncompressibleFlow(pressure_solver=SparseCG(accuracy=1e-4, residual_history=2), metrics=metrics))
+        world.step()
+        world.step()
+        info = fluid.solve_info
+        self.assertTrue(info['converged'])
+        self.assertGreater(info['wall_time'], 0)
+        self.assertLess(info['residual'], 1e-4)
+        self.assertLess(info['divergence'], 1e-3)
+        self.assertEqual([iteration for iteration, _ in info['residual_history']], list(range(2, info['iterations'] + 1, 2)))
+        # hitting the iteration limit is reported as unconverged
+        fluid.physics.pressure_solver = GeometricCG(accuracy=1e-6, max_iterations=3, residual_history=1)
+        world.step()
+        self.assertFalse(fluid.solve_info['converged'])
+        self.assertEqual(len(fluid.solve_info['residual_history']), 3)
+        self.assertEqual([record['solve'] for record in metrics.unconverged('fluid')], [2])
+        summary = metrics.summary('fluid')
+        self.assertEqual(summary['solves'], 3)
+        self.assertEqual(summary['unconverged'], 1)
+        self.assertEqual(summary['max_iterations'], max(record['iterations'] for record in metrics.records('fluid')))
+        self.assertNotIn('divergence', _simulate(SparseCG(), steps=1).solve_info)  # diagnostics are only computed with metrics
+        sor = SORSolver(iterations=4)
+        self.assertIsNone(solve_converged(sor, _simulate(sor, steps=1).solve_info['iterations']))
+        direct = SparseSciPy()
+        self.assertTrue(solve_converged(direct, _simulate(direct, steps=1).solve_info['iterations']))
+
+    def test_stencil_operator(self):
+        for dimensions in ([7, 5], [6, 5, 4]):
+            random = numpy.random.RandomState(0)
+            active_mask = (random.rand(*[1] + [n + 2 for n in dimensions] + [1]) > 0.3).astype(numpy.float32)
+            fluid_mask = numpy.maximum(active_mask, random.rand(*active_mask.shape) > 0.5).astype(numpy.float32)
+            operator = PressureStencilOperator(dimensions, active_mask, fluid_mask)
+            A = sparse_pressure_matrix(dimensions, active_mask, fluid_mask)
+            self.assertLess(operator.nbytes, nbytes_of(A))
+            x = random.randn(*[3] + dimensions + [1]).astype(numpy.float32)
+            numpy.testing.assert_allclose(operator.apply(x).reshape([3, -1]), A.dot(x.reshape([3, -1]).T).T, atol=1e-5)
+            numpy.testing.assert_allclose(operator.matvec(x[0].flatten()), A.dot(x[0].flatten()), atol=1e-5)
+            numpy.testing.assert_allclose(operator.matmat(x.reshape([3, -1]).T), A.dot(x.reshape([3, -1]).T), atol=1e-5)
+
+    def test_matrix_free_solver(self):
+        domain = FluidDomain(Domain([32, 32], boundaries=OPEN))
+        divergence = numpy.random.RandomState(0).randn(2, 32, 32, 1).astype(numpy.float32)
+        A = sparse_pressure_matrix([32, 32], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        for solver in (MatrixFreeSciPy('cg'), MatrixFreeSciPy('minres', accuracy=1e-6), MatrixFreeSciPy('gmres'), MatrixFreeSciPy('blas'), MatrixFreeSciPy('cg', preconditioner=MultigridPreconditioner())):
+            pressure, iterations = solver.solve(divergence, domain, None)
+            residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+            self.assertLess(numpy.max(numpy.abs(residual)), 1e-4, solver.name)
+            self.assertGreater(iterations, 0)
+        _simulate(MatrixFreeSciPy())
+
+    def test_multigrid_solver(self):
+        domain, divergence = _closed_box_problem(64)
+        A = sparse_pressure_matrix([64, 64], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        for solver in (MultigridSolver(), MultigridSolver(cycle='W', smoother='jacobi'), MultigridSolver(cycle='F')):
+            pressure, cycles = solver.solve(divergence, domain, None)
+            residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+            self.assertLess(numpy.max(numpy.abs(residual)), 1e-4)
+            self.assertLess(cycles, 30)
+            self.assertEqual(solver.solve_info['levels'], 5)
+        _simulate(MultigridSolver())
+
+    def test_multigrid_closed_box(self):
+        active = numpy.ones([1, 64, 64, 1], numpy.float32)
+        domain = FluidDomain(Domain([64, 64], boundaries=CLOSED), active=CenteredGrid(active, extrapolation='constant'), accessible=CenteredGrid(active, extrapolation='constant'))
+        divergence = numpy.random.RandomState(0).randn(2, 64, 64, 1).astype(numpy.float32)
+        divergence -= numpy.mean(divergence, axis=(1, 2, 3), keepdims=True)
+        A = sparse_pressure_matrix([64, 64], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        for cycle in ('W', 'F'):
+            for smoother in ('rbgs', 'jacobi'):
+                pressure, _ = MultigridSolver(accuracy=1e-4, cycle=cycle, smoother=smoother).solve(divergence, domain, None)
+                self.assertEqual(pressure.dtype, numpy.float32)
+                residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+                self.assertLess(numpy.max(numpy.abs(residual)), 1e-3, (cycle, smoother))  # the constant null space component must not grow
+                self.assertLess(numpy.max(numpy.abs(pressure)), 100)
+
+    def test_amg_solver(self):
+        size = 48
+        maze = numpy.ones([1, size, size, 1], numpy.float32)
+        for i, x in enumerate(range(6, size - 6, 8)):  # thin walls with alternating gaps
+            maze[:, 2:size - 2, x, :] = 0
+            maze[:, (size - 6 if i % 2 == 0 else 2):(size - 2 if i % 2 == 0 else 6), x, :] = 1
+        domain = FluidDomain(Domain([size, size], boundaries=CLOSED), active=CenteredGrid(maze, extrapolation='constant'), accessible=CenteredGrid(maze, extrapolation='constant'))
+        divergence = numpy.random.RandomState(0).randn(2, size, size, 1).astype(numpy.float32) * maze
+        divergence -= numpy.sum(divergence, axis=(1, 2, 3), keepdims=True) / numpy.sum(maze) * maze
+        A = sparse_pressure_matrix([size, size], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        cache = OperatorCache()
+        for solver in (AMGSolver(cache=cache), AMGSolver(cycle='W', cache=cache)):
+            pressure, cycles = solver.solve(divergence, domain, None)
+            residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+            self.assertLess(numpy.max(numpy.abs(residual)), 1e-4)
+            self.assertLess(cycles, 40)
+            self.assertGreater(solver.solve_info['levels'], 1)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+        _, cg_iterations = SparseCG(accuracy=1e-3).solve(divergence, domain, None)
+        pressure, amg_iterations = SparseCG(accuracy=1e-3, preconditioner=AMGPreconditioner(cache=cache)).solve(divergence, domain, None)
+        residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+        self.assertLess(numpy.max(numpy.abs(residual)), 1e-3)
+        self.assertLess(amg_iterations, cg_iterations / 4)
+        _simulate(AMGSolver())
+
+    def test_amg_coarse_factorization(self):
+        domain, divergence = _closed_box_problem(32)
+        A = sparse_pressure_matrix([32, 32], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        factorization = CoarseFactorization(A, numpy.ones(A.shape[0]))
+        rhs = numpy.random.RandomState(1).randn(A.shape[0], 2)
+        numpy.testing.assert_allclose(factorization.dot(rhs), numpy.linalg.pinv(A.toarray().astype(numpy.float64), rcond=1e-10).dot(rhs), atol=1e-8)
+        for max_levels in (1, 2):  # coarsening stops above max_coarse
+            hierarchy = cached_amg_hierarchy(domain, max_coarse=16, max_levels=max_levels, cache=None)
+            self.assertIsInstance(hierarchy[-1].coarse_inverse, CoarseFactorization)
+            pressure, cycles = AMGSolver(max_coarse=16, max_levels=max_levels, cache=None).solve(divergence, domain, None)
+            residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+            self.assertLess(numpy.max(numpy.abs(residual)), 1e-4)
+            self.assertLess(cycles, 40)
+
+    def test_sor_solver(self):
+        domain, divergence = _closed_box_problem(16)
+        A = sparse_pressure_matrix([16, 16], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        iterations = {}
+        for omega in (1., 'optimal'):
+            solver = SORSolver(accuracy=1e-4, omega=omega)
+            pressure, iterations[omega] = solver.solve(divergence, domain, None)
+            residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+            self.assertLess(numpy.max(numpy.abs(residual)), 1e-4)
+        self.assertLess(iterations['optimal'], iterations[1.] / 2)
+        self.assertGreater(optimal_sor_omega([64, 64]), optimal_sor_omega([16, 16]))
+        pressure, fixed_iterations = SORSolver(iterations=5).solve(divergence, domain, None)
+        self.assertEqual(fixed_iterations, 5)
+        residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+        self.assertLess(numpy.max(numpy.abs(residual)), numpy.max(numpy.abs(divergence)))
+        _simulate(SORSolver(iterations=20))
+        domain, divergence = _closed_box_problem(64)
+        pressure, cycles = MultigridSolver(smoother='sor').solve(divergence, domain, None)
+        self.assertLess(cycles, 30)
+
+    def test_schwarz_solver(self):
+        self.assertEqual(partition_grid([10, 4], [2, 1], overlap=1), [((0, 6), (0, 4)), ((4, 10), (0, 4))])
+        domain, divergence = _closed_box_problem(32)
+        A = sparse_pressure_matrix([32, 32], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        _, cg_iterations = SparseCG(accuracy=1e-3).solve(divergence, domain, None)
+        results = {}
+        for workers, overlap, blocks in ((1, 0, [2, 2]), (1, 2, [2, 2]), (2, 2, [2, 2]), (1, 2, [1, 1])):
+            solver = SchwarzCG(accuracy=1e-3, blocks=blocks, overlap=overlap, workers=workers)
+            try:
+                pressure, iterations = solver.solve(divergence, domain, None)
+                self.assertEqual(solver.solve(divergence, domain, None)[1], iterations)  # cached factorizations
+            finally:
+                solver.preconditioner.close()
+            residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+            self.assertLess(numpy.max(numpy.abs(residual)), 1e-3)
+            self.assertLess(iterations, cg_iterations / 2)
+            results[(workers, overlap, str(blocks))] = pressure, iterations
+        self.assertLess(results[(1, 2, '[2, 2]')][1], results[(1, 0, '[2, 2]')][1])
+        numpy.testing.assert_equal(results[(2, 2, '[2, 2]')][0], results[(1, 2, '[2, 2]')][0])
+
+    def test_fourier_solver(self):
+        for boundaries in (CLOSED, OPEN, [CLOSED, OPEN]):
+            domain = FluidDomain(Domain([16, 12], boundaries=boundaries))
+            divergence = numpy.random.RandomState(0).randn(2, 16, 12, 1).astype(numpy.float32)
+            divergence -= numpy.mean(divergence, axis=(1, 2), keepdims=True)
+            solver = FourierSolver()
+            pressure, iterations = solver.solve(divergence, domain, None)
+            self.assertIsNone(iterations)
+            self.assertFalse(solver.solve_info['fallback'])
+            A = sparse_pressure_matrix([16, 12], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+            residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+            self.assertLess(numpy.max(numpy.abs(residual)), 1e-4)
+        # Periodic
+        pressure, _ = FourierSolver().solve(divergence, FluidDomain(Domain([16, 12], boundaries=PERIODIC)), None)
+        laplace = sum([numpy.roll(pressure, 1, axis) + numpy.roll(pressure, -1, axis) - 2 * pressure for axis in (1, 2)])
+        numpy.testing.assert_allclose(laplace, divergence, atol=1e-4)
+        # Obstacles
+        domain, divergence = _closed_box_problem(16)
+        solver = FourierSolver()
+        pressure, iterations = solver.solve(divergence, domain, None)
+        self.assertTrue(solver.solve_info['fallback'])
+        self.assertGreater(iterations, 0)
+        _simulate(FourierSolver(), obstacle=False)
+
+    def test_multiscale_solver(self):
+        domain, divergence = _closed_box_problem(32)
+        solver = MultiscaleSolver([SparseCG(accuracy=1e-3), SparseCG(accuracy=1e-3, preconditioner=JacobiPreconditioner())])
+        pressure, iterations = solver.solve(divergence, domain, None)
+        self.assertEqual(len(iterations), 2)
+        A = sparse_pressure_matrix([32, 32], domain.active_tensor(extend=1), domain.accessible_tensor(extend=1))
+        residual = divergence.reshape([2, -1]) - A.dot(pressure.reshape([2, -1]).T).T
+        self.assertLess(numpy.max(numpy.abs(residual)), 1e-3)